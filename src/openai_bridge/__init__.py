@@ -63,21 +63,55 @@ def menu_func(self, context):
     layout.operator(op.code.OPENAI_OT_GenerateCodeExample.bl_idname,
                     icon_value=icon_collection.icon_id)
 
+    # Resend the request when the cached response is not good.
+    prefs = context.preferences.addons["openai_bridge"].preferences
+    if prefs.response_cache_enabled:
+        ops = layout.operator(op.chat.OPENAI_OT_Ask.bl_idname,
+                              text="Ask (Bypass Cache)",
+                              icon_value=icon_collection.icon_id)
+        ops.bypass_cache = True
+        ops = layout.operator(
+            op.code.OPENAI_OT_GenerateCodeExample.bl_idname,
+            text="Generate Code Example (Bypass Cache)",
+            icon_value=icon_collection.icon_id)
+        ops.bypass_cache = True
+
 
 def register():
     register_updater(bl_info)
 
     properties.register_properties()
 
+    utils.profiler.install_operator_profiling([
+        c["class"]
+        for c in utils.bl_class_registry.BlClassRegistry.class_list])
     utils.bl_class_registry.BlClassRegistry.register()
     ui.register_tools()
-    utils.threading.RequestHandler.start()
-
-    bpy.types.WM_MT_button_context.append(menu_func)
 
     user_prefs = bpy.context.preferences
     prefs = user_prefs.addons["openai_bridge"].preferences
 
+    utils.threading.RequestHandler.start(
+        prefs.num_request_workers,
+        preferences.get_request_concurrency_limits(prefs))
+    utils.rate_limiter.RateLimiter.configure(
+        prefs.rate_limit_enabled, preferences.get_rate_limits(prefs))
+    utils.request_journal.RequestJournal.configure(
+        prefs.persistent_queue_enabled)
+    utils.instrumentation.LatencyRecorder.configure(
+        prefs.latency_instrumentation_enabled, prefs.latency_max_records)
+    utils.metrics.MetricsRegistry.configure(
+        prefs.metrics_enabled, utils.metrics.get_metrics_dir(prefs),
+        prefs.metrics_flush_interval)
+    utils.profiler.Profiler.configure(
+        prefs.profiler_enabled, prefs.profiler_mode,
+        utils.profiler.get_profile_dir(prefs), prefs.profiler_modal_ticks)
+    if prefs.persistent_queue_enabled and not bpy.app.background:
+        bpy.app.timers.register(
+            utils.threading.offer_resume_requests, first_interval=1.0)
+
+    bpy.types.WM_MT_button_context.append(menu_func)
+
     prefs.connection_status = utils.common.check_api_connection(
         prefs.api_key, prefs.http_proxy, prefs.https_proxy)
 
@@ -85,7 +119,13 @@ def register():
 def unregister():
     bpy.types.WM_MT_button_context.remove(menu_func)
 
+    if bpy.app.timers.is_registered(utils.threading.offer_resume_requests):
+        bpy.app.timers.unregister(utils.threading.offer_resume_requests)
     utils.threading.RequestHandler.stop()
+    utils.metrics.MetricsRegistry.stop_exporter()
+    utils.profiler.Profiler.configure(False)
+    # The queued requests are left in the journal to be resumed.
+    utils.request_journal.RequestJournal.close()
 
     ui.unregister_tools()
     utils.bl_class_registry.BlClassRegistry.unregister()
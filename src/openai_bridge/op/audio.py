@@ -119,7 +119,7 @@ created""",
         filepath = sequence.sound.filepath
 
         request = {
-            "file": (filepath, open(filepath, "rb")),   # pylint: disable=R1732
+            "file": (filepath, filepath),
             "model": (None, prefs.audio_tool_model),
             "prompt": (None, self.prompt),
             "response_format": (None, "json"),
@@ -147,7 +147,7 @@ created""",
                 "title": filepath[0:32],
             }
             async_request(api_key, 'TRANSCRIBE_AUDIO', request, options,
-                          transaction_data)
+                          transaction_data, priority='BACKGROUND')
             # Run Message Processing Timer if it has not launched yet.
             bpy.ops.system.openai_process_message()
 
@@ -229,7 +229,7 @@ saved""",
 
         request = {
             "file": (os.path.basename(self.audio_filepath),
-                     open(self.audio_filepath, "rb")),  # pylint: disable=R1732
+                     self.audio_filepath),
             "model": (None, prefs.audio_tool_model),
             "prompt": (None, self.prompt),
             "response_format": (None, "json"),
@@ -254,7 +254,7 @@ saved""",
             }
             async_request(
                 api_key, 'TRANSCRIBE_AUDIO', request, options,
-                transaction_data)
+                transaction_data, priority='BACKGROUND')
             # Run Message Processing Timer if it has not launched yet.
             bpy.ops.system.openai_process_message()
 
@@ -1,17 +1,18 @@
-import os
-import glob
 import bpy
 
 from ..utils.common import (
-    CHAT_DATA_DIR,
     ChatTextFile,
+    get_chat_topic_files,
     get_area_region_space,
     get_code_from_response_data,
+    get_max_prompt_tokens,
 )
 from ..utils.threading import (
     sync_request,
     async_request,
 )
+from ..utils.response_cache import get_response_cache_options
+from ..utils.tokenizer import count_message_tokens
 from ..utils import error_storage
 from ..utils.common import api_connection_enabled
 from ..utils.bl_class_registry import BlClassRegistry
@@ -25,6 +26,13 @@ class OPENAI_OT_Ask(bpy.types.Operator):
     bl_label = "Ask"
     bl_options = {'REGISTER'}
 
+    bypass_cache: bpy.props.BoolProperty(
+        name="Bypass Cache",
+        description="Send the request even if the cached response exists",
+        default=False,
+        options={'SKIP_SAVE'},
+    )
+
     @classmethod
     def poll(cls, context):
         if not api_connection_enabled(context):
@@ -62,7 +70,11 @@ class OPENAI_OT_Ask(bpy.types.Operator):
             "new_topic": True,
             "http_proxy": prefs.http_proxy,
             "https_proxy": prefs.https_proxy,
+            "stream": prefs.chat_tool_stream_response,
+            "history_token_budget": prefs.chat_tool_history_token_budget,
         }
+        if not self.bypass_cache:
+            options["response_cache"] = get_response_cache_options(prefs)
 
         if kind == 'OPERATOR':
             op = context.button_operator
@@ -116,7 +128,8 @@ class OPENAI_OT_Ask(bpy.types.Operator):
                 "type": 'CHAT',
                 "title": options["topic"][0:32],
             }
-            async_request(api_key, 'CHAT', request, options, transaction_data)
+            async_request(api_key, 'CHAT', request, options, transaction_data,
+                          priority='INTERACTIVE')
             # Run Message Processing Timer if it has not launched yet.
             bpy.ops.system.openai_process_message()
 
@@ -461,14 +474,8 @@ class OPENAI_OT_Chat(bpy.types.Operator):
     )
 
     def get_topics(self, _):
-        topic_dir = f"{CHAT_DATA_DIR}/topics"
-        if not os.path.isdir(topic_dir):
-            return []
-
         items = []
-        topic_files = glob.glob(f"{topic_dir}/**/*.json", recursive=True)
-        for file in topic_files:
-            topic_name = os.path.splitext(os.path.basename(file))[0]
+        for topic_name, file in get_chat_topic_files().items():
             items.append((topic_name, topic_name, file))
         return items
 
@@ -543,6 +550,8 @@ class OPENAI_OT_Chat(bpy.types.Operator):
             "new_topic": self.new_topic,
             "http_proxy": prefs.http_proxy,
             "https_proxy": prefs.https_proxy,
+            "stream": prefs.chat_tool_stream_response,
+            "history_token_budget": prefs.chat_tool_history_token_budget,
             "hidden_conditions": [
                 "The question is for the Blender",
             ]
@@ -552,6 +561,14 @@ class OPENAI_OT_Chat(bpy.types.Operator):
         else:
             options["topic"] = self.topic
 
+        num_tokens = count_message_tokens(request["messages"])
+        if num_tokens > get_max_prompt_tokens(request["model"]):
+            self.report(
+                {'WARNING'},
+                f"The prompt is too long ({num_tokens} tokens).")
+            return {'CANCELLED'}
+        options["estimated_prompt_tokens"] = num_tokens
+
         if not prefs.async_execution:
             sync_request(api_key, 'CHAT', request, options, context, self)
         else:
@@ -2,13 +2,12 @@ import glob
 import os
 import uuid
 import bpy
-import gpu
-from gpu_extras.batch import batch_for_shader
 import blf
 from ..utils.common import (
     AUDIO_DATA_DIR,
     CODE_DATA_DIR,
     get_area_region_space,
+    get_max_prompt_tokens,
 )
 from ..utils.audio_recorder import (
     AudioRecorder,
@@ -17,7 +16,10 @@ from ..utils.threading import (
     sync_request,
     async_request,
 )
+from ..utils.response_cache import get_response_cache_options
+from ..utils.tokenizer import count_message_tokens
 from ..utils import error_storage
+from ..utils.overlay import RectBatchCache
 from ..utils.common import api_connection_enabled
 from ..utils.audio_recorder import support_audio_recording
 from ..utils.bl_class_registry import BlClassRegistry
@@ -31,6 +33,13 @@ class OPENAI_OT_GenerateCodeExample(bpy.types.Operator):
     bl_label = "Generate Code Example"
     bl_options = {'REGISTER'}
 
+    bypass_cache: bpy.props.BoolProperty(
+        name="Bypass Cache",
+        description="Send the request even if the cached response exists",
+        default=False,
+        options={'SKIP_SAVE'},
+    )
+
     @classmethod
     def poll(cls, context):
         if not api_connection_enabled(context):
@@ -82,7 +91,10 @@ class OPENAI_OT_GenerateCodeExample(bpy.types.Operator):
             "show_text_editor": True,
             "http_proxy": prefs.http_proxy,
             "https_proxy": prefs.https_proxy,
+            "stream": prefs.code_tool_stream_response,
         }
+        if not self.bypass_cache:
+            options["response_cache"] = get_response_cache_options(prefs)
 
         if kind == 'OPERATOR':
             op = context.button_operator
@@ -115,7 +127,8 @@ class OPENAI_OT_GenerateCodeExample(bpy.types.Operator):
                 "title": options["code"][0:32],
             }
             async_request(
-                api_key, 'GENERATE_CODE', request, options, transaction_data)
+                api_key, 'GENERATE_CODE', request, options, transaction_data,
+                priority='INTERACTIVE')
             # Run Message Processing Timer if it has not launched yet.
             bpy.ops.system.openai_process_message()
 
@@ -352,6 +365,7 @@ class OPENAI_OT_GenerateCodeFromAudio(bpy.types.Operator):
     timer = None
     draw_cb = {"space_data": None, "handler": None}
     recorder = None
+    status_background = RectBatchCache()
 
     @classmethod
     def poll(cls, context):
@@ -369,29 +383,11 @@ class OPENAI_OT_GenerateCodeFromAudio(bpy.types.Operator):
         center_y = context.region.height / 2
 
         # Draw background.
-        original_state = gpu.state.blend_get()
-        gpu.state.blend_set('ALPHA')
         rect_width = 400.0
         rect_height = 180.0
-        vertex_data = {
-            "pos": [
-                [center_x - rect_width / 2, center_y - rect_height / 2],
-                [center_x - rect_width / 2, center_y + rect_height / 2],
-                [center_x + rect_width / 2, center_y + rect_height / 2],
-                [center_x + rect_width / 2, center_y - rect_height / 2],
-            ]
-        }
-        index_data = [
-            [0, 1, 2],
-            [2, 3, 0]
-        ]
-        shader = gpu.shader.from_builtin('2D_UNIFORM_COLOR')
-        batch = batch_for_shader(
-            shader, 'TRIS', vertex_data, indices=index_data)
-        shader.bind()
-        shader.uniform_float("color", [0.0, 0.0, 0.0, 0.6])
-        batch.draw(shader)
-        gpu.state.blend_set(original_state)
+        cls.status_background.draw(
+            center_x - rect_width / 2, center_y - rect_height / 2,
+            rect_width, rect_height, [0.0, 0.0, 0.0, 0.6])
 
         str_to_draw = ""
         if cls.recorder:
@@ -442,6 +438,7 @@ class OPENAI_OT_GenerateCodeFromAudio(bpy.types.Operator):
             "show_text_editor": False,
             "http_proxy": prefs.http_proxy,
             "https_proxy": prefs.https_proxy,
+            "stream": prefs.code_tool_stream_response,
         }
 
         if not prefs.async_execution:
@@ -656,12 +653,21 @@ class OPENAI_OT_GenerateCode(bpy.types.Operator):
             "show_text_editor": self.show_text_editor,
             "http_proxy": prefs.http_proxy,
             "https_proxy": prefs.https_proxy,
+            "stream": prefs.code_tool_stream_response,
         }
         if self.execute_immediately:
             options["code"] = self.prompt[0:64]
         else:
             options["code"] = self.new_code_name
 
+        num_tokens = count_message_tokens(request["messages"])
+        if num_tokens > get_max_prompt_tokens(request["model"]):
+            self.report(
+                {'WARNING'},
+                f"The prompt is too long ({num_tokens} tokens).")
+            return {'CANCELLED'}
+        options["estimated_prompt_tokens"] = num_tokens
+
         if not prefs.async_execution:
             sync_request(api_key, 'GENERATE_CODE', request, options,
                          context, self)
@@ -788,8 +794,17 @@ Edit the [Code] from the below [Instruction].
             "execute_immediately": False,
             "http_proxy": prefs.http_proxy,
             "https_proxy": prefs.https_proxy,
+            "stream": prefs.code_tool_stream_response,
         }
 
+        num_tokens = count_message_tokens(request["messages"])
+        if num_tokens > get_max_prompt_tokens(request["model"]):
+            self.report(
+                {'WARNING'},
+                f"The prompt is too long ({num_tokens} tokens).")
+            return {'CANCELLED'}
+        options["estimated_prompt_tokens"] = num_tokens
+
         if not prefs.async_execution:
             sync_request(api_key, 'EDIT_CODE', request, options, context, self)
         else:
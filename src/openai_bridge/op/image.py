@@ -114,7 +114,8 @@ class OPENAI_OT_GeneateImage(bpy.types.Operator):
                 "title": options["image_name"][0:32],
             }
             async_request(
-                api_key, 'GENERATE_IMAGE', request, options, transaction_data)
+                api_key, 'GENERATE_IMAGE', request, options, transaction_data,
+                priority='BACKGROUND')
             # Run Message Processing Timer if it has not launched yet.
             bpy.ops.system.openai_process_message()
 
@@ -223,11 +224,11 @@ class OPENAI_OT_EditImage(bpy.types.Operator):
         request = {
             "image": (
                 os.path.basename(base_image_filepath),
-                open(base_image_filepath, "rb")     # pylint: disable=R1732
+                base_image_filepath
             ),
             "mask": (
                 os.path.basename(mask_image_filepath),
-                open(mask_image_filepath, "rb")     # pylint: disable=R1732
+                mask_image_filepath
             ),
             "prompt": (None, self.prompt),
             "n": (None, self.num_images),
@@ -237,8 +238,7 @@ class OPENAI_OT_EditImage(bpy.types.Operator):
         options = {
             "base_image_name": self.base_image_name,
             "mask_image_name": self.mask_image_name,
-            "base_image_filepath": base_image_filepath,
-            "mask_image_filepath": mask_image_filepath,
+            "temp_filepaths": [base_image_filepath, mask_image_filepath],
             "http_proxy": prefs.http_proxy,
             "https_proxy": prefs.https_proxy,
         }
@@ -252,7 +252,7 @@ class OPENAI_OT_EditImage(bpy.types.Operator):
                 "title": self.base_image_name[0:32],
             }
             async_request(api_key, 'EDIT_IMAGE', request, options,
-                          transaction_data)
+                          transaction_data, priority='BACKGROUND')
             # Run Message Processing Timer if it has not launched yet.
             bpy.ops.system.openai_process_message()
 
@@ -386,7 +386,7 @@ class OPENAI_OT_GenerateVariationImage(bpy.types.Operator):
         request = {
             "image": (
                 os.path.basename(base_image_filepath),
-                open(base_image_filepath, "rb")     # pylint: disable=R1732
+                base_image_filepath
             ),
             "n": (None, self.num_images),
             "size": (None, self.image_size),
@@ -394,7 +394,7 @@ class OPENAI_OT_GenerateVariationImage(bpy.types.Operator):
         }
         options = {
             "base_image_name": self.base_image_name,
-            "base_image_filepath": base_image_filepath,
+            "temp_filepaths": [base_image_filepath],
             "http_proxy": prefs.http_proxy,
             "https_proxy": prefs.https_proxy,
         }
@@ -408,7 +408,7 @@ class OPENAI_OT_GenerateVariationImage(bpy.types.Operator):
                 "title": self.base_image_name[0:32],
             }
             async_request(api_key, 'GENERATE_VARIATION_IMAGE', request,
-                          options, transaction_data)
+                          options, transaction_data, priority='BACKGROUND')
             # Run Message Processing Timer if it has not launched yet.
             bpy.ops.system.openai_process_message()
 
@@ -1,5 +1,8 @@
 import bpy
+from .utils import metrics
 from .utils import pip
+from .utils import profiler
+from .utils import response_cache
 from .utils.audio_recorder import support_audio_recording
 from .utils.common import (
     draw_data_on_ui_layout,
@@ -7,6 +10,11 @@ from .utils.common import (
     api_connection_enabled,
 )
 from .utils.addon_updater import AddonUpdaterManager
+from .utils.threading import RequestHandler
+from .utils.instrumentation import LatencyRecorder
+from .utils.rate_limiter import RateLimiter
+from .utils.tracing import Tracer, get_trace_filepath
+from .utils.request_journal import RequestJournal
 from .utils.bl_class_registry import BlClassRegistry
 
 
@@ -92,6 +100,131 @@ library to Blender Python environment)"""
         return {'FINISHED'}
 
 
+@BlClassRegistry()
+class OPENAI_OT_ExportMetrics(bpy.types.Operator):
+
+    bl_idname = "system.openai_export_metrics"
+    bl_description = "Export the metrics to the metrics directory now"
+    bl_label = "Export Metrics"
+    bl_options = {'REGISTER'}
+
+    def execute(self, context):
+        user_prefs = context.preferences
+        prefs = user_prefs.addons["openai_bridge"].preferences
+
+        metrics_dir = metrics.get_metrics_dir(prefs)
+        try:
+            metrics.MetricsRegistry.flush(metrics_dir)
+        except OSError as e:
+            self.report({'WARNING'}, f"Failed to export the metrics: {e}")
+            return {'CANCELLED'}
+        self.report({'INFO'}, f"Exported the metrics to '{metrics_dir}'.")
+
+        return {'FINISHED'}
+
+
+@BlClassRegistry()
+class OPENAI_OT_ToggleTrace(bpy.types.Operator):
+
+    bl_idname = "system.openai_toggle_trace"
+    bl_description = """Start recording the trace, or stop recording and save
+it as Chrome Trace Event JSON"""
+    bl_label = "Toggle Trace"
+    bl_options = {'REGISTER'}
+
+    def execute(self, _):
+        if not Tracer.enabled:
+            Tracer.start()
+            self.report({'INFO'}, "Started recording the trace.")
+            return {'FINISHED'}
+
+        filepath = get_trace_filepath()
+        try:
+            num_events = Tracer.stop(filepath)
+        except OSError as e:
+            self.report({'WARNING'}, f"Failed to save the trace: {e}")
+            return {'CANCELLED'}
+        self.report({'INFO'},
+                    f"Saved {num_events} trace events to '{filepath}'.")
+
+        return {'FINISHED'}
+
+
+@BlClassRegistry()
+class OPENAI_OT_PruneResponseCache(bpy.types.Operator):
+
+    bl_idname = "system.openai_prune_response_cache"
+    bl_description = "Remove the expired responses from the response cache"
+    bl_label = "Prune Cache"
+    bl_options = {'REGISTER'}
+
+    def execute(self, context):
+        user_prefs = context.preferences
+        prefs = user_prefs.addons["openai_bridge"].preferences
+
+        num_removed, removed_size = response_cache.prune(
+            response_cache.get_response_cache_dir(prefs),
+            prefs.response_cache_ttl * 60 * 60,
+            prefs.response_cache_max_size * 1024 * 1024)
+        self.report(
+            {'INFO'},
+            f"Removed {num_removed} cached responses ({removed_size} bytes).")
+
+        return {'FINISHED'}
+
+
+def get_request_concurrency_limits(prefs):
+    return {
+        'IMAGE': prefs.max_concurrent_image_requests,
+        'AUDIO': prefs.max_concurrent_audio_requests,
+        'CHAT': prefs.max_concurrent_chat_requests,
+        'CODE': prefs.max_concurrent_code_requests,
+    }
+
+
+def update_request_workers(self, _):
+    RequestHandler.configure(
+        self.num_request_workers, get_request_concurrency_limits(self))
+
+
+def get_rate_limits(prefs):
+    return {
+        "dall-e-2": (prefs.image_requests_per_minute, 0),
+        "whisper-1": (prefs.audio_requests_per_minute, 0),
+        "gpt-3.5-turbo": (prefs.gpt35_turbo_requests_per_minute,
+                          prefs.gpt35_turbo_tokens_per_minute),
+        "gpt-4": (prefs.gpt4_requests_per_minute,
+                  prefs.gpt4_tokens_per_minute),
+        "gpt-4-32k": (prefs.gpt4_32k_requests_per_minute,
+                      prefs.gpt4_32k_tokens_per_minute),
+    }
+
+
+def update_rate_limiter(self, _):
+    RateLimiter.configure(self.rate_limit_enabled, get_rate_limits(self))
+
+
+def update_latency_recorder(self, _):
+    LatencyRecorder.configure(
+        self.latency_instrumentation_enabled, self.latency_max_records)
+
+
+def update_metrics(self, _):
+    metrics.MetricsRegistry.configure(
+        self.metrics_enabled, metrics.get_metrics_dir(self),
+        self.metrics_flush_interval)
+
+
+def update_profiler(self, _):
+    profiler.Profiler.configure(
+        self.profiler_enabled, self.profiler_mode,
+        profiler.get_profile_dir(self), self.profiler_modal_ticks)
+
+
+def update_persistent_queue(self, _):
+    RequestJournal.configure(self.persistent_queue_enabled)
+
+
 @BlClassRegistry()
 class OPENAI_Preferences(bpy.types.AddonPreferences):
     bl_idname = "openai_bridge"
@@ -142,6 +275,213 @@ class OPENAI_Preferences(bpy.types.AddonPreferences):
         description="Execute operations asynchronously",
         default=True,
     )
+    num_request_workers: bpy.props.IntProperty(
+        name="Request Workers",
+        description="Number of requests which are sent in parallel",
+        default=4,
+        min=1,
+        max=16,
+        update=update_request_workers,
+    )
+    max_concurrent_image_requests: bpy.props.IntProperty(
+        name="Image",
+        description="Maximum number of image requests sent in parallel",
+        default=4,
+        min=1,
+        max=16,
+        update=update_request_workers,
+    )
+    max_concurrent_audio_requests: bpy.props.IntProperty(
+        name="Audio",
+        description="Maximum number of audio requests sent in parallel",
+        default=1,
+        min=1,
+        max=16,
+        update=update_request_workers,
+    )
+    max_concurrent_chat_requests: bpy.props.IntProperty(
+        name="Chat",
+        description="Maximum number of chat requests sent in parallel",
+        default=2,
+        min=1,
+        max=16,
+        update=update_request_workers,
+    )
+    max_concurrent_code_requests: bpy.props.IntProperty(
+        name="Code",
+        description="Maximum number of code requests sent in parallel",
+        default=2,
+        min=1,
+        max=16,
+        update=update_request_workers,
+    )
+    response_cache_enabled: bpy.props.BoolProperty(
+        name="Response Cache",
+        description="""Reuse the cached response for the same request from
+Ask and Generate Code Example""",
+        default=True,
+    )
+    response_cache_dir: bpy.props.StringProperty(
+        name="Cache Directory",
+        description="""Directory to store the cached responses.
+Set the shared directory to share the cache among machines.
+The default directory is used if empty""",
+        subtype='DIR_PATH',
+    )
+    response_cache_ttl: bpy.props.IntProperty(
+        name="Expiration (Hours)",
+        description="Hours until the cached response expires",
+        default=24 * 7,
+        min=1,
+        max=24 * 365,
+    )
+    response_cache_max_size: bpy.props.IntProperty(
+        name="Max Size (MB)",
+        description="Maximum total size of the cached responses",
+        default=64,
+        min=1,
+        max=4096,
+    )
+    latency_instrumentation_enabled: bpy.props.BoolProperty(
+        name="Latency Instrumentation",
+        description="Record the time spent in each stage of the requests",
+        default=False,
+        update=update_latency_recorder,
+    )
+    latency_max_records: bpy.props.IntProperty(
+        name="Max Records",
+        description="Number of the latest requests to keep the latency",
+        default=256,
+        min=1,
+        max=65536,
+        update=update_latency_recorder,
+    )
+    metrics_enabled: bpy.props.BoolProperty(
+        name="Metrics Export",
+        description="""Export the metrics periodically as Prometheus text file
+and JSON""",
+        default=False,
+        update=update_metrics,
+    )
+    metrics_dir: bpy.props.StringProperty(
+        name="Metrics Directory",
+        description="""Directory to write the metrics.
+The default directory is used if empty""",
+        subtype='DIR_PATH',
+        update=update_metrics,
+    )
+    metrics_flush_interval: bpy.props.FloatProperty(
+        name="Interval (Seconds)",
+        description="Interval to export the metrics",
+        default=15.0,
+        min=1.0,
+        max=3600.0,
+        update=update_metrics,
+    )
+    profiler_enabled: bpy.props.BoolProperty(
+        name="Profiler",
+        description="""Profile the operators and the request handlers, and save
+the profile per invocation (For developers)""",
+        default=False,
+        update=update_profiler,
+    )
+    profiler_mode: bpy.props.EnumProperty(
+        name="Profiler Mode",
+        description="Profiler to capture the profile",
+        items=[
+            ('CPROFILE', "cProfile", "Save the profile as .prof by cProfile"),
+            ('SAMPLING', "Sampling",
+             "Save the sampled stacks as collapsed stacks (.folded)"),
+        ],
+        default='CPROFILE',
+        update=update_profiler,
+    )
+    profiler_dir: bpy.props.StringProperty(
+        name="Profile Directory",
+        description="""Directory to save the profiles.
+The default directory is used if empty""",
+        subtype='DIR_PATH',
+        update=update_profiler,
+    )
+    profiler_modal_ticks: bpy.props.IntProperty(
+        name="Ticks per Capture",
+        description="""Number of the ticks of the message processing to save
+as a profile""",
+        default=100,
+        min=1,
+        max=100000,
+        update=update_profiler,
+    )
+    persistent_queue_enabled: bpy.props.BoolProperty(
+        name="Persistent Queue",
+        description="""Journal the requests to resume the unfinished requests
+after restarting Blender""",
+        default=False,
+        update=update_persistent_queue,
+    )
+    rate_limit_enabled: bpy.props.BoolProperty(
+        name="Rate Limit",
+        description="""Pace the requests not to exceed the rate limits of
+OpenAI API""",
+        default=True,
+        update=update_rate_limiter,
+    )
+    image_requests_per_minute: bpy.props.IntProperty(
+        name="Image",
+        description="Requests per minute for image (0: Unlimited)",
+        default=50,
+        min=0,
+        update=update_rate_limiter,
+    )
+    audio_requests_per_minute: bpy.props.IntProperty(
+        name="Audio",
+        description="Requests per minute for audio (0: Unlimited)",
+        default=50,
+        min=0,
+        update=update_rate_limiter,
+    )
+    gpt35_turbo_requests_per_minute: bpy.props.IntProperty(
+        name="gpt-3.5-turbo",
+        description="Requests per minute for gpt-3.5-turbo (0: Unlimited)",
+        default=3500,
+        min=0,
+        update=update_rate_limiter,
+    )
+    gpt35_turbo_tokens_per_minute: bpy.props.IntProperty(
+        name="gpt-3.5-turbo",
+        description="Tokens per minute for gpt-3.5-turbo (0: Unlimited)",
+        default=90000,
+        min=0,
+        update=update_rate_limiter,
+    )
+    gpt4_requests_per_minute: bpy.props.IntProperty(
+        name="gpt-4",
+        description="Requests per minute for gpt-4 (0: Unlimited)",
+        default=500,
+        min=0,
+        update=update_rate_limiter,
+    )
+    gpt4_tokens_per_minute: bpy.props.IntProperty(
+        name="gpt-4",
+        description="Tokens per minute for gpt-4 (0: Unlimited)",
+        default=10000,
+        min=0,
+        update=update_rate_limiter,
+    )
+    gpt4_32k_requests_per_minute: bpy.props.IntProperty(
+        name="gpt-4-32k",
+        description="Requests per minute for gpt-4-32k (0: Unlimited)",
+        default=500,
+        min=0,
+        update=update_rate_limiter,
+    )
+    gpt4_32k_tokens_per_minute: bpy.props.IntProperty(
+        name="gpt-4-32k",
+        description="Tokens per minute for gpt-4-32k (0: Unlimited)",
+        default=20000,
+        min=0,
+        update=update_rate_limiter,
+    )
     show_request_status: bpy.props.BoolProperty(
         name="Show Request Status",
         description="Show request status",
@@ -179,6 +519,19 @@ class OPENAI_Preferences(bpy.types.AddonPreferences):
         ],
         default="gpt-3.5-turbo",
     )
+    chat_tool_stream_response: bpy.props.BoolProperty(
+        name="Stream Response",
+        description="Show the response in the chat log while receiving it",
+        default=True,
+    )
+    chat_tool_history_token_budget: bpy.props.IntProperty(
+        name="History Token Budget",
+        description="""Maximum number of tokens of the conversation history
+sent with the prompt. 0 uses the context size of the model""",
+        default=0,
+        min=0,
+        max=32768,
+    )
     chat_tool_log_wrap_width: bpy.props.FloatProperty(
         name="Wrap Width",
         description="Wrap width of the chat tool log",
@@ -198,6 +551,11 @@ class OPENAI_Preferences(bpy.types.AddonPreferences):
         ],
         default="gpt-3.5-turbo",
     )
+    code_tool_stream_response: bpy.props.BoolProperty(
+        name="Stream Response",
+        description="Receive the generated code as a stream",
+        default=False,
+    )
     code_tool_audio_language: bpy.props.EnumProperty(
         name="Code Tool Audio Language",
         description="Language for the audio input in the code tool",
@@ -305,6 +663,84 @@ class OPENAI_Preferences(bpy.types.AddonPreferences):
                 if self.show_request_status:
                     row.prop(self, "request_status_location", expand=True,
                              text="Location")
+                row = col.row()
+                row.alignment = 'LEFT'
+                row.prop(self, "num_request_workers")
+                row = col.row()
+                row.label(text="Concurrent Requests:")
+                row.prop(self, "max_concurrent_image_requests")
+                row.prop(self, "max_concurrent_audio_requests")
+                row.prop(self, "max_concurrent_chat_requests")
+                row.prop(self, "max_concurrent_code_requests")
+            col.separator()
+            row = col.row()
+            row.alignment = 'LEFT'
+            row.prop(self, "response_cache_enabled")
+            if self.response_cache_enabled:
+                row.prop(self, "response_cache_ttl")
+                row.prop(self, "response_cache_max_size")
+                row = col.row(align=True)
+                row.prop(self, "response_cache_dir")
+                row.operator(OPENAI_OT_PruneResponseCache.bl_idname,
+                             icon='TRASH')
+            col.separator()
+            row = col.row()
+            row.alignment = 'LEFT'
+            row.prop(self, "persistent_queue_enabled")
+            col.separator()
+            row = col.row()
+            row.alignment = 'LEFT'
+            row.prop(self, "latency_instrumentation_enabled")
+            if self.latency_instrumentation_enabled:
+                row.prop(self, "latency_max_records")
+            col.separator()
+            row = col.row()
+            row.alignment = 'LEFT'
+            row.label(text="Trace:")
+            if Tracer.enabled:
+                row.operator(OPENAI_OT_ToggleTrace.bl_idname,
+                             text="Stop and Save", icon='PAUSE')
+            else:
+                row.operator(OPENAI_OT_ToggleTrace.bl_idname,
+                             text="Start Recording", icon='REC')
+            col.separator()
+            row = col.row()
+            row.alignment = 'LEFT'
+            row.prop(self, "metrics_enabled")
+            if self.metrics_enabled:
+                row.prop(self, "metrics_flush_interval")
+                row = col.row(align=True)
+                row.prop(self, "metrics_dir")
+                row.operator(OPENAI_OT_ExportMetrics.bl_idname,
+                             icon='EXPORT')
+            col.separator()
+            row = col.row()
+            row.alignment = 'LEFT'
+            row.prop(self, "profiler_enabled")
+            if self.profiler_enabled:
+                row.prop(self, "profiler_mode", text="")
+                row.prop(self, "profiler_modal_ticks")
+                row = col.row()
+                row.prop(self, "profiler_dir")
+            col.separator()
+            row = col.row()
+            row.alignment = 'LEFT'
+            row.prop(self, "rate_limit_enabled")
+            if self.rate_limit_enabled:
+                row = col.row()
+                row.label(text="Requests per Minute:")
+                row.prop(self, "image_requests_per_minute")
+                row.prop(self, "audio_requests_per_minute")
+                row.prop(self, "gpt35_turbo_requests_per_minute")
+                row.prop(self, "gpt4_requests_per_minute")
+                row.prop(self, "gpt4_32k_requests_per_minute")
+                row = col.row()
+                row.label(text="Tokens per Minute:")
+                row.label(text="")
+                row.label(text="")
+                row.prop(self, "gpt35_turbo_tokens_per_minute")
+                row.prop(self, "gpt4_tokens_per_minute")
+                row.prop(self, "gpt4_32k_tokens_per_minute")
 
             layout.separator()
 
@@ -376,6 +812,12 @@ class OPENAI_Preferences(bpy.types.AddonPreferences):
             row = col.row()
             row.alignment = 'LEFT'
             row.prop(self, "chat_tool_model")
+            row = col.row()
+            row.alignment = 'LEFT'
+            row.prop(self, "chat_tool_stream_response")
+            row = col.row()
+            row.alignment = 'LEFT'
+            row.prop(self, "chat_tool_history_token_budget")
             col.separator()
             row = col.row()
             row.alignment = 'LEFT'
@@ -385,6 +827,9 @@ class OPENAI_Preferences(bpy.types.AddonPreferences):
             row = col.row()
             row.alignment = 'LEFT'
             row.prop(self, "code_tool_model")
+            row = col.row()
+            row.alignment = 'LEFT'
+            row.prop(self, "code_tool_stream_response")
 
             layout.separator()
 
@@ -5,8 +5,8 @@ import bpy.utils.previews
 
 from .utils.common import (
     IMAGE_DATA_DIR,
-    CHAT_DATA_DIR,
     ICON_DIR,
+    get_chat_topic_files,
 )
 
 
@@ -255,14 +255,8 @@ class OPENAI_ChatToolProperties(bpy.types.PropertyGroup):
     )
 
     def get_topics(self, _):
-        topic_dir = f"{CHAT_DATA_DIR}/topics"
-        if not os.path.isdir(topic_dir):
-            return []
-
         items = []
-        topic_files = glob.glob(f"{topic_dir}/**/*.json", recursive=True)
-        for file in topic_files:
-            topic_name = os.path.splitext(os.path.basename(file))[0]
+        for topic_name, file in get_chat_topic_files().items():
             items.append((topic_name, topic_name, file))
         return items
 
@@ -7,16 +7,44 @@ from ..op import audio
 from ..op import chat
 from ..op import code
 from ..utils.common import (
-    ChatTextFile,
-    parse_response_data,
+    ChatTopicCache,
     CODE_DATA_DIR,
     draw_data_on_ui_layout,
+    draw_wrapped_text_on_ui_layout,
 )
+from ..utils.instrumentation import (
+    LatencyRecorder,
+    TOTAL_STAGE,
+    get_bucket_label,
+)
+from ..utils.threading import (
+    OPENAI_OT_ShowRequestLatency,
+    OPENAI_OT_ClearRequestLatency,
+)
+from ..utils.tokenizer import count_message_tokens, estimate_cost
+from ..utils.tracing import trace_draw
 from ..utils import error_storage
 from ..utils.common import api_connection_enabled
 from ..utils.bl_class_registry import BlClassRegistry
 
 
+def draw_prompt_estimation(layout, model, prompt, conditions):
+    messages = [{"content": prompt}]
+    for condition in conditions:
+        if condition.condition != "":
+            messages.append({"content": condition.condition})
+    num_tokens = count_message_tokens(messages)
+    cost = estimate_cost(model, num_tokens)
+
+    row = layout.row()
+    row.alignment = 'RIGHT'
+    row.enabled = False
+    if cost is None:
+        row.label(text=f"~{num_tokens} tokens")
+    else:
+        row.label(text=f"~{num_tokens} tokens (${cost:.4f})")
+
+
 @BlClassRegistry()
 class OPENAI_PT_ImageTool(bpy.types.Panel):
 
@@ -32,6 +60,7 @@ class OPENAI_PT_ImageTool(bpy.types.Panel):
 
         layout.label(text="", icon_value=icon_collection.icon_id)
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
 
@@ -58,6 +87,7 @@ class OPENAI_PT_ImageToolGenerateImage(bpy.types.Panel):
 
         layout.label(text="", icon='CONSOLE')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -106,6 +136,7 @@ class OPENAI_PT_ImageToolEditImage(bpy.types.Panel):
 
         layout.label(text="", icon='GREASEPENCIL')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -152,6 +183,7 @@ class OPENAI_PT_ImageToolGenereateVariationImage(bpy.types.Panel):
 
         layout.label(text="", icon='DUPLICATE')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -192,6 +224,7 @@ class OPENAI_PT_ImageToolGeneratedImages(bpy.types.Panel):
 
         layout.label(text="", icon='IMAGE_DATA')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -223,6 +256,7 @@ class OPENAI_PT_AudioToolSequenceEditor(bpy.types.Panel):
 
         layout.label(text="", icon_value=icon_collection.icon_id)
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
 
@@ -249,6 +283,7 @@ class OPENAI_PT_AudioToolTranscribeSoundStrip(bpy.types.Panel):
 
         layout.label(text="", icon='SOUND')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -319,6 +354,7 @@ class OPENAI_PT_AudioToolTextEditor(bpy.types.Panel):
 
         layout.label(text="", icon_value=icon_collection.icon_id)
 
+    @trace_draw
     def draw(self, context):
         pass
 
@@ -337,6 +373,7 @@ class OPENAI_PT_AudioToolTranscribeAudioFile(bpy.types.Panel):
 
         layout.label(text="", icon='SOUND')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -416,6 +453,7 @@ class OPENAI_PT_ChatTool(bpy.types.Panel):
 
         layout.label(text="", icon_value=icon_collection.icon_id)
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
 
@@ -476,6 +514,7 @@ class OPENAI_PT_ChatToolPrompt(bpy.types.Panel):
 
         layout.label(text="", icon='CONSOLE')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -495,6 +534,11 @@ class OPENAI_PT_ChatToolPrompt(bpy.types.Panel):
             item = op.conditions.add()
             item.condition = condition.condition
 
+        user_prefs = context.preferences
+        prefs = user_prefs.addons["openai_bridge"].preferences
+        draw_prompt_estimation(layout, prefs.chat_tool_model, props.prompt,
+                               sc.openai_chat_tool_conditions)
+
         row = layout.row()
         row.alignment = 'LEFT'
         row.label(text="Conditions:")
@@ -522,6 +566,7 @@ class OPENAI_PT_ChatToolLog(bpy.types.Panel):
 
         layout.label(text="", icon='WORDWRAP_ON')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -532,14 +577,10 @@ class OPENAI_PT_ChatToolLog(bpy.types.Panel):
         if props.new_topic or not props.topic:
             return
 
-        chat_file = ChatTextFile()
-        chat_file.load_from_topic(props.topic)
-
-        for part in range(chat_file.num_parts()):
-            user_data = chat_file.get_user_data(part)
-            condition_data = chat_file.get_condition_data(part)
-            response_data = chat_file.get_response_data(part)
+        parts = ChatTopicCache.get_parts(props.topic)
+        wrap_width = prefs.chat_tool_log_wrap_width
 
+        for part, part_data in enumerate(parts):
             # Draw header.
             row = layout.row(align=True)
             row.alignment = 'LEFT'
@@ -558,40 +599,37 @@ class OPENAI_PT_ChatToolLog(bpy.types.Panel):
             op.target_type = 'TEXT'
 
             # Draw user data.
-            lines = user_data.split("\n")
             row = layout.row()
             row.label(text="", icon='USER')
             col = row.column()
-            draw_data_on_ui_layout(context, col, lines,
-                                   prefs.chat_tool_log_wrap_width)
+            draw_wrapped_text_on_ui_layout(context, col, part_data["user"],
+                                           wrap_width)
 
             # Draw condition data.
-            if len(condition_data) != 0:
+            if len(part_data["condition"].lines) != 0:
                 row = layout.row()
                 row.label(text="", icon='MODIFIER')
                 col = row.column()
-                draw_data_on_ui_layout(context, col, condition_data,
-                                       prefs.chat_tool_log_wrap_width)
+                draw_wrapped_text_on_ui_layout(
+                    context, col, part_data["condition"], wrap_width)
 
             layout.separator()
 
             # Draw response data.
-            sections = parse_response_data(response_data)
             row = layout.row()
             row.label(text="", icon='LIGHT')
             col = row.column()
             code_index = 0
-            for section in sections:
-                lines = section["body"].split("\n")
+            for section in part_data["response"]:
                 if section["kind"] == 'TEXT':
                     c = col.column()
-                    draw_data_on_ui_layout(context, c, lines,
-                                           prefs.chat_tool_log_wrap_width)
+                    draw_wrapped_text_on_ui_layout(context, c, section["text"],
+                                                   wrap_width)
                 elif section["kind"] == 'CODE':
                     r = col.row(align=True)
                     c = r.box().column(align=True)
-                    draw_data_on_ui_layout(context, c, lines,
-                                           prefs.chat_tool_log_wrap_width)
+                    draw_wrapped_text_on_ui_layout(context, c, section["text"],
+                                                   wrap_width)
                     c = r.column(align=True)
                     op = c.operator(chat.OPENAI_OT_RunChatCode.bl_idname,
                                     icon='PLAY', text="")
@@ -648,6 +686,7 @@ class OPENAI_PT_CodeTool(bpy.types.Panel):
 
         layout.label(text="", icon_value=icon_collection.icon_id)
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
 
@@ -674,6 +713,7 @@ class OPENAI_PT_CodeToolPrompt(bpy.types.Panel):
 
         layout.label(text="", icon='CONSOLE')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -698,6 +738,11 @@ class OPENAI_PT_CodeToolPrompt(bpy.types.Panel):
             item = op.conditions.add()
             item.condition = condition.condition
 
+        user_prefs = context.preferences
+        prefs = user_prefs.addons["openai_bridge"].preferences
+        draw_prompt_estimation(layout, prefs.code_tool_model, props.prompt,
+                               sc.openai_code_tool_conditions)
+
         row = layout.row()
         row.alignment = 'LEFT'
         row.label(text="Conditions:")
@@ -727,6 +772,7 @@ class OPENAI_PT_CodeToolGeneratedCode(bpy.types.Panel):
 
         layout.label(text="", icon='WORDWRAP_ON')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         user_prefs = context.preferences
@@ -778,6 +824,7 @@ class OPENAI_PT_CodeToolTextEditor(bpy.types.Panel):
 
         layout.label(text="", icon_value=icon_collection.icon_id)
 
+    @trace_draw
     def draw(self, context):
         pass
 
@@ -796,6 +843,7 @@ class OPENAI_PT_CodeToolGenerateCode(bpy.types.Panel):
 
         layout.label(text="", icon='CONSOLE')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -816,6 +864,11 @@ class OPENAI_PT_CodeToolGenerateCode(bpy.types.Panel):
             item = op.conditions.add()
             item.condition = condition.condition
 
+        user_prefs = context.preferences
+        prefs = user_prefs.addons["openai_bridge"].preferences
+        draw_prompt_estimation(
+            layout, prefs.code_tool_model, props.prompt, conditions)
+
         row = layout.row()
         row.alignment = 'LEFT'
         row.label(text="Conditions:")
@@ -845,6 +898,7 @@ class OPENAI_PT_CodeToolEditCode(bpy.types.Panel):
 
         layout.label(text="", icon='GREASEPENCIL')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         sc = context.scene
@@ -867,6 +921,11 @@ class OPENAI_PT_CodeToolEditCode(bpy.types.Panel):
             item = op.conditions.add()
             item.condition = condition.condition
 
+        user_prefs = context.preferences
+        prefs = user_prefs.addons["openai_bridge"].preferences
+        draw_prompt_estimation(
+            layout, prefs.code_tool_model, props.prompt, conditions)
+
         row = layout.row()
         row.alignment = 'LEFT'
         row.label(text="Conditions:")
@@ -897,6 +956,7 @@ class OPENAI_PT_CodeToolGeneratedCodeTextEditor(bpy.types.Panel):
 
         layout.label(text="", icon='WORDWRAP_ON')
 
+    @trace_draw
     def draw(self, context):
         layout = self.layout
         user_prefs = context.preferences
@@ -931,3 +991,62 @@ class OPENAI_PT_CodeToolGeneratedCodeTextEditor(bpy.types.Panel):
                 op = c.operator(code.OPENAI_OT_CopyCodeError.bl_idname,
                                 icon='DUPLICATE', text="")
                 op.code = code_name
+
+
+@BlClassRegistry()
+class OPENAI_PT_RequestLatency(bpy.types.Panel):
+
+    bl_region_type = 'UI'
+    bl_space_type = 'VIEW_3D'
+    bl_category = "OpenAI"
+    bl_label = "Request Latency"
+    bl_options = {'DEFAULT_CLOSED'}
+
+    @classmethod
+    def poll(cls, context):
+        user_prefs = context.preferences
+        prefs = user_prefs.addons["openai_bridge"].preferences
+        return prefs.latency_instrumentation_enabled
+
+    def draw_header(self, _):
+        layout = self.layout
+
+        layout.label(text="", icon='TIME')
+
+    @trace_draw
+    def draw(self, _):
+        layout = self.layout
+
+        row = layout.row(align=True)
+        row.operator(OPENAI_OT_ShowRequestLatency.bl_idname, icon='TEXT')
+        row.operator(OPENAI_OT_ClearRequestLatency.bl_idname, text="",
+                     icon='TRASH')
+
+        statistics = LatencyRecorder.get_statistics()
+        if not statistics:
+            layout.label(text="No request is recorded.")
+            return
+
+        for req_type, stages in statistics.items():
+            box = layout.box()
+            box.label(text=f"{req_type} ({stages[TOTAL_STAGE]['count']})")
+            col = box.column(align=True)
+            sp = col.split(factor=0.5, align=True)
+            sp.label(text="Stage")
+            sp.label(text="Mean / P95")
+            for stage, stat in stages.items():
+                sp = col.split(factor=0.5, align=True)
+                sp.label(text=stage)
+                sp.label(text=f"{stat['mean']:.2f}s / {stat['p95']:.2f}s")
+
+            # Histogram of the total latency.
+            col = box.column(align=True)
+            histogram = stages[TOTAL_STAGE]["histogram"]
+            max_count = max(histogram)
+            for i, count in enumerate(histogram):
+                if count == 0:
+                    continue
+                sp = col.split(factor=0.3, align=True)
+                sp.label(text=get_bucket_label(i))
+                bar_text = "|" * max(1, count * 30 // max_count)
+                sp.label(text=f"{bar_text} {count}")
@@ -6,16 +6,36 @@ if "bpy" in locals():
     importlib.reload(bl_class_registry)
     importlib.reload(common)
     importlib.reload(error_storage)
+    importlib.reload(instrumentation)
+    importlib.reload(metrics)
+    importlib.reload(overlay)
     importlib.reload(pip)
+    importlib.reload(profiler)
+    importlib.reload(rate_limiter)
+    importlib.reload(request_journal)
+    importlib.reload(response_cache)
+    importlib.reload(session)
     importlib.reload(threading)
+    importlib.reload(tokenizer)
+    importlib.reload(tracing)
 else:
     from . import addon_updater
     from . import audio_recorder
     from . import bl_class_registry
     from . import common
     from . import error_storage
+    from . import instrumentation
+    from . import metrics
+    from . import overlay
     from . import pip
+    from . import profiler
+    from . import rate_limiter
+    from . import request_journal
+    from . import response_cache
+    from . import session
     from . import threading
+    from . import tokenizer
+    from . import tracing
 
 # pylint: disable=C0413
 import bpy
@@ -1,8 +1,18 @@
 import os
 import json
 import textwrap
+import uuid
+from collections import OrderedDict
 import requests
 
+from .session import get_session
+from .tokenizer import TOKENS_PER_MESSAGE, count_tokens
+
+# The API server can be replaced by the environment variable (ex: the mock
+# server for the benchmark).
+API_BASE_URL = os.environ.get(
+    "OPENAI_BRIDGE_API_BASE_URL", "https://api.openai.com/v1")
+
 DATA_DIR = f"{os.path.dirname(__file__)}/../_data"
 IMAGE_DATA_DIR = f"{DATA_DIR}/image"
 AUDIO_DATA_DIR = f"{DATA_DIR}/audio"
@@ -11,6 +21,18 @@ CODE_DATA_DIR = f"{DATA_DIR}/code"
 ICON_DIR = f"{os.path.dirname(__file__)}/../icon"
 CONNECTION_STATUS_OK = "OK"
 
+# Connect and read timeouts (seconds) to check the API connection.
+CHECK_API_CONNECTION_TIMEOUT = (10.0, 30.0)
+
+# Number of tokens in the context window of each chat model.
+MODEL_CONTEXT_SIZES = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+# Number of tokens reserved for the response.
+RESPONSE_RESERVED_TOKENS = 1024
+
 
 def get_area_region_space(context, area_type, region_type, space_type):
     area = None
@@ -39,59 +61,312 @@ def get_area_region_space(context, area_type, region_type, space_type):
     return area, region, space
 
 
-class ChatTextFile:
+def get_chat_topic_filepath(topic):
+    # Topics saved before the append-only format are stored as JSON.
+    filepath = f"{CHAT_DATA_DIR}/topics/{topic}.jsonl"
+    legacy_filepath = f"{CHAT_DATA_DIR}/topics/{topic}.json"
+    if not os.path.isfile(filepath) and os.path.isfile(legacy_filepath):
+        return legacy_filepath
+    return filepath
+
+
+def get_chat_topic_files():
+    topic_dir = f"{CHAT_DATA_DIR}/topics"
+    if not os.path.isdir(topic_dir):
+        return {}
+
+    topic_files = {}
+    for file in sorted(os.listdir(topic_dir)):
+        topic_name, ext = os.path.splitext(file)
+        if ext not in (".jsonl", ".json"):
+            continue
+        if topic_name in topic_files and ext == ".json":
+            continue
+        topic_files[topic_name] = f"{topic_dir}/{file}"
+    return topic_files
+
+
+class ChatTextFile:    # pylint: disable=R0904
+    """Chat topic stored in the append-only JSON Lines format.
+
+    Each line is a record which adds or modifies a part, so that saving a
+    chat turn only appends its own bytes to the file. The file is
+    compacted to one record per part by writing a temporary file and
+    replacing the original one atomically.
+
+    The records refer to the part by its ID, because the other writer may
+    add a part to the same topic. The records written by the other writers
+    are applied before saving, so the writers of the same topic must be
+    serialized by the caller.
+    """
+
+    # Compact the file when the number of records exceeds the number of
+    # parts by this value.
+    COMPACTION_THRESHOLD = 64
+
     def __init__(self):
         self.filepath = None
         self.json_raw = {}
+        self.pending_records = []
+        self.num_records = 0
+        self.needs_compaction = False
+        # Bytes of the records read from the file, and the identity and the
+        # last record of the file to detect that the file is replaced by
+        # the compaction. The inode number may be reused by the new file.
+        self.offset = 0
+        self.file_id = None
+        self.last_record = b""
+        # Part ID -> index of the part.
+        self.part_indices = {}
 
     @classmethod
     def remove(cls, topic):
-        os.remove(f"{CHAT_DATA_DIR}/topics/{topic}.json")
+        for ext in (".jsonl", ".json"):
+            filepath = f"{CHAT_DATA_DIR}/topics/{topic}{ext}"
+            if os.path.isfile(filepath):
+                os.remove(filepath)
 
     def new(self, topic):
-        self.filepath = f"{CHAT_DATA_DIR}/topics/{topic}.json"
+        self.filepath = f"{CHAT_DATA_DIR}/topics/{topic}.jsonl"
         self.json_raw = {
             "topic": {
                 "parts": []
             }
         }
+        self.pending_records = []
+        self.num_records = 0
+        self.needs_compaction = True
+        self.offset = 0
+        self.file_id = None
+        self.last_record = b""
+        self.part_indices = {}
+
+    def sync(self):
+        # Apply the records written by the other writers after the last
+        # load, so that saving does not drop them.
+        if self.file_id is None or self.load_appended() is not None:
+            return
+        # The file is replaced or removed by the other writer.
+        pending_records = self.pending_records
+        parts = {part["id"]: part
+                 for part in self.json_raw["topic"]["parts"]}
+        self.load(self.filepath)
+        restored_parts = set()
+        for record in pending_records:
+            part_id = record.get("id")
+            if part_id in restored_parts:
+                continue
+            if record["op"] != "add_part" and \
+                    part_id not in self.part_indices:
+                # The part is removed with the replaced file. Add the part
+                # with the current contents again not to lose the response.
+                self.add_record({"op": "add_part", **parts[part_id]})
+                restored_parts.add(part_id)
+                continue
+            self.add_record(record)
 
     def save(self):
-        with open(self.filepath, "w", encoding="utf-8") as f:
-            json.dump(self.json_raw, f, ensure_ascii=False, indent=4,
-                      sort_keys=True, separators=(",", ": "))
+        self.sync()
+        if self.needs_compaction or \
+                self.num_records > self.num_parts() + \
+                self.COMPACTION_THRESHOLD:
+            self.compact()
+            return
+        if len(self.pending_records) == 0:
+            return
+
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n"
+                       for record in self.pending_records)
+        with open(self.filepath, "a", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.num_records += len(self.pending_records)
+        self.pending_records = []
+        self.offset += len(data.encode("utf-8"))
+        self.last_record = data[data.rfind("\n", 0, -1) + 1:].encode("utf-8")
+
+    def compact(self):
+        records = [{"op": "add_part", **part}
+                   for part in self.json_raw["topic"]["parts"]]
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n"
+                       for record in records)
+        tmp_filepath = f"{self.filepath}.tmp"
+        with open(tmp_filepath, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            file_id = self.get_file_id(f.fileno())
+        os.replace(tmp_filepath, self.filepath)
+        self.offset = len(data.encode("utf-8"))
+        self.file_id = file_id
+        self.last_record = data[data.rfind("\n", 0, -1) + 1:].encode("utf-8")
+
+        # Remove the topic file saved in the legacy format.
+        legacy_filepath = f"{os.path.splitext(self.filepath)[0]}.json"
+        if os.path.isfile(legacy_filepath):
+            os.remove(legacy_filepath)
+
+        self.num_records = len(records)
+        self.pending_records = []
+        self.needs_compaction = False
 
     def load_from_topic(self, topic):
-        filepath = f"{CHAT_DATA_DIR}/topics/{topic}.json"
-        self.load(filepath)
+        self.load(get_chat_topic_filepath(topic))
 
     def load(self, filepath):
+        self.json_raw = {
+            "topic": {
+                "parts": []
+            }
+        }
+        self.pending_records = []
+        self.num_records = 0
+        self.needs_compaction = False
+        self.offset = 0
+        self.file_id = None
+        self.last_record = b""
+        self.part_indices = {}
+
+        if filepath.endswith(".json"):
+            # Migrate the legacy format at the next save.
+            self.filepath = f"{os.path.splitext(filepath)[0]}.jsonl"
+            self.needs_compaction = True
+            if os.path.isfile(filepath):
+                with open(filepath, "r", encoding="utf-8") as f:
+                    json_raw = json.load(f)
+                for part in json_raw["topic"]["parts"]:
+                    self.apply_record({"op": "add_part", **part})
+            return
+
         self.filepath = filepath
         if not os.path.isfile(self.filepath):
-            self.json_raw = {
-                "topic": {
-                    "parts": []
-                }
-            }
+            self.needs_compaction = True
             return
-        with open(self.filepath, "r", encoding="utf-8") as f:
-            self.json_raw = json.load(f)
+        with open(self.filepath, "rb") as f:
+            self.file_id = self.get_file_id(f.fileno())
+            _, completed = self.read_records(f)
+        if not completed:
+            # The last record may be broken by a crash while writing.
+            # Rewrite the file at the next save.
+            self.needs_compaction = True
+
+    def load_appended(self):
+        """Apply the records appended to the file after the last load.
+
+        Returns the indices of the changed parts, or None if the file must
+        be loaded again because it is replaced or not in JSON Lines format.
+        """
+
+        if self.file_id is None:
+            return None
+        try:
+            with open(self.filepath, "rb") as f:
+                if self.get_file_id(f.fileno()) != self.file_id or \
+                        os.fstat(f.fileno()).st_size < self.offset:
+                    return None
+                f.seek(self.offset - len(self.last_record))
+                if f.read(len(self.last_record)) != self.last_record:
+                    return None
+                changed_parts, _ = self.read_records(f)
+        except OSError:
+            return None
+        return changed_parts
+
+    @classmethod
+    def get_file_id(cls, fd):
+        stat = os.fstat(fd)
+        return (stat.st_dev, stat.st_ino)
+
+    def read_records(self, f):
+        # Returns the indices of the changed parts, and False if the read
+        # stopped at an incomplete or broken record. The incomplete record
+        # may be being written, so it is read again at the next load.
+        changed_parts = set()
+        for line in f:
+            if not line.endswith(b"\n"):
+                return changed_parts, False
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                return changed_parts, False
+            changed_parts.add(self.apply_record(record))
+            self.num_records += 1
+            self.offset += len(line)
+            self.last_record = line
+        return changed_parts, True
+
+    def apply_record(self, record):
+        # Returns the index of the changed part.
+        parts = self.json_raw["topic"]["parts"]
+        op = record["op"]
+        if op == "add_part":
+            part_id = record.get("id")
+            if part_id is None:
+                # The part saved before the part ID is introduced. Save the
+                # ID before the records refer to it.
+                part_id = uuid.uuid4().hex
+                self.needs_compaction = True
+            parts.append({
+                "id": part_id,
+                "user": record["user"],
+                "system": record["system"],
+                "assistant": record["assistant"],
+            })
+            self.part_indices[part_id] = len(parts) - 1
+            return len(parts) - 1
+
+        if "id" in record:
+            part = self.part_indices[record["id"]]
+        else:
+            part = record["part"]
+        if op == "modify_part":
+            for key in ("user", "system", "assistant"):
+                if key in record:
+                    parts[part][key] = record[key]
+        elif op == "append_response":
+            parts[part]["assistant"] += record["assistant"]
+        return part
+
+    def add_record(self, record):
+        self.apply_record(record)
+        self.pending_records.append(record)
 
     def add_part(self, user_data, condition_data, response_data):
-        self.json_raw["topic"]["parts"].append({
+        # Returns the ID of the added part.
+        part_id = uuid.uuid4().hex
+        self.add_record({
+            "op": "add_part",
+            "id": part_id,
             "user": user_data,
             "system": condition_data,
             "assistant": response_data,
         })
+        return part_id
 
     def modify_part(self, part, *, user_data=None, condition_data=None,
                     response_data=None):
+        if part < 0:
+            part += self.num_parts()
+        part_id = self.get_part_id(part)
+        record = {"op": "modify_part", "id": part_id}
         if user_data is not None:
-            self.json_raw["topic"]["parts"][part]["user"] = user_data
+            record["user"] = user_data
         if condition_data is not None:
-            self.json_raw["topic"]["parts"][part]["system"] = condition_data
+            record["system"] = condition_data
         if response_data is not None:
-            self.json_raw["topic"]["parts"][part]["assistant"] = response_data
+            current_response_data = self.get_response_data(part)
+            if user_data is None and condition_data is None and \
+                    response_data.startswith(current_response_data):
+                # Only append the rest of the response (ex. streaming).
+                record = {
+                    "op": "append_response",
+                    "id": part_id,
+                    "assistant": response_data[len(current_response_data):],
+                }
+            else:
+                record["assistant"] = response_data
+        self.add_record(record)
 
     def num_parts(self):
         return len(self.json_raw["topic"]["parts"])
@@ -99,6 +374,12 @@ class ChatTextFile:
     def get_part(self, part):
         return self.json_raw["topic"]["parts"][part]
 
+    def get_part_id(self, part):
+        return self.json_raw["topic"]["parts"][part]["id"]
+
+    def get_part_index(self, part_id):
+        return self.part_indices.get(part_id)
+
     def get_user_data(self, part):
         return self.json_raw["topic"]["parts"][part]["user"]
 
@@ -109,6 +390,45 @@ class ChatTextFile:
         return self.json_raw["topic"]["parts"][part]["assistant"]
 
 
+def get_max_prompt_tokens(model):
+    context_size = MODEL_CONTEXT_SIZES.get(model, 4096)
+    return context_size - RESPONSE_RESERVED_TOKENS
+
+
+def build_chat_history(chat_file, num_parts, token_budget):
+    # Walk the parts from the newest one and stop at the part which does
+    # not fit in the token budget, so that the oldest parts are dropped.
+    history_chunks = []
+    for part in reversed(range(num_parts)):
+        messages = [{
+            "role": "user",
+            "content": chat_file.get_user_data(part),
+        }]
+        for condition in chat_file.get_condition_data(part):
+            messages.append({
+                "role": "system",
+                "content": condition,
+            })
+        messages.append({
+            "role": "assistant",
+            "content": chat_file.get_response_data(part),
+        })
+
+        num_tokens = 0
+        for message in messages:
+            num_tokens += count_tokens(message["content"]) + \
+                TOKENS_PER_MESSAGE
+        if num_tokens > token_budget:
+            break
+        token_budget -= num_tokens
+        history_chunks.append(messages)
+
+    history = []
+    for messages in reversed(history_chunks):
+        history.extend(messages)
+    return history
+
+
 def parse_response_data(response_data):
     sections = []
 
@@ -155,6 +475,124 @@ def get_code_from_response_data(response_data, code_index):
     return codes[code_index]
 
 
+class WrappedText:
+    """Lines of text which memoizes the wrapped lines per wrap length."""
+
+    # Number of wrap lengths to be memoized.
+    MAX_WRAPPED_CACHE = 4
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.wrapped = OrderedDict()
+
+    def wrap(self, wrapped_length):
+        if wrapped_length in self.wrapped:
+            self.wrapped.move_to_end(wrapped_length)
+            return self.wrapped[wrapped_length]
+
+        wrapper = textwrap.TextWrapper(width=wrapped_length)
+        wrapped_lines = []
+        for line in self.lines:
+            lines = wrapper.wrap(text=line)
+            if len(lines) == 0:
+                lines = [""]
+            wrapped_lines.extend(lines)
+
+        self.wrapped[wrapped_length] = wrapped_lines
+        if len(self.wrapped) > self.MAX_WRAPPED_CACHE:
+            self.wrapped.popitem(last=False)
+
+        return wrapped_lines
+
+
+class ChatTopicCache:
+    """In-memory cache of the parsed chat topics for drawing the chat log.
+
+    The cached topic is updated only when the modification time or the
+    size of the topic file is changed. Only the records appended after the
+    last read are parsed (ex: while the response is streamed), and the
+    whole file is parsed again if it is replaced by the compaction.
+    """
+
+    # Number of topics to be cached.
+    MAX_TOPICS = 8
+
+    topics = OrderedDict()
+
+    @classmethod
+    def get_file_stamp(cls, filepath):
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @classmethod
+    def parse_part(cls, chat_file, part):
+        sections = []
+        for section in parse_response_data(chat_file.get_response_data(part)):
+            sections.append({
+                "kind": section["kind"],
+                "text": WrappedText(section["body"].split("\n")),
+            })
+        return {
+            "user": WrappedText(chat_file.get_user_data(part).split("\n")),
+            "condition": WrappedText(chat_file.get_condition_data(part)),
+            "response": sections,
+        }
+
+    @classmethod
+    def get_parts(cls, topic):
+        filepath = get_chat_topic_filepath(topic)
+        stamp = cls.get_file_stamp(filepath)
+
+        entry = cls.topics.get(topic)
+        if entry is not None and entry["stamp"] == stamp:
+            cls.topics.move_to_end(topic)
+            return entry["parts"]
+
+        if entry is not None and entry["chat_file"].filepath == filepath:
+            chat_file = entry["chat_file"]
+            changed_parts = chat_file.load_appended()
+            if changed_parts is not None:
+                parts = entry["parts"]
+                for part in sorted(changed_parts):
+                    parsed_part = cls.parse_part(chat_file, part)
+                    if part < len(parts):
+                        parts[part] = parsed_part
+                    else:
+                        parts.append(parsed_part)
+                entry["stamp"] = stamp
+                cls.topics.move_to_end(topic)
+                return parts
+
+        chat_file = ChatTextFile()
+        chat_file.load(filepath)
+        parts = [cls.parse_part(chat_file, part)
+                 for part in range(chat_file.num_parts())]
+
+        cls.topics[topic] = {
+            "stamp": stamp,
+            "chat_file": chat_file,
+            "parts": parts,
+        }
+        cls.topics.move_to_end(topic)
+        if len(cls.topics) > cls.MAX_TOPICS:
+            cls.topics.popitem(last=False)
+
+        return parts
+
+
+def draw_wrapped_text_on_ui_layout(context, layout, wrapped_text, wrap_width,
+                                   alert=False):
+    wrapped_length = int(context.region.width * wrap_width)
+    col = layout.column(align=True)
+    col.alert = alert
+    col.scale_y = 0.8
+    for line in wrapped_text.wrap(wrapped_length):
+        col.label(text=line)
+
+
 def draw_data_on_ui_layout(context, layout, lines, wrap_width, alert=False):
     wrapped_length = int(context.region.width * wrap_width)
     wrapper = textwrap.TextWrapper(width=wrapped_length)
@@ -179,8 +617,10 @@ def check_api_connection(api_key, http_proxy, https_proxy):
         "https": https_proxy,
     }
     try:
-        response = requests.get("https://api.openai.com/v1/models",
-                                headers=headers, proxies=proxies)
+        session = get_session(proxies)
+        response = session.get(f"{API_BASE_URL}/models",
+                               headers=headers, proxies=proxies,
+                               timeout=CHECK_API_CONNECTION_TIMEOUT)
     except Exception as e:  # pylint: disable=W0703
         return f"Error - {e}"
 
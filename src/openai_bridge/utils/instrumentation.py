@@ -0,0 +1,218 @@
+import contextlib
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+DEFAULT_MAX_RECORDS = 256
+# Transactions not finished are dropped from the oldest over this number.
+MAX_ACTIVE_RECORDS = 1024
+# Upper bounds (seconds) of the histogram buckets. The last bucket has no
+# upper bound.
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                     60.0)
+TOTAL_STAGE = "total"
+
+
+class TransactionRecord:
+    def __init__(self, transaction_id, req_type, created_at):
+        self.transaction_id = transaction_id
+        self.req_type = req_type
+        self.created_at = created_at
+        self.queued_at = created_at
+        self.finished_at = None
+        # List of (stage, start, end, thread name).
+        self.stages = []
+
+    def total(self):
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.created_at
+
+    def stage_durations(self):
+        durations = OrderedDict()
+        for stage, start, end, _ in self.stages:
+            durations[stage] = durations.get(stage, 0.0) + (end - start)
+        return durations
+
+
+def get_bucket_index(seconds):
+    for i, upper in enumerate(HISTOGRAM_BUCKETS):
+        if seconds <= upper:
+            return i
+    return len(HISTOGRAM_BUCKETS)
+
+
+def get_bucket_label(index):
+    if index == len(HISTOGRAM_BUCKETS):
+        return f">{HISTOGRAM_BUCKETS[-1]:g}s"
+    return f"<={HISTOGRAM_BUCKETS[index]:g}s"
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of the sorted values.
+    if not values:
+        return 0.0
+    return values[max(1, math.ceil(p / 100.0 * len(values))) - 1]
+
+
+class LatencyRecorder:
+    """Records the time spent in each stage of the transactions.
+
+    The stages are recorded from the worker threads and the main thread.
+    The finished transactions are kept in a ring of the bounded size. The
+    statistics are computed again only after the finished transactions are
+    changed, because they are drawn on every redraw of the panel.
+    """
+
+    enabled = False
+    lock = threading.Lock()
+    active_records = OrderedDict()
+    finished_records = deque(maxlen=DEFAULT_MAX_RECORDS)
+    # Incremented when the finished transactions are changed.
+    version = 0
+    # (version, statistics)
+    statistics_cache = (-1, None)
+
+    @classmethod
+    def configure(cls, enabled, max_records=DEFAULT_MAX_RECORDS):
+        with cls.lock:
+            cls.enabled = enabled
+            if max_records != cls.finished_records.maxlen:
+                cls.finished_records = deque(
+                    cls.finished_records, maxlen=max_records)
+                cls.version += 1
+            if not enabled:
+                cls.active_records.clear()
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.finished_records.clear()
+            cls.version += 1
+
+    @classmethod
+    def begin(cls, transaction_id, req_type):
+        if not cls.enabled:
+            return
+        with cls.lock:
+            cls.active_records[transaction_id] = TransactionRecord(
+                transaction_id, req_type, time.monotonic())
+            while len(cls.active_records) > MAX_ACTIVE_RECORDS:
+                cls.active_records.popitem(last=False)
+
+    @classmethod
+    def record(cls, transaction_id, stage, start, end):
+        if not cls.enabled or transaction_id is None:
+            return
+        with cls.lock:
+            record = cls.active_records.get(transaction_id)
+            if record is not None:
+                record.stages.append(
+                    (stage, start, end, threading.current_thread().name))
+
+    @classmethod
+    @contextlib.contextmanager
+    def stage(cls, transaction_id, stage):
+        if not cls.enabled or transaction_id is None:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            cls.record(transaction_id, stage, start, time.monotonic())
+
+    @classmethod
+    def requeue(cls, transaction_id):
+        # The request is queued again for the retry.
+        with cls.lock:
+            record = cls.active_records.get(transaction_id)
+            if record is not None:
+                record.queued_at = time.monotonic()
+
+    @classmethod
+    def dequeue(cls, transaction_id):
+        # The request is taken by the worker.
+        with cls.lock:
+            record = cls.active_records.get(transaction_id)
+            if record is not None:
+                record.stages.append(
+                    ("queue", record.queued_at, time.monotonic(),
+                     threading.current_thread().name))
+
+    @classmethod
+    def finish(cls, transaction_id):
+        with cls.lock:
+            record = cls.active_records.pop(transaction_id, None)
+            if record is None:
+                return
+            record.finished_at = time.monotonic()
+            cls.finished_records.append(record)
+            cls.version += 1
+
+    @classmethod
+    def get_records(cls):
+        with cls.lock:
+            return list(cls.finished_records)
+
+    @classmethod
+    def get_statistics(cls):
+        """Returns the statistics of the stages per request type.
+
+        {request type: {stage: {"count", "mean", "p50", "p95", "max",
+                                "histogram"}}}
+        """
+
+        with cls.lock:
+            if cls.statistics_cache[0] == cls.version:
+                return cls.statistics_cache[1]
+            version = cls.version
+            records = list(cls.finished_records)
+
+        durations = OrderedDict()
+        for record in records:
+            stages = durations.setdefault(record.req_type, OrderedDict())
+            stages.setdefault(TOTAL_STAGE, []).append(record.total())
+            for stage, duration in record.stage_durations().items():
+                stages.setdefault(stage, []).append(duration)
+
+        statistics = OrderedDict()
+        for req_type, stages in durations.items():
+            statistics[req_type] = OrderedDict()
+            for stage, values in stages.items():
+                values.sort()
+                histogram = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+                for value in values:
+                    histogram[get_bucket_index(value)] += 1
+                statistics[req_type][stage] = {
+                    "count": len(values),
+                    "mean": sum(values) / len(values),
+                    "p50": percentile(values, 50),
+                    "p95": percentile(values, 95),
+                    "max": values[-1],
+                    "histogram": histogram,
+                }
+        with cls.lock:
+            cls.statistics_cache = (version, statistics)
+        return statistics
+
+
+def format_statistics(statistics):
+    lines = []
+    for req_type, stages in statistics.items():
+        lines.append(f"[{req_type}] {stages[TOTAL_STAGE]['count']} requests")
+        for stage, stat in stages.items():
+            lines.append(
+                f"  {stage:<28} mean {stat['mean']:8.3f}s  "
+                f"p50 {stat['p50']:8.3f}s  p95 {stat['p95']:8.3f}s  "
+                f"max {stat['max']:8.3f}s")
+        lines.append("  Histogram of total:")
+        histogram = stages[TOTAL_STAGE]["histogram"]
+        max_count = max(histogram)
+        for i, count in enumerate(histogram):
+            bar_text = "#" * math.ceil(count * 40 / max_count)
+            lines.append(
+                f"  {get_bucket_label(i):>8} {count:6d} {bar_text}".rstrip())
+        lines.append("")
+    return lines
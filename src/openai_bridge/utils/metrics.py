@@ -0,0 +1,286 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from ..utils.common import DATA_DIR
+
+METRICS_DIR = f"{DATA_DIR}/metrics"
+METRICS_FILENAME = "openai_bridge"
+DEFAULT_FLUSH_INTERVAL = 15.0
+
+# Upper bounds (seconds) of the latency histograms.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   120.0)
+
+METRIC_DEFINITIONS = {
+    "openai_bridge_requests_total": (
+        'COUNTER', "Number of API requests sent"),
+    "openai_bridge_request_errors_total": (
+        'COUNTER', "Number of failed API requests by status code"),
+    "openai_bridge_request_duration_seconds": (
+        'HISTOGRAM', "Time until the response headers of API requests"),
+    "openai_bridge_retries_total": (
+        'COUNTER', "Number of retried requests"),
+    "openai_bridge_sent_bytes_total": (
+        'COUNTER', "Bytes of the request bodies"),
+    "openai_bridge_received_bytes_total": (
+        'COUNTER', "Bytes of the response bodies"),
+    "openai_bridge_response_cache_requests_total": (
+        'COUNTER', "Lookups of the response cache by result"),
+    "openai_bridge_response_cache_hit_ratio": (
+        'GAUGE', "Ratio of the response cache hits"),
+    "openai_bridge_request_queue_depth": (
+        'GAUGE', "Number of queued requests per category"),
+    "openai_bridge_delayed_requests": (
+        'GAUGE', "Number of requests waiting for the retry"),
+    "openai_bridge_running_requests": (
+        'GAUGE', "Number of requests being sent per category"),
+    "openai_bridge_message_queue_depth": (
+        'GAUGE', "Number of messages waiting for the main thread"),
+    "openai_bridge_inflight_transactions": (
+        'GAUGE', "Number of transactions not finished"),
+}
+
+
+def format_labels(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ""
+    text = ",".join(
+        '{}="{}"'.format(
+            name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in items)
+    return "{" + text + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def write_file_atomically(filepath, text):
+    # The scrapers must not read a partially written file.
+    dirname = os.path.dirname(filepath)
+    fd, tmp_filepath = tempfile.mkstemp(
+        prefix=f".{os.path.basename(filepath)}.", suffix=".tmp", dir=dirname)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.remove(tmp_filepath)
+        raise
+
+
+class MetricsRegistry:
+    """Registry of the counters, histograms and gauges of the add-on.
+
+    The counters and histograms are updated by the callers, and the gauges
+    are collected by the registered collectors when flushed. All updates
+    return immediately while the registry is disabled.
+    """
+
+    enabled = False
+    lock = threading.Lock()
+    counters = {}
+    histograms = {}
+    gauge_collectors = []
+    metrics_dir = METRICS_DIR
+    flush_interval = DEFAULT_FLUSH_INTERVAL
+    exporter_thread = None
+    exporter_stop_event = None
+
+    @classmethod
+    def inc(cls, name, value=1, **labels):
+        if not cls.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with cls.lock:
+            cls.counters[key] = cls.counters.get(key, 0) + value
+
+    @classmethod
+    def observe(cls, name, value, **labels):
+        if not cls.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with cls.lock:
+            histogram = cls.histograms.get(key)
+            if histogram is None:
+                histogram = {
+                    "buckets": [0] * len(LATENCY_BUCKETS),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+                cls.histograms[key] = histogram
+            for i, upper in enumerate(LATENCY_BUCKETS):
+                if value <= upper:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @classmethod
+    def get_counter(cls, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with cls.lock:
+            return cls.counters.get(key, 0)
+
+    @classmethod
+    def register_gauge_collector(cls, collector):
+        # The collector returns the list of (name, labels, value).
+        if collector not in cls.gauge_collectors:
+            cls.gauge_collectors.append(collector)
+
+    @classmethod
+    def collect_gauges(cls):
+        gauges = {}
+        for collector in cls.gauge_collectors:
+            for name, labels, value in collector():
+                gauges[(name, tuple(sorted(labels.items())))] = value
+
+        hits = cls.get_counter(
+            "openai_bridge_response_cache_requests_total", result="hit")
+        misses = cls.get_counter(
+            "openai_bridge_response_cache_requests_total", result="miss")
+        if hits + misses > 0:
+            gauges[("openai_bridge_response_cache_hit_ratio", ())] = \
+                hits / (hits + misses)
+        return gauges
+
+    @classmethod
+    def snapshot(cls):
+        gauges = cls.collect_gauges()
+        with cls.lock:
+            counters = dict(cls.counters)
+            histograms = {
+                key: {
+                    "buckets": list(value["buckets"]),
+                    "sum": value["sum"],
+                    "count": value["count"],
+                }
+                for key, value in cls.histograms.items()
+            }
+
+        metrics = {}
+        for kind, values in (('COUNTER', counters), ('GAUGE', gauges),
+                             ('HISTOGRAM', histograms)):
+            for (name, labels), value in sorted(values.items()):
+                metric = metrics.setdefault(name, {
+                    "type": kind.lower(),
+                    "help": METRIC_DEFINITIONS.get(name, (kind, ""))[1],
+                    "samples": [],
+                })
+                metric["samples"].append(
+                    {"labels": dict(labels), "value": value})
+        return metrics
+
+    @classmethod
+    def to_prometheus(cls, metrics, instance_labels=()):
+        # The instance labels are added to all samples, so that the samples
+        # of the processes sharing the directory are distinguished.
+        lines = []
+        for name, metric in sorted(metrics.items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for sample in metric["samples"]:
+                labels = list(instance_labels) + \
+                    sorted(sample["labels"].items())
+                value = sample["value"]
+                if metric["type"] != "histogram":
+                    lines.append(
+                        f"{name}{format_labels(labels)} "
+                        f"{format_value(value)}")
+                    continue
+                for upper, count in zip(LATENCY_BUCKETS, value["buckets"]):
+                    lines.append(
+                        f"{name}_bucket"
+                        f"{format_labels(labels, ('le', format_value(upper)))}"
+                        f" {count}")
+                lines.append(
+                    f"{name}_bucket{format_labels(labels, ('le', '+Inf'))} "
+                    f"{value['count']}")
+                lines.append(
+                    f"{name}_sum{format_labels(labels)} "
+                    f"{format_value(value['sum'])}")
+                lines.append(
+                    f"{name}_count{format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def flush(cls, metrics_dir=None):
+        if metrics_dir is None:
+            metrics_dir = cls.metrics_dir
+        os.makedirs(metrics_dir, exist_ok=True)
+        metrics = cls.snapshot()
+        hostname = socket.gethostname()
+        pid = os.getpid()
+        # Each process writes its own files, because several Blender
+        # processes may share the directory (ex: render farm).
+        filename = get_metrics_filename(hostname, pid)
+        write_file_atomically(
+            f"{metrics_dir}/{filename}.prom",
+            cls.to_prometheus(
+                metrics, (("hostname", hostname), ("pid", str(pid)))))
+        write_file_atomically(
+            f"{metrics_dir}/{filename}.json",
+            json.dumps({
+                "timestamp": time.time(),
+                "hostname": hostname,
+                "pid": pid,
+                "metrics": metrics,
+            }, indent=2))
+
+    @classmethod
+    def export_loop(cls, stop_event):
+        while not stop_event.wait(cls.flush_interval):
+            try:
+                cls.flush()
+            except OSError as e:
+                print(f"Failed to export the metrics: {e}")
+
+    @classmethod
+    def configure(cls, enabled, metrics_dir=METRICS_DIR,
+                  flush_interval=DEFAULT_FLUSH_INTERVAL):
+        # The last values are exported only when the export is disabled,
+        # not when the settings are changed.
+        cls.stop_exporter(flush=not enabled)
+        cls.enabled = enabled
+        cls.metrics_dir = metrics_dir
+        cls.flush_interval = flush_interval
+        if enabled:
+            cls.exporter_stop_event = threading.Event()
+            cls.exporter_thread = threading.Thread(
+                target=cls.export_loop, args=(cls.exporter_stop_event, ),
+                daemon=True)
+            cls.exporter_thread.start()
+
+    @classmethod
+    def stop_exporter(cls, flush=True):
+        if cls.exporter_thread is None:
+            return
+        cls.exporter_stop_event.set()
+        cls.exporter_thread.join()
+        cls.exporter_thread = None
+        cls.exporter_stop_event = None
+        if not flush:
+            return
+        # Export the last values.
+        try:
+            cls.flush()
+        except OSError as e:
+            print(f"Failed to export the metrics: {e}")
+
+
+def get_metrics_filename(hostname, pid):
+    return f"{METRICS_FILENAME}-{hostname}-{pid}"
+
+
+def get_metrics_dir(prefs):
+    if prefs.metrics_dir == "":
+        return METRICS_DIR
+    return os.path.abspath(os.path.expanduser(prefs.metrics_dir))
@@ -0,0 +1,44 @@
+import gpu
+from gpu_extras.batch import batch_for_shader
+
+
+class RectBatchCache:
+    """Cache of the shader and the batch to draw a filled rectangle.
+
+    The batch is rebuilt only when the rectangle is changed, so that the
+    draw callbacks called on every redraw do not allocate GPU resources.
+    """
+
+    def __init__(self):
+        self.shader = None
+        self.batch = None
+        self.rect = None
+
+    def draw(self, x, y, width, height, color):
+        if self.shader is None:
+            self.shader = gpu.shader.from_builtin('2D_UNIFORM_COLOR')
+
+        rect = (x, y, width, height)
+        if self.batch is None or self.rect != rect:
+            vertex_data = {
+                "pos": [
+                    [x, y],
+                    [x, y + height],
+                    [x + width, y + height],
+                    [x + width, y],
+                ]
+            }
+            index_data = [
+                [0, 1, 2],
+                [2, 3, 0]
+            ]
+            self.batch = batch_for_shader(
+                self.shader, 'TRIS', vertex_data, indices=index_data)
+            self.rect = rect
+
+        original_state = gpu.state.blend_get()
+        gpu.state.blend_set('ALPHA')
+        self.shader.bind()
+        self.shader.uniform_float("color", color)
+        self.batch.draw(self.shader)
+        gpu.state.blend_set(original_state)
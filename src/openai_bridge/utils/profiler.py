@@ -0,0 +1,212 @@
+import collections
+import contextlib
+import cProfile
+import functools
+import itertools
+import os
+import sys
+import threading
+import time
+
+from ..utils.common import DATA_DIR
+
+PROFILE_DIR = f"{DATA_DIR}/profiles"
+DEFAULT_TICKS_PER_CAPTURE = 100
+# Interval (seconds) of the sampling profiler.
+SAMPLING_INTERVAL = 0.005
+
+
+class StackSampler:
+    """Sampling profiler of a thread.
+
+    The stacks of the target thread are sampled by the background thread
+    while the sampler is enabled, and saved as the collapsed stacks which
+    can be read by flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, thread_id, interval=SAMPLING_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.active = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def enable(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.sample_loop, name="OpenAIBridgeSampler",
+                daemon=True)
+            self.thread.start()
+        self.active.set()
+
+    def disable(self):
+        self.active.clear()
+
+    def sample_loop(self):
+        while True:
+            # Sleep without polling while the sampler is disabled.
+            self.active.wait()
+            if self.stop_event.wait(self.interval):
+                break
+            if not self.active.is_set():
+                continue
+            # pylint: disable=W0212
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append(
+                    f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def dump_stats(self, filepath):
+        self.stop_event.set()
+        # Wake up the thread waiting for the sampler to be enabled.
+        self.active.set()
+        if self.thread is not None:
+            self.thread.join()
+        with open(filepath, "w", encoding="utf-8") as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """Captures the profile per invocation of the operators and the request
+    handlers, or per ticks of the modal operator.
+
+    Each capture is saved as .prof (cProfile) or .folded (collapsed stacks
+    of the sampling profiler) in the output directory.
+    """
+
+    enabled = False
+    mode = 'CPROFILE'
+    output_dir = PROFILE_DIR
+    ticks_per_capture = DEFAULT_TICKS_PER_CAPTURE
+    # Name -> [profiler, number of ticks].
+    tick_captures = {}
+    thread_local = threading.local()
+    sequence = itertools.count()
+
+    @classmethod
+    def configure(cls, enabled, mode='CPROFILE', output_dir=PROFILE_DIR,
+                  ticks_per_capture=DEFAULT_TICKS_PER_CAPTURE):
+        if cls.enabled and not enabled:
+            # Save the captures of the ticks in progress.
+            for name, (profiler, _) in cls.tick_captures.items():
+                cls.save(name, profiler)
+            cls.tick_captures = {}
+        cls.enabled = enabled
+        cls.mode = mode
+        cls.output_dir = output_dir
+        cls.ticks_per_capture = ticks_per_capture
+
+    @classmethod
+    def create_profiler(cls):
+        if cls.mode == 'SAMPLING':
+            return StackSampler(threading.get_ident())
+        return cProfile.Profile()
+
+    @classmethod
+    def save(cls, name, profiler):
+        ext = "folded" if isinstance(profiler, StackSampler) else "prof"
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        filepath = f"{cls.output_dir}/{name}-{timestamp}-" \
+                   f"{next(cls.sequence)}.{ext}"
+        try:
+            os.makedirs(cls.output_dir, exist_ok=True)
+            profiler.dump_stats(filepath)
+        except OSError as e:
+            print(f"Failed to save the profile: {e}")
+
+    @classmethod
+    @contextlib.contextmanager
+    def run(cls, profiler):
+        # Profile in this thread unless the outer call is profiled.
+        if getattr(cls.thread_local, "active", False):
+            yield False
+            return
+        try:
+            profiler.enable()
+        except ValueError:
+            # Other profiling tool is active (Python 3.12+).
+            yield False
+            return
+        cls.thread_local.active = True
+        try:
+            yield True
+        finally:
+            profiler.disable()
+            cls.thread_local.active = False
+
+    @classmethod
+    @contextlib.contextmanager
+    def profile(cls, name):
+        if not cls.enabled:
+            yield
+            return
+        profiler = cls.create_profiler()
+        profiled = False
+        try:
+            with cls.run(profiler) as profiled:
+                yield
+        finally:
+            # Save the profile of the failed invocation too.
+            if profiled:
+                cls.save(name, profiler)
+
+    @classmethod
+    @contextlib.contextmanager
+    def profile_ticks(cls, name):
+        # The ticks are accumulated into a capture. This must be called
+        # from the same thread.
+        if not cls.enabled:
+            yield
+            return
+        if name not in cls.tick_captures:
+            cls.tick_captures[name] = [cls.create_profiler(), 0]
+        capture = cls.tick_captures[name]
+        profiled = False
+        try:
+            with cls.run(capture[0]) as profiled:
+                yield
+        finally:
+            if profiled:
+                capture[1] += 1
+                if capture[1] >= cls.ticks_per_capture:
+                    del cls.tick_captures[name]
+                    cls.save(name, capture[0])
+
+
+def profile_execute(execute, name):
+    # Blender checks that execute() of the operator has 2 arguments when
+    # the operator is registered.
+    @functools.wraps(execute)
+    def wrapper(self, context):
+        if not Profiler.enabled:
+            return execute(self, context)
+        with Profiler.profile(name):
+            return execute(self, context)
+
+    wrapper.profiled = True
+    return wrapper
+
+
+def install_operator_profiling(classes):
+    for class_ in classes:
+        if not class_.__name__.startswith("OPENAI_OT_"):
+            continue
+        execute = class_.__dict__.get("execute")
+        if execute is None or getattr(execute, "profiled", False):
+            continue
+        class_.execute = profile_execute(
+            execute, f"{class_.__name__}.execute")
+
+
+def get_profile_dir(prefs):
+    if prefs.profiler_dir == "":
+        return PROFILE_DIR
+    return os.path.abspath(os.path.expanduser(prefs.profiler_dir))
@@ -0,0 +1,175 @@
+import re
+import threading
+import time
+
+# Limits per model: (requests per minute, tokens per minute).
+# 0 means unlimited.
+DEFAULT_RATE_LIMITS = {
+    "dall-e-2": (50, 0),
+    "whisper-1": (50, 0),
+    "gpt-3.5-turbo": (3500, 90000),
+    "gpt-4": (500, 10000),
+    "gpt-4-32k": (500, 20000),
+}
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(text):
+    # Parse the duration like "1s", "6m0s" or "20ms" in the headers.
+    seconds = 0.0
+    for value, unit in DURATION_PATTERN.findall(text or ""):
+        seconds += float(value) * DURATION_UNITS[unit]
+    return seconds
+
+
+class TokenBucket:
+    """Token bucket which refills the amount per minute continuously.
+
+    The reservation makes the tokens negative, and the deficit is the
+    time to wait before sending. This paces the concurrent requests
+    instead of letting all of them wait for the same refill.
+    """
+
+    def __init__(self, amount_per_minute):
+        self.capacity = amount_per_minute
+        self.tokens = float(amount_per_minute)
+        self.last_refilled = time.monotonic()
+
+    def refill(self, now):
+        rate = self.capacity / 60.0
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.last_refilled) * rate)
+        self.last_refilled = now
+
+    def reserve(self, amount, now):
+        self.refill(now)
+        self.tokens -= min(amount, self.capacity)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / (self.capacity / 60.0)
+
+    def set_capacity(self, amount_per_minute, now):
+        self.refill(now)
+        self.capacity = amount_per_minute
+        self.tokens = min(self.tokens, self.capacity)
+
+    def limit(self, remaining, reset, now):
+        # Follow the remaining amount reported by the server.
+        self.refill(now)
+        if remaining > 0:
+            self.tokens = min(self.tokens, remaining)
+        else:
+            self.tokens = min(self.tokens, -reset * self.capacity / 60.0)
+
+
+class RateLimiter:
+    """Client-side rate limiter per endpoint and model.
+
+    Each endpoint and model has a bucket for the requests and a bucket for
+    the tokens. The buckets are tuned by the x-ratelimit-* headers of the
+    responses.
+    """
+
+    enabled = True
+    limits = dict(DEFAULT_RATE_LIMITS)
+    buckets = {}
+    blocked_until = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, enabled, limits):
+        with cls.lock:
+            cls.enabled = enabled
+            cls.limits = dict(limits)
+            cls.buckets = {}
+            cls.blocked_until = {}
+
+    @classmethod
+    def get_buckets(cls, endpoint, model):
+        # This must be called with lock acquired.
+        key = (endpoint, model)
+        if key not in cls.buckets:
+            requests_per_minute, tokens_per_minute = \
+                cls.limits.get(model, (0, 0))
+            cls.buckets[key] = {
+                "requests": TokenBucket(requests_per_minute)
+                if requests_per_minute > 0 else None,
+                "tokens": TokenBucket(tokens_per_minute)
+                if tokens_per_minute > 0 else None,
+            }
+        return cls.buckets[key]
+
+    @classmethod
+    def acquire(cls, endpoint, model, num_tokens=0, reserved=False):
+        """Reserve a request and tokens, and return the seconds to wait.
+
+        If reserved is True, the request was reserved by the previous call
+        and only the time blocked by 429 response is returned.
+        """
+
+        if not cls.enabled:
+            return 0.0
+        with cls.lock:
+            now = time.monotonic()
+            buckets = cls.get_buckets(endpoint, model)
+            wait_time = max(
+                0.0, cls.blocked_until.get((endpoint, model), 0.0) - now)
+            if reserved:
+                return wait_time
+            if buckets["requests"] is not None:
+                wait_time = max(
+                    wait_time, buckets["requests"].reserve(1, now))
+            if buckets["tokens"] is not None and num_tokens > 0:
+                wait_time = max(
+                    wait_time, buckets["tokens"].reserve(num_tokens, now))
+        return wait_time
+
+    @classmethod
+    def consume_tokens(cls, endpoint, model, num_tokens):
+        # Correct the reserved tokens by the actual usage.
+        if not cls.enabled:
+            return
+        with cls.lock:
+            bucket = cls.get_buckets(endpoint, model)["tokens"]
+            if bucket is not None:
+                bucket.refill(time.monotonic())
+                bucket.tokens -= num_tokens
+
+    @classmethod
+    def update(cls, endpoint, model, headers):
+        if not cls.enabled:
+            return
+        with cls.lock:
+            now = time.monotonic()
+            buckets = cls.get_buckets(endpoint, model)
+            for kind, bucket in buckets.items():
+                # Follow the limit reported by the server, which may be
+                # higher or lower than the configured limit.
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                if limit is not None and limit.isdigit() and int(limit) > 0:
+                    if bucket is None:
+                        bucket = TokenBucket(int(limit))
+                        buckets[kind] = bucket
+                    else:
+                        bucket.set_capacity(int(limit), now)
+                if bucket is None:
+                    continue
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if remaining is not None and remaining.isdigit():
+                    reset = parse_duration(
+                        headers.get(f"x-ratelimit-reset-{kind}"))
+                    bucket.limit(int(remaining), reset, now)
+
+    @classmethod
+    def penalize(cls, endpoint, model, retry_after):
+        # Stop sending until retry_after seconds pass after 429 response.
+        if not cls.enabled:
+            return
+        with cls.lock:
+            key = (endpoint, model)
+            blocked_until = time.monotonic() + retry_after
+            cls.blocked_until[key] = max(
+                cls.blocked_until.get(key, 0.0), blocked_until)
@@ -0,0 +1,156 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from ..utils.common import DATA_DIR
+from ..utils.tracing import Tracer
+
+REQUEST_JOURNAL_FILEPATH = f"{DATA_DIR}/requests.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    transaction_id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    options TEXT NOT NULL,
+    state TEXT NOT NULL,
+    transaction_data TEXT NOT NULL,
+    created_at REAL NOT NULL
+)
+"""
+
+
+class RequestJournal:
+    """Durable journal of the asynchronous requests.
+
+    A request is journaled when it is queued, its progress is updated at
+    each checkpoint, and it is removed when the transaction ends. The
+    requests left in the journal were not finished by the previous session
+    and can be resumed. The API key is not journaled.
+
+    The journal is a SQLite database in WAL mode, so that a commit survives
+    the crash of Blender.
+
+    The requests in the journal when it is opened are the unfinished ones.
+    The requests journaled by the current session are not resumed or
+    discarded, because they are still queued or in flight.
+    """
+
+    connection = None
+    lock = threading.Lock()
+    # IDs of the requests not finished by the previous session.
+    unfinished_transaction_ids = []
+
+    @classmethod
+    def open(cls, filepath=REQUEST_JOURNAL_FILEPATH):
+        with cls.lock:
+            if cls.connection is not None:
+                return
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            connection = sqlite3.connect(
+                filepath, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(SCHEMA)
+            cls.connection = connection
+            rows = connection.execute(
+                "SELECT transaction_id FROM requests").fetchall()
+            cls.unfinished_transaction_ids = [row[0] for row in rows]
+
+    @classmethod
+    def close(cls):
+        with cls.lock:
+            if cls.connection is None:
+                return
+            cls.connection.close()
+            cls.connection = None
+            cls.unfinished_transaction_ids = []
+
+    @classmethod
+    def configure(cls, enabled):
+        if enabled:
+            cls.open()
+        else:
+            cls.close()
+
+    @classmethod
+    def enabled(cls):
+        return cls.connection is not None
+
+    @classmethod
+    def execute(cls, sql, params=()):
+        # Journaling is best effort. The request is sent even if the
+        # journal is not available.
+        with cls.lock:
+            if cls.connection is None:
+                return []
+            try:
+                with Tracer.span("journal", "io"):
+                    return cls.connection.execute(sql, params).fetchall()
+            except sqlite3.Error as e:
+                print(f"Failed to update the request journal: {e}")
+                return []
+
+    @classmethod
+    def add(cls, request, transaction_data):
+        _, transaction_id, req_type, req_data, options, state = request
+        cls.execute(
+            "INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(transaction_id), req_type, json.dumps(req_data),
+             json.dumps(options), json.dumps(state),
+             json.dumps(transaction_data), time.time()))
+
+    @classmethod
+    def update_state(cls, transaction_id, state):
+        if transaction_id is None:
+            # Synchronous request.
+            return
+        cls.execute(
+            "UPDATE requests SET state = ? WHERE transaction_id = ?",
+            (json.dumps(state), str(transaction_id)))
+
+    @classmethod
+    def remove(cls, transaction_id):
+        cls.execute(
+            "DELETE FROM requests WHERE transaction_id = ?",
+            (str(transaction_id), ))
+
+    @classmethod
+    def discard_unfinished(cls):
+        transaction_ids = cls.unfinished_transaction_ids
+        cls.unfinished_transaction_ids = []
+        for transaction_id in transaction_ids:
+            cls.remove(transaction_id)
+
+    @classmethod
+    def pop_unfinished(cls):
+        # The popped requests are resumed by the caller, and removed from
+        # the journal when they are finished.
+        entries = cls.load()
+        cls.unfinished_transaction_ids = []
+        return entries
+
+    @classmethod
+    def load(cls):
+        """Returns the unfinished requests (without the API key) and their
+        transaction data in the order of arrival."""
+
+        unfinished_transaction_ids = set(cls.unfinished_transaction_ids)
+        if not unfinished_transaction_ids:
+            return []
+        rows = cls.execute(
+            "SELECT transaction_id, type, data, options, state, "
+            "transaction_data FROM requests ORDER BY created_at, rowid")
+        entries = []
+        for transaction_id, req_type, req_data, options, state, \
+                transaction_data in rows:
+            if transaction_id not in unfinished_transaction_ids:
+                continue
+            request = [None, uuid.UUID(transaction_id), req_type,
+                       json.loads(req_data), json.loads(options),
+                       json.loads(state)]
+            entries.append((request, json.loads(transaction_data)))
+        return entries
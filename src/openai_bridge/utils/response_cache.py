@@ -0,0 +1,244 @@
+"""On-disk cache of the chat completion responses.
+
+The cache directory can be shared by several machines (ex: NFS mount).
+This module does not depend on Blender, so that the cache can be pruned
+from the command line:
+
+    python response_cache.py prune [--dir DIR] [--max-age-hours HOURS]
+                                   [--max-size-mb MB]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+# Same as DATA_DIR in common.py, which cannot be imported from the command
+# line.
+RESPONSE_CACHE_DIR = \
+    f"{os.path.dirname(__file__)}/../_data/cache/response"
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+# Minimum seconds between the evictions from a process.
+EVICTION_INTERVAL = 60.0
+# Temporary files older than this are left by the crashed writers.
+STALE_TMP_FILE_AGE = 60 * 60
+
+
+class ResponseCache:
+    """Response cache keyed by the hash of the normalized request body.
+
+    The response is written to a temporary file in the same directory and
+    renamed atomically, so the readers never see a partially written file
+    and need no lock. Concurrent writers of the same key write the same
+    response and the last rename wins. The TTL is checked against the
+    creation time stored in the response. The modification time of the
+    file is updated on every hit, so the least recently used responses are
+    evicted first when the total size exceeds the limit.
+    """
+
+    lock = threading.Lock()
+    last_evicted = {}
+
+    @classmethod
+    def make_key(cls, req_data):
+        # Only the fields which affect the response are hashed.
+        normalized = {
+            "model": req_data["model"],
+            "messages": [
+                {
+                    "role": message["role"],
+                    "content": message["content"].strip(),
+                }
+                for message in req_data["messages"]
+            ],
+        }
+        body = json.dumps(normalized, sort_keys=True, separators=(",", ":"),
+                          ensure_ascii=False)
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def get_filepath(cls, cache_dir, key):
+        return f"{cache_dir}/{key[0:2]}/{key}.json"
+
+    @classmethod
+    def get(cls, key, ttl=DEFAULT_TTL, cache_dir=RESPONSE_CACHE_DIR):
+        filepath = cls.get_filepath(cache_dir, key)
+        try:
+            mtime = os.path.getmtime(filepath)
+            with open(filepath, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # The file may be removed or broken by other machines.
+            return None
+        # The modification time is updated by the hits, so it cannot be
+        # used for the TTL.
+        if time.time() - data.get("created_at", mtime) > ttl:
+            return None
+
+        try:
+            os.utime(filepath)
+        except OSError:
+            # The shared directory may be read-only.
+            pass
+        return data
+
+    @classmethod
+    def put(cls, key, data, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE,
+            cache_dir=RESPONSE_CACHE_DIR):
+        # The cache is an optimization. The failures of the write and the
+        # eviction (ex: disk full, read-only shared directory) must not
+        # fail the request whose response is already received.
+        try:
+            cls.write(key, data, cache_dir)
+        except OSError as e:
+            print(f"Failed to write the response cache: {e}")
+            return
+
+        with cls.lock:
+            now = time.monotonic()
+            last_evicted = cls.last_evicted.get(cache_dir)
+            if last_evicted is not None and \
+                    now - last_evicted < EVICTION_INTERVAL:
+                return
+            cls.last_evicted[cache_dir] = now
+        try:
+            prune(cache_dir, max_age=ttl, max_size=max_size)
+        except OSError as e:
+            print(f"Failed to evict the response cache: {e}")
+
+    @classmethod
+    def write(cls, key, data, cache_dir):
+        filepath = cls.get_filepath(cache_dir, key)
+        dirname = os.path.dirname(filepath)
+        os.makedirs(dirname, exist_ok=True)
+
+        data = dict(data, created_at=time.time())
+        prefix = f".{key}.{socket.gethostname()}."
+        fd, tmp_filepath = tempfile.mkstemp(
+            prefix=prefix, suffix=".tmp", dir=dirname)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filepath, filepath)
+        except BaseException:
+            try:
+                os.remove(tmp_filepath)
+            except OSError:
+                pass
+            raise
+
+
+def prune(cache_dir=RESPONSE_CACHE_DIR, max_age=None, max_size=None):
+    """Remove the expired responses and the least recently used responses
+    until the total size gets within max_size.
+
+    Returns the number of removed files and the removed bytes.
+    """
+
+    now = time.time()
+    entries = []
+    total_size = 0
+    num_removed = 0
+    removed_size = 0
+
+    def remove(filepath, size):
+        nonlocal num_removed, removed_size
+        try:
+            os.remove(filepath)
+        except OSError:
+            # Already removed by other machines.
+            return False
+        num_removed += 1
+        removed_size += size
+        return True
+
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            age = now - stat.st_mtime
+            if filename.endswith(".tmp"):
+                if age > STALE_TMP_FILE_AGE:
+                    remove(filepath, stat.st_size)
+                continue
+            if not filename.endswith(".json"):
+                continue
+            if max_age is not None and age > max_age:
+                remove(filepath, stat.st_size)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filepath))
+            total_size += stat.st_size
+
+    if max_size is not None:
+        entries.sort()
+        for _, size, filepath in entries:
+            if total_size <= max_size:
+                break
+            remove(filepath, size)
+            total_size -= size
+
+    return num_removed, removed_size
+
+
+def get_response_cache_options(prefs):
+    if not prefs.response_cache_enabled:
+        return None
+    return {
+        "ttl": prefs.response_cache_ttl * 60 * 60,
+        "max_size": prefs.response_cache_max_size * 1024 * 1024,
+        "cache_dir": get_response_cache_dir(prefs),
+    }
+
+
+def get_response_cache_dir(prefs):
+    if prefs.response_cache_dir == "":
+        return RESPONSE_CACHE_DIR
+    return os.path.abspath(os.path.expanduser(prefs.response_cache_dir))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Manage the response cache of OpenAI Bridge")
+    subparsers = parser.add_subparsers(dest="command")
+    prune_parser = subparsers.add_parser(
+        "prune", help="Remove old responses from the cache")
+    prune_parser.add_argument(
+        "--dir", default=RESPONSE_CACHE_DIR, help="Cache directory")
+    prune_parser.add_argument(
+        "--max-age-hours", type=float, default=None,
+        help="Remove the responses not used for the hours")
+    prune_parser.add_argument(
+        "--max-size-mb", type=float, default=None,
+        help="Remove the least recently used responses over the size")
+    args = parser.parse_args(argv)
+
+    if args.command != "prune":
+        parser.print_help()
+        return 1
+
+    max_age = None
+    if args.max_age_hours is not None:
+        max_age = args.max_age_hours * 60 * 60
+    max_size = None
+    if args.max_size_mb is not None:
+        max_size = int(args.max_size_mb * 1024 * 1024)
+    num_removed, removed_size = prune(args.dir, max_age, max_size)
+    print(f"Removed {num_removed} files ({removed_size} bytes).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
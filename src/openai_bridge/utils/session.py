@@ -0,0 +1,49 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Number of hosts (api.openai.com, image CDN, ...) to keep connection pools.
+POOL_CONNECTIONS = 4
+# Number of keep-alive connections per host.
+POOL_MAXSIZE = 16
+
+
+class SessionPool:
+    """Shared HTTP sessions which keep connections alive among requests.
+
+    A session is created per proxy configuration and shared by all worker
+    threads. The sessions are never modified after the creation, and
+    connection pools of urllib3 are thread-safe.
+    """
+
+    sessions = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls, proxies):
+        key = (proxies.get("http") or "", proxies.get("https") or "")
+        with cls.lock:
+            session = cls.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                      pool_maxsize=POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                cls.sessions[key] = session
+        return session
+
+    @classmethod
+    def close_all(cls):
+        with cls.lock:
+            for session in cls.sessions.values():
+                session.close()
+            cls.sessions = {}
+
+
+def get_session(proxies):
+    return SessionPool.get(proxies)
+
+
+def close_sessions():
+    SessionPool.close_all()
@@ -4,13 +4,18 @@ import threading
 import time
 from urllib.parse import urlparse
 import math
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import itertools
+import contextlib
+import email.utils
+import hashlib
+import heapq
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import random
 import uuid
 import requests
 import bpy
 import blf
-import gpu
-from gpu_extras.batch import batch_for_shader
 
 from ..utils.common import (
     get_area_region_space,
@@ -19,11 +24,46 @@ from ..utils.common import (
     CHAT_DATA_DIR,
     CODE_DATA_DIR,
     ChatTextFile,
+    build_chat_history,
+    get_max_prompt_tokens,
+    API_BASE_URL,
 )
 from ..utils import error_storage
+from ..utils.instrumentation import LatencyRecorder, format_statistics
+from ..utils.metrics import MetricsRegistry
+from ..utils.overlay import RectBatchCache
+from ..utils.profiler import Profiler
+from ..utils.rate_limiter import RateLimiter
+from ..utils.request_journal import RequestJournal
+from ..utils.response_cache import ResponseCache
+from ..utils.session import get_session, close_sessions
+from ..utils.tokenizer import count_message_tokens
+from ..utils.tracing import Tracer, trace_draw
 from ..utils.bl_class_registry import BlClassRegistry
 
 
+# Interval (seconds) of the timer to process the messages. The interval is
+# extended while no message arrives.
+MESSAGE_TIMER_MIN_INTERVAL = 0.05
+MESSAGE_TIMER_MAX_INTERVAL = 1.0
+MESSAGE_TIMER_BACKOFF_FACTOR = 2.0
+# Maximum time (seconds) to process the messages per timer event.
+MESSAGE_PROCESSING_TIME_BUDGET = 0.02
+# Size of the request status.
+STATUS_WIDTH = 250.0
+STATUS_HEIGHT = 180.0
+# Height of the first request line and the interval of the lines.
+STATUS_LINE_START_Y = 100.0
+STATUS_LINE_HEIGHT = 20.0
+# Area types which need to be redrawn after processing the message.
+MESSAGE_AREA_TYPES = {
+    'IMAGE': {'IMAGE_EDITOR'},
+    'AUDIO': {'TEXT_EDITOR', 'SEQUENCE_EDITOR'},
+    'CHAT': {'VIEW_3D'},
+    'CODE': {'TEXT_EDITOR', 'VIEW_3D'},
+}
+
+
 @BlClassRegistry()
 class OPENAI_OT_ProcessMessage(bpy.types.Operator):
 
@@ -32,7 +72,7 @@ class OPENAI_OT_ProcessMessage(bpy.types.Operator):
     bl_label = "Process Message"
 
     message_queue_lock = threading.Lock()
-    message_queue = []
+    message_queue = deque()
     section_stats = {
         "transaction_total": 0,
         "transaction_consumed_total": 0,
@@ -42,12 +82,21 @@ class OPENAI_OT_ProcessMessage(bpy.types.Operator):
     transaction_ids_lock = threading.Lock()
 
     timer = None
-    draw_cb = {"space_data": None, "handler": None}
+    timer_interval = MESSAGE_TIMER_MIN_INTERVAL
+    draw_cb = {"space_data": None, "handler": None, "area_type": 'VIEW_3D'}
+    status_background = RectBatchCache()
+    status_queue_version = 0
+    status_texts = [""]
+    # Transactions shown in the lines of status_texts[1:].
+    status_transaction_ids = []
+    # Transactions whose chat topic has been focused.
+    chat_focused_transaction_ids = set()
 
     @classmethod
     def process(cls, transaction_id, type_, data, options, exec_params):
         message = {"transaction_id": transaction_id, "type": type_,
-                   "data": data, "options": options}
+                   "data": data, "options": options,
+                   "posted_at": time.monotonic()}
         if exec_params["sync"]:
             cls.sync_process(exec_params["context"],
                              exec_params["operator_instance"], message)
@@ -136,9 +185,14 @@ class OPENAI_OT_ProcessMessage(bpy.types.Operator):
                     s.select = False
                 seq_data.select = True
         elif msg_type == 'CHAT':
-            # Focus on the topic.
-            context.scene.openai_chat_tool_props.topic = options["topic"]
-            context.scene.openai_chat_tool_props.new_topic = False
+            # Focus on the topic only at the first message of the
+            # transaction, so that the streamed responses of the other
+            # topics do not switch the topic while the user reads it.
+            if transaction_id not in cls.chat_focused_transaction_ids:
+                context.scene.openai_chat_tool_props.topic = options["topic"]
+                context.scene.openai_chat_tool_props.new_topic = False
+                if transaction_id is not None:
+                    cls.chat_focused_transaction_ids.add(transaction_id)
         elif msg_type == 'CODE':
             os.makedirs(CODE_DATA_DIR, exist_ok=True)
             filepath = f"{CODE_DATA_DIR}/{options['code']}.py"
@@ -163,52 +217,190 @@ class OPENAI_OT_ProcessMessage(bpy.types.Operator):
             exception = data["exception"]
             operator_instance.report({'WARNING'}, f"Error: {exception}")
         elif message["type"] == 'END_OF_TRANSACTION':
+            cls.chat_focused_transaction_ids.discard(transaction_id)
             cls.section_stats["transaction_consumed_total"] += 1
             return transaction_id
 
         return None
 
-    def process_message(self, context):
+    def process_messages(self, context):
         cls = self.__class__
-        with cls.message_queue_lock:
-            if len(cls.message_queue) == 0:
-                return None
-            message = cls.message_queue.pop(0)
-
-        transaction_id = cls.process_message_internal(context, self, message)
+        num_processed = 0
+        finished_transaction_ids = []
+        area_types_to_redraw = set()
+
+        # Process the pending messages until the time budget is exhausted.
+        # At least one message is processed per call.
+        start_time = time.monotonic()
+        while time.monotonic() - start_time < MESSAGE_PROCESSING_TIME_BUDGET:
+            with cls.message_queue_lock:
+                if len(cls.message_queue) == 0:
+                    break
+                message = cls.message_queue.popleft()
+
+            processing_start = time.monotonic()
+            with Tracer.span(f"apply {message['type'].lower()}", "ui"):
+                transaction_id = cls.process_message_internal(
+                    context, self, message)
+            LatencyRecorder.record(
+                message["transaction_id"], "message_wait",
+                message["posted_at"], processing_start)
+            if transaction_id is not None:
+                LatencyRecorder.finish(transaction_id)
+            else:
+                LatencyRecorder.record(
+                    message["transaction_id"],
+                    f"apply {message['type'].lower()}", processing_start,
+                    time.monotonic())
+            num_processed += 1
+            area_types_to_redraw |= MESSAGE_AREA_TYPES.get(
+                message["type"], set())
+            if transaction_id is not None:
+                finished_transaction_ids.append(transaction_id)
+                # Request status is changed.
+                area_types_to_redraw.add(cls.draw_cb["area_type"])
 
         # Update screen.
-        for area in context.screen.areas:
-            area.tag_redraw()
+        if area_types_to_redraw:
+            for area in context.screen.areas:
+                if area.type in area_types_to_redraw:
+                    area.tag_redraw()
+
+        return num_processed, finished_transaction_ids
 
-        return transaction_id
+    @classmethod
+    def set_timer_interval(cls, context, interval):
+        if interval == cls.timer_interval:
+            return
+        wm = context.window_manager
+        wm.event_timer_remove(cls.timer)
+        cls.timer = wm.event_timer_add(interval, window=context.window)
+        cls.timer_interval = interval
 
     def modal(self, context, event):
         cls = self.__class__
 
-        if event.type == 'TIMER':
-            msg_key = self.process_message(context)
-            if msg_key is not None:
-                with cls.transaction_ids_lock:
-                    assert msg_key in cls.transaction_ids
-                    del cls.transaction_ids[msg_key]
-                    if len(cls.transaction_ids) == 0:
-                        wm = context.window_manager
-                        wm.event_timer_remove(cls.timer)
-                        cls.timer = None
-                        if cls.draw_cb["space_data"] is not None and \
-                                cls.draw_cb["handler"] is not None:
-                            cls.draw_cb["space_data"].draw_handler_remove(
-                                cls.draw_cb["handler"], 'WINDOW')
-
-                        print("Terminated Message Processing Timer")
-                        return {'FINISHED'}
-
-            context.area.tag_redraw()
+        if event.type == 'ESC' and event.value == 'PRESS':
+            position = cls.get_mouse_position_on_status(context, event)
+            if position is not None:
+                # Cancel the request under the mouse cursor by ESC, or all
+                # requests by ESC on the title of the request status.
+                transaction_id = cls.get_status_transaction_id(position[1])
+                if transaction_id is None:
+                    RequestHandler.cancel_all()
+                else:
+                    RequestHandler.cancel(transaction_id)
+                return {'RUNNING_MODAL'}
+
+        if event.type != 'TIMER':
+            # Snap back to the fast timer when a message arrives while the
+            # timer is backed off.
+            if len(cls.message_queue) != 0:
+                cls.set_timer_interval(context, MESSAGE_TIMER_MIN_INTERVAL)
+        else:
+            with Profiler.profile_ticks("OPENAI_OT_ProcessMessage.modal"), \
+                    Tracer.span("modal tick", "ui"):
+                num_processed, finished_transaction_ids = \
+                    self.process_messages(context)
+            with cls.transaction_ids_lock:
+                for transaction_id in finished_transaction_ids:
+                    assert transaction_id in cls.transaction_ids
+                    del cls.transaction_ids[transaction_id]
+                num_transactions = len(cls.transaction_ids)
+            if finished_transaction_ids or \
+                    cls.status_queue_version != RequestHandler.queue_version:
+                cls.update_status_texts()
+                cls.redraw_status(context)
+                if num_transactions == 0:
+                    wm = context.window_manager
+                    wm.event_timer_remove(cls.timer)
+                    cls.timer = None
+                    if cls.draw_cb["space_data"] is not None and \
+                            cls.draw_cb["handler"] is not None:
+                        cls.draw_cb["space_data"].draw_handler_remove(
+                            cls.draw_cb["handler"], 'WINDOW')
+
+                    print("Terminated Message Processing Timer")
+                    return {'FINISHED'}
+
+            # Tick fast while the messages are flowing, and back off while
+            # the message queue stays empty.
+            if num_processed != 0:
+                interval = MESSAGE_TIMER_MIN_INTERVAL
+            else:
+                interval = min(
+                    cls.timer_interval * MESSAGE_TIMER_BACKOFF_FACTOR,
+                    MESSAGE_TIMER_MAX_INTERVAL)
+            cls.set_timer_interval(context, interval)
 
         return {'PASS_THROUGH'}
 
     @classmethod
+    def update_status_texts(cls):
+        consumed = cls.section_stats["transaction_consumed_total"]
+        total = cls.section_stats["transaction_total"]
+        texts = [f"({consumed}/{total})"]
+        transaction_ids = []
+        positions = RequestHandler.get_queue_positions()
+        with cls.transaction_ids_lock:
+            for transaction_id, item in cls.transaction_ids.items():
+                if len(texts) > 5:
+                    break
+                position = positions.get(transaction_id)
+                state = "Running" if position is None else f"#{position}"
+                texts.append(f"[{item['type']}] {item['title']} ({state})")
+                transaction_ids.append(transaction_id)
+        cls.status_texts = texts
+        cls.status_transaction_ids = transaction_ids
+        cls.status_queue_version = RequestHandler.queue_version
+
+    @classmethod
+    def redraw_status(cls, context):
+        if cls.draw_cb["handler"] is None:
+            return
+        for area in context.screen.areas:
+            if area.type == cls.draw_cb["area_type"]:
+                area.tag_redraw()
+
+    @classmethod
+    def get_mouse_position_on_status(cls, context, event):
+        # Returns the mouse position relative to the request status, or None
+        # if the mouse is not on the request status.
+        if cls.draw_cb["handler"] is None:
+            return None
+
+        user_prefs = context.preferences
+        prefs = user_prefs.addons["openai_bridge"].preferences
+        base_x = prefs.request_status_location[0]
+        base_y = prefs.request_status_location[1]
+
+        for area in context.window.screen.areas:
+            if area.type != cls.draw_cb["area_type"]:
+                continue
+            for region in area.regions:
+                if region.type != 'WINDOW':
+                    continue
+                x = event.mouse_x - region.x
+                y = event.mouse_y - region.y
+                if not (0 <= x < region.width and 0 <= y < region.height):
+                    continue
+                if base_x <= x <= base_x + STATUS_WIDTH and \
+                        base_y <= y <= base_y + STATUS_HEIGHT:
+                    return x - base_x, y - base_y
+        return None
+
+    @classmethod
+    def get_status_transaction_id(cls, y):
+        # Returns the transaction drawn at the height, which is relative to
+        # the request status.
+        for count, transaction_id in enumerate(cls.status_transaction_ids):
+            line_y = STATUS_LINE_START_Y - count * STATUS_LINE_HEIGHT
+            if line_y - 5.0 <= y < line_y - 5.0 + STATUS_LINE_HEIGHT:
+                return transaction_id
+        return None
+
+    @classmethod
+    @trace_draw
     def draw_status(cls, context):
         user_prefs = context.preferences
         prefs = user_prefs.addons["openai_bridge"].preferences
@@ -219,29 +411,8 @@ class OPENAI_OT_ProcessMessage(bpy.types.Operator):
         base_y = prefs.request_status_location[1]
 
         # Draw background.
-        original_state = gpu.state.blend_get()
-        gpu.state.blend_set('ALPHA')
-        rect_width = 250.0
-        rect_height = 180.0
-        vertex_data = {
-            "pos": [
-                [base_x, base_y],
-                [base_x, base_y + rect_height],
-                [base_x + rect_width, base_y + rect_height],
-                [base_x + rect_width, base_y],
-            ]
-        }
-        index_data = [
-            [0, 1, 2],
-            [2, 3, 0]
-        ]
-        shader = gpu.shader.from_builtin('2D_UNIFORM_COLOR')
-        batch = batch_for_shader(
-            shader, 'TRIS', vertex_data, indices=index_data)
-        shader.bind()
-        shader.uniform_float("color", [0.0, 0.0, 0.0, 0.6])
-        batch.draw(shader)
-        gpu.state.blend_set(original_state)
+        cls.status_background.draw(
+            base_x, base_y, STATUS_WIDTH, STATUS_HEIGHT, [0.0, 0.0, 0.0, 0.6])
 
         blf.color(font_id, 1.0, 1.0, 0.0, 1.0)
 
@@ -251,23 +422,22 @@ class OPENAI_OT_ProcessMessage(bpy.types.Operator):
         blf.draw(font_id, "Processing Requests ...")
 
         # Draw rest transactions.
-        consumed = cls.section_stats["transaction_consumed_total"]
-        total = cls.section_stats["transaction_total"]
         blf.position(font_id, base_x + 10.0, base_y + 120.0, 0)
         blf.size(font_id, 12)
-        blf.draw(font_id, f"({consumed}/{total})")
+        blf.draw(font_id, cls.status_texts[0])
 
         # Draw process transaction.
-        count = 0
-        for item in cls.transaction_ids.values():
-            if count >= 5:
-                break
-            ts_type = item["type"]
-            ts_title = item["title"]
+        for count, text in enumerate(cls.status_texts[1:]):
             blf.position(
-                font_id, base_x + 10.0, base_y + 100.0 - count * 20.0, 0)
-            blf.draw(font_id, f"[{ts_type}] {ts_title}")
-            count += 1
+                font_id, base_x + 10.0,
+                base_y + STATUS_LINE_START_Y - count * STATUS_LINE_HEIGHT, 0)
+            blf.draw(font_id, text)
+
+        # Draw usage.
+        blf.color(font_id, 0.7, 0.7, 0.7, 1.0)
+        blf.position(font_id, base_x + 10.0, base_y + 4.0, 0)
+        blf.size(font_id, 10)
+        blf.draw(font_id, "ESC: Cancel the request under the cursor")
 
     def execute(self, context):
         cls = self.__class__
@@ -278,22 +448,30 @@ class OPENAI_OT_ProcessMessage(bpy.types.Operator):
         cls.section_stats["transaction_total"] += 1
 
         if cls.timer:
+            cls.update_status_texts()
             return {'FINISHED'}
 
         # Initialize statistics.
         cls.section_stats["transaction_total"] = 1
         cls.section_stats["transaction_consumed_total"] = 0
+        cls.update_status_texts()
 
-        cls.timer = wm.event_timer_add(0.1, window=context.window)
+        cls.timer = wm.event_timer_add(MESSAGE_TIMER_MIN_INTERVAL,
+                                       window=context.window)
+        cls.timer_interval = MESSAGE_TIMER_MIN_INTERVAL
         wm.modal_handler_add(self)
         if prefs.show_request_status:
-            if context.space_data.type in ('VIEW_3D', 'IMAGE_EDITOR',
-                                           'SEQUENCE_EDITOR', 'TEXT_EDITOR'):
+            if context.space_data is not None and \
+                    context.space_data.type in ('VIEW_3D', 'IMAGE_EDITOR',
+                                                'SEQUENCE_EDITOR',
+                                                'TEXT_EDITOR'):
                 cls.draw_cb["space_data"] = context.space_data
                 cls.draw_cb["handler"] = context.space_data.draw_handler_add(
                     cls.draw_status, (context, ), 'WINDOW', 'POST_PIXEL')
+                cls.draw_cb["area_type"] = context.space_data.type
             else:
                 cls.draw_cb["space_data"] = bpy.types.SpaceView3D
+                cls.draw_cb["area_type"] = 'VIEW_3D'
                 cls.draw_cb["handler"] = \
                     bpy.types.SpaceView3D.draw_handler_add(
                         cls.draw_status, (context, ), 'WINDOW', 'POST_PIXEL')
@@ -306,42 +484,770 @@ class OPENAI_OT_ProcessMessage(bpy.types.Operator):
         return {'RUNNING_MODAL'}
 
 
-class RequestHandler:
-
-    request_queue = []
-    request_queue_lock = None
-    send_loop_thread = None
+# Request types which are grouped to limit the number of concurrent requests.
+REQUEST_CATEGORIES = {
+    'GENERATE_IMAGE': 'IMAGE',
+    'EDIT_IMAGE': 'IMAGE',
+    'GENERATE_VARIATION_IMAGE': 'IMAGE',
+    'TRANSCRIBE_AUDIO': 'AUDIO',
+    'CHAT': 'CHAT',
+    'GENERATE_CODE': 'CODE',
+    'EDIT_CODE': 'CODE',
+    'GENERATE_CODE_FROM_AUDIO': 'CODE',
+}
+DEFAULT_NUM_WORKERS = 4
+# OpenAI API generates up to 10 images at once.
+NUM_DOWNLOAD_WORKERS = 10
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Minimum interval (seconds) to save the partial response of the streaming.
+STREAM_CHECKPOINT_INTERVAL = 0.25
+# The requests are served in the order of the virtual deadline, which is
+# the time of arrival plus the delay of the priority and the size class.
+# The delay lets the interactive requests preempt the background requests,
+# and the background requests are served after the delay at the latest.
+REQUEST_PRIORITY_DELAYS = {
+    'INTERACTIVE': 0.0,
+    'NORMAL': 10.0,
+    'BACKGROUND': 60.0,
+}
+DEFAULT_REQUEST_PRIORITY = 'NORMAL'
+# Number of estimated prompt tokens in a scheduling size class, and the
+# delay (seconds) per size class.
+REQUEST_SIZE_CLASS_TOKENS = 256
+REQUEST_SIZE_CLASS_DELAY = 1.0
+# Identical requests of these types in flight are sent only once.
+SINGLE_FLIGHT_REQUEST_TYPES = {'CHAT', 'GENERATE_CODE', 'EDIT_CODE'}
+# Model used by the image endpoints when no model is specified.
+DEFAULT_IMAGE_MODEL = "dall-e-2"
+# Seconds to block the endpoint when 429 response has no Retry-After.
+RATE_LIMIT_DEFAULT_RETRY_AFTER = 1.0
+# Retry policy for the transient failures. The delay before the n-th retry
+# is chosen randomly from [0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2^n)].
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# Maximum delay (seconds) before the retry of the synchronous request, which
+# blocks the main thread. The request fails if the server asks to wait
+# longer.
+SYNC_RETRY_MAX_DELAY = 3.0
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+# Connect and read timeouts (seconds) per endpoint. The read timeout of the
+# streaming is the maximum interval between the chunks.
+REQUEST_TIMEOUTS = {
+    "images/generations": (10.0, 120.0),
+    "images/edits": (10.0, 120.0),
+    "images/variations": (10.0, 120.0),
+    "audio/transcriptions": (10.0, 300.0),
+    "chat/completions": (10.0, 120.0),
+}
+DEFAULT_REQUEST_TIMEOUT = (10.0, 120.0)
+DOWNLOAD_TIMEOUT = (10.0, 60.0)
+DEFAULT_CONCURRENCY_LIMITS = {
+    'IMAGE': 4,
+    'AUDIO': 1,
+    'CHAT': 2,
+    'CODE': 2,
+}
+
+
+class RequestCancelledError(Exception):
+    pass
+
+
+class RequestHandlerStoppedError(Exception):
+    pass
+
+
+class RequestDeferredError(Exception):
+    # The request is sent again after the delay.
+
+    def __init__(self, delay):
+        super().__init__(f"Request is deferred for {delay:.1f} seconds")
+        self.delay = delay
+
+
+@contextlib.contextmanager
+def open_multipart_files(fields):
+    # The file field of multipart/form-data is given as (filename, filepath)
+    # instead of the file object, so that the request can be sent again.
+    # The other fields are given as (None, value).
+    files = []
+    try:
+        opened_fields = {}
+        for name, (filename, value) in fields.items():
+            if filename is None:
+                opened_fields[name] = (filename, value)
+                continue
+            f = open(value, "rb")   # pylint: disable=R1732
+            files.append(f)
+            opened_fields[name] = (filename, f)
+        yield opened_fields
+    finally:
+        for f in files:
+            f.close()
+
+
+def parse_retry_after(response):
+    if response is None:
+        return None
+    retry_after = response.headers.get("retry-after")
+    if retry_after is None:
+        return None
+    # Retry-After is capped so that the server cannot block the requests
+    # for a long time.
+    try:
+        return min(max(0.0, float(retry_after)), RETRY_MAX_DELAY)
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return min(max(0.0, retry_date.timestamp() - time.time()),
+               RETRY_MAX_DELAY)
+
+
+def is_retryable_error(exception):
+    if isinstance(exception, requests.HTTPError):
+        return exception.response is not None and \
+            exception.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(exception, (requests.ConnectionError,
+                                  requests.Timeout,
+                                  requests.exceptions.ChunkedEncodingError))
+
+
+def get_retry_delay(attempt, exception, max_delay=RETRY_MAX_DELAY):
+    # Capped exponential backoff with full jitter. Retry-After of the
+    # response takes precedence if it is longer.
+    delay = random.uniform(
+        0.0, min(max_delay, RETRY_BASE_DELAY * (2 ** attempt)))
+    retry_after = parse_retry_after(getattr(exception, "response", None))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class RequestHandler:    # pylint: disable=R0904
+
+    # Pending requests are queued per category so that a request whose
+    # category is at the concurrency limit does not block the others.
+    request_queues = {}
+    request_queue_cond = None
+    request_sequence = itertools.count()
+    # Single-flight: key -> transaction IDs subscribing to the in-flight
+    # request, and transaction ID of the in-flight request -> key.
+    inflight_followers = {}
+    inflight_keys = {}
+    inflight_lock = threading.Lock()
+    # Transactions which have not received END_OF_TRANSACTION yet, and the
+    # cancelled transactions whose request is sent by the workers.
+    active_transaction_ids = set()
+    cancelled_transaction_ids = set()
+    worker_local = threading.local()
+    worker_threads = {}
+    download_executor = None
+    num_workers = DEFAULT_NUM_WORKERS
+    concurrency_limits = dict(DEFAULT_CONCURRENCY_LIMITS)
+    running_requests = {}
+    # Incremented when the queues are changed.
+    queue_version = 0
+    # Heap of (time to send, sequence number, request) to be retried.
+    delayed_requests = []
     should_stop = True
+    stop_event = threading.Event()
+    # Topic -> lock to serialize the writers of the chat topic.
+    topic_locks = {}
+    topic_locks_lock = threading.Lock()
+
+    @classmethod
+    def get_topic_lock(cls, topic):
+        with cls.topic_locks_lock:
+            if topic not in cls.topic_locks:
+                cls.topic_locks[topic] = threading.Lock()
+            return cls.topic_locks[topic]
+
+    @classmethod
+    def make_single_flight_key(cls, request):
+        api_key, _, req_type, req_data, options, _ = request
+        if req_type not in SINGLE_FLIGHT_REQUEST_TYPES:
+            return None
+        body = json.dumps([api_key, req_type, req_data, options],
+                          sort_keys=True, default=str)
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()
 
     @classmethod
     def add_request(cls, request):
-        with cls.request_queue_lock:    # pylint: disable=E1129
-            cls.request_queue.append(request)
+        # Subscribe to the in-flight request if the same request is sent.
+        key = cls.make_single_flight_key(request)
+        with cls.inflight_lock:
+            cls.active_transaction_ids.add(request[1])
+            if key is not None:
+                if key in cls.inflight_followers:
+                    cls.inflight_followers[key].append(request[1])
+                    return
+                cls.inflight_followers[key] = []
+                cls.inflight_keys[request[1]] = key
+
+        size_class = request[4].get("estimated_prompt_tokens", 0) // \
+            REQUEST_SIZE_CLASS_TOKENS
+        deadline = cls.get_virtual_deadline(
+            request, time.monotonic() + size_class * REQUEST_SIZE_CLASS_DELAY)
+        cls.enqueue_request(request, deadline, next(cls.request_sequence))
 
     @classmethod
-    def start(cls):
+    def get_virtual_deadline(cls, request, arrival_time):
+        priority = request[5].get("priority", DEFAULT_REQUEST_PRIORITY)
+        return arrival_time + REQUEST_PRIORITY_DELAYS[priority]
+
+    @classmethod
+    def enqueue_request(cls, request, deadline, seq):
+        category = REQUEST_CATEGORIES[request[2]]
+        with cls.request_queue_cond:    # pylint: disable=E1129
+            heapq.heappush(
+                cls.request_queues[category], (deadline, seq, request))
+            cls.queue_version += 1
+            # The reserved worker does not take the background request, so
+            # all workers need to check the queue.
+            cls.request_queue_cond.notify_all()
+
+    @classmethod
+    def configure(cls, num_workers, concurrency_limits):
+        cls.num_workers = num_workers
+        cls.concurrency_limits = dict(concurrency_limits)
+        if cls.should_stop:
+            return
+
+        # Wake up the waiting workers so that the workers whose index
+        # exceeds the number of workers terminate and the new limits are
+        # applied.
+        with cls.request_queue_cond:    # pylint: disable=E1129
+            cls.request_queue_cond.notify_all()
+
+        # Launch the missing workers. The busy workers whose index exceeds
+        # the number of workers will terminate after the current request.
+        for index in range(num_workers):
+            thread = cls.worker_threads.get(index)
+            if thread is not None and thread.is_alive():
+                continue
+            thread = threading.Thread(
+                target=cls.send_loop, args=(index, ),
+                name=f"OpenAIBridgeWorker-{index}")
+            cls.worker_threads[index] = thread
+            thread.start()
+
+    @classmethod
+    def start(cls, num_workers=DEFAULT_NUM_WORKERS,
+              concurrency_limits=None):
         print("RequestHandler is started.")
-        cls.send_loop_thread = threading.Thread(target=cls.send_loop)
-        cls.request_queue_lock = threading.Lock()
+        if concurrency_limits is None:
+            concurrency_limits = DEFAULT_CONCURRENCY_LIMITS
+        cls.request_queue_cond = threading.Condition()
+        cls.request_queues = {
+            category: [] for category in DEFAULT_CONCURRENCY_LIMITS
+        }
+        cls.running_requests = {
+            category: 0 for category in DEFAULT_CONCURRENCY_LIMITS
+        }
+        cls.download_executor = ThreadPoolExecutor(
+            max_workers=NUM_DOWNLOAD_WORKERS,
+            thread_name_prefix="OpenAIBridgeDownload")
         cls.should_stop = False
-        cls.send_loop_thread.start()
+        cls.stop_event.clear()
+        cls.configure(num_workers, concurrency_limits)
 
     @classmethod
     def stop(cls):
-        cls.should_stop = True
-        while cls.send_loop_thread.is_alive():
-            print(".", end="")
-            time.sleep(1)
-            continue
+        with cls.request_queue_cond:    # pylint: disable=E1129
+            cls.should_stop = True
+            cls.request_queue_cond.notify_all()
+        cls.stop_event.set()
+        for thread in cls.worker_threads.values():
+            while thread.is_alive():
+                print(".", end="")
+                time.sleep(1)
+                continue
         print()
-        cls.request_queue_lock = None
-        cls.request_queue = []
-        cls.send_loop_thread = None
+        cls.download_executor.shutdown(wait=True)
+        cls.download_executor = None
+        # The files of the queued requests are kept only if the requests
+        # can be resumed from the journal.
+        queues = list(cls.request_queues.values()) + [cls.delayed_requests]
+        for _, _, request in itertools.chain.from_iterable(queues):
+            with cls.inflight_lock:
+                resumable = RequestJournal.enabled() and \
+                    request[1] in cls.active_transaction_ids
+            if not resumable:
+                cls.cleanup_request(request)
+        cls.request_queue_cond = None
+        cls.request_queues = {}
+        cls.delayed_requests = []
+        close_sessions()
+        cls.worker_threads = {}
         print("RequestHandler is stopped.")
 
+    @classmethod
+    def is_reserved_worker(cls, worker_index):
+        # The last worker is reserved for the interactive requests, so that
+        # they do not wait for the long background requests.
+        return cls.num_workers > 1 and worker_index == cls.num_workers - 1
+
+    @classmethod
+    def pop_request(cls, worker_index):
+        # Pick the request with the earliest virtual deadline whose category
+        # has a free slot.
+        # This must be called with request_queue_cond acquired.
+        interactive_only = cls.is_reserved_worker(worker_index)
+        target = None
+        target_index = None
+        for category, queue in cls.request_queues.items():
+            if len(queue) == 0:
+                continue
+            limit = cls.concurrency_limits.get(category, cls.num_workers)
+            if cls.running_requests[category] >= limit:
+                continue
+            if interactive_only:
+                indices = [
+                    i for i, item in enumerate(queue)
+                    if item[2][5].get("priority") == 'INTERACTIVE'
+                ]
+                if not indices:
+                    continue
+                index = min(indices, key=lambda i, q=queue: q[i][:2])
+            else:
+                index = 0
+            if target is None or queue[index][:2] < \
+                    cls.request_queues[target][target_index][:2]:
+                target = category
+                target_index = index
+        if target is None:
+            return None
+
+        cls.running_requests[target] += 1
+        queue = cls.request_queues[target]
+        if target_index == 0:
+            _, _, request = heapq.heappop(queue)
+        else:
+            _, _, request = queue.pop(target_index)
+            heapq.heapify(queue)
+        cls.queue_version += 1
+        return request
+
+    @classmethod
+    def get_queue_positions(cls):
+        # Returns the position in the queues (1 is the next) of the
+        # transactions waiting to be sent.
+        with cls.request_queue_cond:    # pylint: disable=E1129
+            items = []
+            for queue in cls.request_queues.values():
+                items.extend(queue)
+        items.sort(key=lambda item: item[:2])
+        positions = {}
+        with cls.inflight_lock:
+            for position, (_, _, request) in enumerate(items, 1):
+                transaction_id = request[1]
+                if transaction_id in cls.active_transaction_ids:
+                    positions[transaction_id] = position
+                key = cls.inflight_keys.get(transaction_id)
+                if key is not None:
+                    for follower_id in cls.inflight_followers[key]:
+                        positions[follower_id] = position
+        return positions
+
+    @classmethod
+    def schedule_retry(cls, request, exception):
+        state = request[5]
+        attempt = state.get("attempt", 0)
+        if attempt >= MAX_RETRIES or not is_retryable_error(exception):
+            return False
+        if cls.is_abandoned(request[1]):
+            return False
+        state["attempt"] = attempt + 1
+        MetricsRegistry.inc("openai_bridge_retries_total", type=request[2])
+
+        delay = get_retry_delay(attempt, exception)
+        print(f"Retry request {request[1]} in {delay:.1f} seconds "
+              f"({attempt + 1}/{MAX_RETRIES}): {exception}")
+        cls.defer_request(request, delay)
+        return True
+
+    @classmethod
+    def defer_request(cls, request, delay):
+        LatencyRecorder.requeue(request[1])
+        with cls.request_queue_cond:    # pylint: disable=E1129
+            heapq.heappush(
+                cls.delayed_requests,
+                (time.monotonic() + delay, next(cls.request_sequence),
+                 request))
+            # Let the waiting workers wake up at the time to send.
+            cls.request_queue_cond.notify_all()
+
+    @classmethod
+    def enqueue_delayed_requests(cls):
+        # This must be called with request_queue_cond acquired.
+        # Returns the seconds until the next delayed request gets ready.
+        now = time.monotonic()
+        while cls.delayed_requests:
+            send_time, seq, request = cls.delayed_requests[0]
+            if send_time > now:
+                return send_time - now
+            heapq.heappop(cls.delayed_requests)
+            category = REQUEST_CATEGORIES[request[2]]
+            heapq.heappush(
+                cls.request_queues[category],
+                (cls.get_virtual_deadline(request, send_time), seq, request))
+            cls.queue_version += 1
+        return None
+
+    @classmethod
+    def wait_request(cls, worker_index):
+        with cls.request_queue_cond:    # pylint: disable=E1129
+            while True:
+                if cls.should_stop or worker_index >= cls.num_workers:
+                    return None
+                timeout = cls.enqueue_delayed_requests()
+                request = cls.pop_request(worker_index)
+                if request is not None:
+                    return request
+                cls.request_queue_cond.wait(timeout)
+
+    @classmethod
+    def post_message(cls, transaction_id, type_, data, options, exec_params):
+        if transaction_id is None:
+            # Synchronous request.
+            OPENAI_OT_ProcessMessage.process(
+                transaction_id, type_, data, options, exec_params)
+            return
+
+        # Post the message to the subscribers of the request too.
+        # The cancelled transactions do not receive the messages anymore.
+        # The messages are posted with the lock acquired so that no message
+        # is posted after the END_OF_TRANSACTION posted by cancel().
+        with cls.inflight_lock:
+            key = cls.inflight_keys.get(transaction_id)
+            if key is None:
+                followers = []
+            elif type_ == 'END_OF_TRANSACTION':
+                # No one can subscribe to the finished request.
+                followers = cls.inflight_followers.pop(key)
+                del cls.inflight_keys[transaction_id]
+            else:
+                followers = list(cls.inflight_followers[key])
+
+            receivers = [
+                id_ for id_ in [transaction_id] + followers
+                if id_ in cls.active_transaction_ids
+            ]
+            if type_ == 'END_OF_TRANSACTION':
+                cls.active_transaction_ids.difference_update(receivers)
+
+            for i, receiver_id in enumerate(receivers):
+                if i == 1 and data and "usage_stats" in data:
+                    # Usage is counted only once.
+                    data = dict(data)
+                    del data["usage_stats"]
+                OPENAI_OT_ProcessMessage.process(
+                    receiver_id, type_, data, options, exec_params)
+
+        if type_ == 'END_OF_TRANSACTION':
+            # The finished transactions are not resumed.
+            for id_ in [transaction_id] + followers:
+                RequestJournal.remove(id_)
+
+    @classmethod
+    def cancel(cls, transaction_id):
+        """Cancel the transaction and return True if it is cancelled.
+
+        The queued request is dropped and the in-flight request is aborted
+        at the next check, unless the other transactions subscribe to it.
+        """
+
+        with cls.inflight_lock:
+            if transaction_id not in cls.active_transaction_ids:
+                return False
+            cls.active_transaction_ids.remove(transaction_id)
+            sender_id = transaction_id
+            for key, followers in cls.inflight_followers.items():
+                if transaction_id in followers:
+                    followers.remove(transaction_id)
+                    sender_id = next(
+                        id_ for id_, k in cls.inflight_keys.items()
+                        if k == key)
+                    break
+            else:
+                cls.cancelled_transaction_ids.add(transaction_id)
+            request = cls.remove_abandoned_request(sender_id)
+        RequestJournal.remove(transaction_id)
+        if request is not None:
+            cls.cleanup_request(request)
+
+        OPENAI_OT_ProcessMessage.process(
+            transaction_id, 'END_OF_TRANSACTION', None, None,
+            {"sync": False})
+        with cls.request_queue_cond:    # pylint: disable=E1129
+            # Let the worker drop the cancelled request soon.
+            cls.request_queue_cond.notify()
+        return True
+
+    @classmethod
+    def remove_abandoned_request(cls, transaction_id):
+        # Drop the queued request which no one waits for, so that it is not
+        # counted in the queue positions. Returns the dropped request.
+        # This must be called with inflight_lock acquired.
+        if transaction_id not in cls.cancelled_transaction_ids:
+            return None
+        key = cls.inflight_keys.get(transaction_id)
+        if key is not None and len(cls.inflight_followers[key]) > 0:
+            return None
+        request = cls.remove_queued_request(transaction_id)
+        if request is not None and key is not None:
+            del cls.inflight_keys[transaction_id]
+            del cls.inflight_followers[key]
+        return request
+
+    @classmethod
+    def remove_queued_request(cls, transaction_id):
+        # Returns the removed request, or None if the request is not queued.
+        with cls.request_queue_cond:    # pylint: disable=E1129
+            queues = list(cls.request_queues.values()) + \
+                [cls.delayed_requests]
+            for queue in queues:
+                for index, (_, _, request) in enumerate(queue):
+                    if request[1] != transaction_id:
+                        continue
+                    queue.pop(index)
+                    heapq.heapify(queue)
+                    cls.queue_version += 1
+                    return request
+        return None
+
+    @classmethod
+    def cancel_all(cls):
+        with cls.inflight_lock:
+            transaction_ids = list(cls.active_transaction_ids)
+        num_cancelled = 0
+        for transaction_id in transaction_ids:
+            if cls.cancel(transaction_id):
+                num_cancelled += 1
+        return num_cancelled
+
+    @classmethod
+    def is_abandoned(cls, transaction_id):
+        # The request is abandoned if its transaction is cancelled and no one
+        # subscribes to the request.
+        with cls.inflight_lock:
+            if transaction_id not in cls.cancelled_transaction_ids:
+                return False
+            key = cls.inflight_keys.get(transaction_id)
+            return key is None or len(cls.inflight_followers[key]) == 0
+
+    @classmethod
+    def check_cancelled(cls):
+        transaction_id = getattr(cls.worker_local, "transaction_id", None)
+        if transaction_id is not None and cls.is_abandoned(transaction_id):
+            raise RequestCancelledError(
+                f"Request {transaction_id} is cancelled")
+
+    @classmethod
+    def cleanup_request(cls, request):
+        for filepath in request[4].get("temp_filepaths", []):
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        with cls.inflight_lock:
+            cls.cancelled_transaction_ids.discard(request[1])
+
+    @classmethod
+    def finish_request(cls, request):
+        category = REQUEST_CATEGORIES[request[2]]
+        with cls.request_queue_cond:    # pylint: disable=E1129
+            cls.running_requests[category] -= 1
+            # A free slot may allow a queued request to be sent.
+            cls.request_queue_cond.notify_all()
+
+    @classmethod
+    @contextlib.contextmanager
+    def measure(cls, stage, category="request"):
+        # Measure the stage of the transaction handled by this worker.
+        transaction_id = getattr(cls.worker_local, "transaction_id", None)
+        with LatencyRecorder.stage(transaction_id, stage), \
+                Tracer.span(stage, category):
+            yield
+
+    @classmethod
+    def decode_json(cls, response):
+        with Tracer.span("json decode", "json"):
+            return response.json()
+
+    @classmethod
+    def sleep(cls, seconds):
+        if seconds <= 0.0:
+            return
+        if cls.stop_event.wait(seconds):
+            raise RequestHandlerStoppedError("RequestHandler is stopped")
+
+    @classmethod
+    def send_api_request(cls, session, endpoint, model, num_tokens=0,
+                         files=None, **kwargs):
+        # Pace the request by the rate limiter. The request rejected by the
+        # rate limit of the server will be retried by send_loop.
+        url = f"{API_BASE_URL}/{endpoint}"
+        state = getattr(cls.worker_local, "request_state", None)
+        reserved = state is not None and \
+            state.pop("rate_limit_reserved", None) == [endpoint, model]
+        wait_time = RateLimiter.acquire(
+            endpoint, model, num_tokens, reserved)
+        if wait_time > 0.0:
+            if state is not None:
+                # Release the worker and the slot of the category while
+                # waiting. The reservation is kept for the next attempt.
+                state["rate_limit_reserved"] = [endpoint, model]
+                raise RequestDeferredError(wait_time)
+            with cls.measure("rate_limit"):
+                cls.sleep(wait_time)
+        cls.check_cancelled()
+        kwargs.setdefault(
+            "timeout", REQUEST_TIMEOUTS.get(endpoint, DEFAULT_REQUEST_TIMEOUT))
+        MetricsRegistry.inc("openai_bridge_requests_total", endpoint=endpoint)
+        start_time = time.monotonic()
+        try:
+            with cls.measure(f"http {endpoint}", "http"):
+                if files is None:
+                    response = session.post(url, **kwargs)
+                else:
+                    with open_multipart_files(files) as opened_files:
+                        response = session.post(
+                            url, files=opened_files, **kwargs)
+        except requests.RequestException as e:
+            MetricsRegistry.inc("openai_bridge_request_errors_total",
+                                endpoint=endpoint, status=type(e).__name__)
+            raise
+        if MetricsRegistry.enabled:
+            cls.update_request_metrics(
+                endpoint, response, time.monotonic() - start_time,
+                kwargs.get("stream", False))
+        RateLimiter.update(endpoint, model, response.headers)
+        if response.status_code == 429:
+            retry_after = parse_retry_after(response)
+            if retry_after is None:
+                retry_after = RATE_LIMIT_DEFAULT_RETRY_AFTER
+            RateLimiter.penalize(endpoint, model, retry_after)
+        try:
+            cls.check_cancelled()
+        except RequestCancelledError:
+            response.close()
+            raise
+        return response
+
+    @classmethod
+    def update_request_metrics(cls, endpoint, response, duration, stream):
+        MetricsRegistry.observe(
+            "openai_bridge_request_duration_seconds", duration,
+            endpoint=endpoint)
+        if response.status_code >= 400:
+            MetricsRegistry.inc("openai_bridge_request_errors_total",
+                                endpoint=endpoint,
+                                status=str(response.status_code))
+        body = response.request.body
+        if isinstance(body, str):
+            # Count the bytes instead of the characters.
+            body = body.encode("utf-8")
+        if body is not None:
+            MetricsRegistry.inc("openai_bridge_sent_bytes_total", len(body),
+                                endpoint=endpoint)
+        if not stream:
+            # The streamed response is counted while it is read.
+            MetricsRegistry.inc("openai_bridge_received_bytes_total",
+                                len(response.content), endpoint=endpoint)
+
+    @classmethod
+    def download_image(cls, session, proxies, download_url, filepath,
+                       transaction_id=None):
+        # The image is written while it is downloaded.
+        with LatencyRecorder.stage(transaction_id, "download"), \
+                Tracer.span("download", "http"), \
+                session.get(download_url, proxies=proxies, stream=True,
+                            timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            content_type = response.headers["content-type"]
+            if "image" not in content_type:
+                raise RuntimeError(f"Invalid content-type '{content_type}'")
+
+            # Save image.
+            with open(filepath, "wb") as f:
+                for chunk in response.iter_content(
+                        chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    MetricsRegistry.inc("openai_bridge_received_bytes_total",
+                                        len(chunk), endpoint="download")
+
+        return filepath
+
+    @classmethod
+    def download_images(cls, session, proxies, downloads, image_size,
+                        transaction_id, options, exec_params, state):
+        # The images saved by the previous attempt are not downloaded again.
+        # They are loaded again only if the request is resumed by the new
+        # session.
+        downloaded_filepaths = state.setdefault("downloaded_filepaths", [])
+        resumed = state.pop("resumed", False)
+        remaining_downloads = []
+        for download_url, filepath in downloads:
+            if filepath not in downloaded_filepaths:
+                remaining_downloads.append((download_url, filepath))
+            elif resumed and os.path.exists(filepath):
+                cls.post_message(
+                    transaction_id, 'IMAGE', {"filepath": filepath},
+                    options, exec_params)
+
+        # Download all images at once and post each image as soon as it
+        # is saved.
+        os.makedirs(f"{IMAGE_DATA_DIR}/generated", exist_ok=True)
+        futures = [
+            cls.download_executor.submit(
+                cls.download_image, session, proxies, download_url, filepath,
+                transaction_id)
+            for download_url, filepath in remaining_downloads
+        ]
+        try:
+            for future in as_completed(futures):
+                filepath = future.result()
+                downloaded_filepaths.append(filepath)
+                RequestJournal.update_state(transaction_id, state)
+                cls.check_cancelled()
+
+                usage_stats = {
+                    'IMAGE': {
+                        "size": image_size,
+                        "num_images": 1,
+                    },
+                }
+
+                cls.post_message(
+                    transaction_id, 'IMAGE',
+                    {"filepath": filepath, "usage_stats": usage_stats},
+                    options, exec_params)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    @classmethod
+    def send_image_request(cls, session, endpoint, transaction_id, state,
+                           **kwargs):
+        # The URLs of the generated images are journaled so that the images
+        # are not generated again by the retry or the resumed request.
+        if "image_urls" not in state:
+            response = cls.send_api_request(
+                session, endpoint, DEFAULT_IMAGE_MODEL, **kwargs)
+            response.raise_for_status()
+            state["image_urls"] = [
+                data["url"] for data in cls.decode_json(response)["data"]
+            ]
+            RequestJournal.update_state(transaction_id, state)
+        return state["image_urls"]
+
     @classmethod
     def handle_generate_image_request(
-            cls, api_key, transaction_id, req_data, options, exec_params):
+            cls, api_key, transaction_id, req_data, options, exec_params,
+            state):
         # Send prompt.
         headers = {
             "Content-Type": "application/json",
@@ -351,53 +1257,32 @@ class RequestHandler:
             "http": options["http_proxy"],
             "https": options["https_proxy"],
         }
-        response = requests.post(
-            "https://api.openai.com/v1/images/generations",
+        session = get_session(proxies)
+        image_urls = cls.send_image_request(
+            session, "images/generations", transaction_id, state,
             headers=headers, data=json.dumps(req_data), proxies=proxies)
-        response.raise_for_status()
-        response_data = response.json()
-
-        # Download image.
-        for i, data in enumerate(response_data["data"]):
-            download_url = data["url"]
-            response = requests.get(download_url, proxies=proxies)
-            response.raise_for_status()
-            content_type = response.headers["content-type"]
-            if "image" not in content_type:
-                raise RuntimeError(f"Invalid content-type '{content_type}'")
-            image_data = response.content
 
-            # Save image
-            dirname = f"{IMAGE_DATA_DIR}/generated"
-            os.makedirs(dirname, exist_ok=True)
+        # Download images.
+        dirname = f"{IMAGE_DATA_DIR}/generated"
+        downloads = []
+        for i, download_url in enumerate(image_urls):
             if options["auto_image_name"]:
                 filename = urlparse(download_url).path.split("/")[-1]
             else:
                 filename = f"{options['image_name']}.png"
                 if i >= 1:
                     filename = f"{filename}-{i}"
-            filepath = f"{dirname}/{filename}"
-            with open(filepath, "wb") as f:
-                f.write(image_data)
-
-            usage_stats = {
-                'IMAGE': {
-                    "size": req_data["size"],
-                    "num_images": 1,
-                },
-            }
-
-            OPENAI_OT_ProcessMessage.process(
-                transaction_id, 'IMAGE',
-                {"filepath": filepath, "usage_stats": usage_stats},
-                options, exec_params)
+            downloads.append((download_url, f"{dirname}/{filename}"))
+        cls.download_images(session, proxies, downloads, req_data["size"],
+                            transaction_id, options, exec_params, state)
 
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'END_OF_TRANSACTION', None, None, exec_params)
 
     @classmethod
     def handle_edit_image_request(
-            cls, api_key, transaction_id, req_data, options, exec_params):
+            cls, api_key, transaction_id, req_data, options, exec_params,
+            state):
         # Send prompt.
         headers = {
             "Authorization": f"Bearer {api_key}"
@@ -406,54 +1291,29 @@ class RequestHandler:
             "http": options["http_proxy"],
             "https": options["https_proxy"],
         }
-        response = requests.post("https://api.openai.com/v1/images/edits",
-                                 headers=headers, files=req_data,
-                                 proxies=proxies)
-        response.raise_for_status()
-        response_data = response.json()
-
-        # Download image.
-        for i, data in enumerate(response_data["data"]):
-            download_url = data["url"]
-            response = requests.get(download_url, proxies=proxies)
-            response.raise_for_status()
-            content_type = response.headers["content-type"]
-            if "image" not in content_type:
-                raise RuntimeError(f"Invalid content-type '{content_type}'")
-            image_data = response.content
+        session = get_session(proxies)
+        image_urls = cls.send_image_request(
+            session, "images/edits", transaction_id, state,
+            headers=headers, files=req_data, proxies=proxies)
 
-            # Save image
-            dirname = f"{IMAGE_DATA_DIR}/generated"
-            os.makedirs(dirname, exist_ok=True)
+        # Download images.
+        dirname = f"{IMAGE_DATA_DIR}/generated"
+        downloads = []
+        for i, download_url in enumerate(image_urls):
             filename = f"edit-{options['base_image_name']}.png"
             if i >= 1:
                 filename = f"{filename}-{i}"
-            filepath = f"{dirname}/{filename}"
-            with open(filepath, "wb") as f:
-                f.write(image_data)
-
-            # Remove temporary files.
-            os.remove(options["base_image_filepath"])
-            os.remove(options["mask_image_filepath"])
-
-            usage_stats = {
-                'IMAGE': {
-                    "size": req_data["size"],
-                    "num_images": 1,
-                },
-            }
-
-            OPENAI_OT_ProcessMessage.process(
-                transaction_id, 'IMAGE',
-                {"filepath": filepath, "usage_stats": usage_stats},
-                options, exec_params)
+            downloads.append((download_url, f"{dirname}/{filename}"))
+        cls.download_images(session, proxies, downloads, req_data["size"][1],
+                            transaction_id, options, exec_params, state)
 
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'END_OF_TRANSACTION', None, None, exec_params)
 
     @classmethod
     def handle_generate_variation_image_request(
-            cls, api_key, transaction_id, req_data, options, exec_params):
+            cls, api_key, transaction_id, req_data, options, exec_params,
+            state):
         # Send prompt.
         headers = {
             "Authorization": f"Bearer {api_key}"
@@ -462,53 +1322,29 @@ class RequestHandler:
             "http": options["http_proxy"],
             "https": options["https_proxy"],
         }
-        response = requests.post("https://api.openai.com/v1/images/variations",
-                                 headers=headers, files=req_data,
-                                 proxies=proxies)
-        response.raise_for_status()
-        response_data = response.json()
-
-        # Download image.
-        for i, data in enumerate(response_data["data"]):
-            download_url = data["url"]
-            response = requests.get(download_url, proxies=proxies)
-            response.raise_for_status()
-            content_type = response.headers["content-type"]
-            if "image" not in content_type:
-                raise RuntimeError(f"Invalid content-type '{content_type}'")
-            image_data = response.content
+        session = get_session(proxies)
+        image_urls = cls.send_image_request(
+            session, "images/variations", transaction_id, state,
+            headers=headers, files=req_data, proxies=proxies)
 
-            # Save image
-            dirname = f"{IMAGE_DATA_DIR}/generated"
-            os.makedirs(dirname, exist_ok=True)
+        # Download images.
+        dirname = f"{IMAGE_DATA_DIR}/generated"
+        downloads = []
+        for i, download_url in enumerate(image_urls):
             filename = f"variation-{options['base_image_name']}.png"
             if i >= 1:
                 filename = f"{filename}-{i}"
-            filepath = f"{dirname}/{filename}"
-            with open(filepath, "wb") as f:
-                f.write(image_data)
+            downloads.append((download_url, f"{dirname}/{filename}"))
+        cls.download_images(session, proxies, downloads, req_data["size"][1],
+                            transaction_id, options, exec_params, state)
 
-            # Remove temporary files.
-            os.remove(options["base_image_filepath"])
-
-            usage_stats = {
-                'IMAGE': {
-                    "size": req_data["size"],
-                    "num_images": 1,
-                },
-            }
-
-            OPENAI_OT_ProcessMessage.process(
-                transaction_id, 'IMAGE',
-                {"filepath": filepath, "usage_stats": usage_stats},
-                options, exec_params)
-
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'END_OF_TRANSACTION', None, None, exec_params)
 
     @classmethod
     def handle_transcribe_audio_request(
-            cls, api_key, transaction_id, req_data, options, exec_params):
+            cls, api_key, transaction_id, req_data, options, exec_params,
+            state):
         # Send audio.
         headers = {
             "Authorization": f"Bearer {api_key}"
@@ -517,11 +1353,16 @@ class RequestHandler:
             "http": options["http_proxy"],
             "https": options["https_proxy"],
         }
-        response = requests.post(
-            "https://api.openai.com/v1/audio/transcriptions",
-            headers=headers, files=req_data, proxies=proxies)
-        response.raise_for_status()
-        response_data = response.json()
+        session = get_session(proxies)
+        # The transcription is journaled so that the resumed request does
+        # not send the audio again.
+        if "transcription" not in state:
+            response = cls.send_api_request(
+                session, "audio/transcriptions", req_data["model"][1],
+                headers=headers, files=req_data, proxies=proxies)
+            response.raise_for_status()
+            state["transcription"] = cls.decode_json(response)["text"]
+            RequestJournal.update_state(transaction_id, state)
 
         usage_stats = {}
         if "strip_start" in options and "strip_end" in options:
@@ -534,34 +1375,193 @@ class RequestHandler:
             }
 
         # Post message.
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'AUDIO',
-            {"text": response_data["text"], "usage_stats": usage_stats},
+            {"text": state["transcription"], "usage_stats": usage_stats},
             options, exec_params)
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'END_OF_TRANSACTION', None, None, exec_params)
 
     @classmethod
-    def handle_chat_request(
-            cls, api_key, transaction_id, req_data, options, exec_params):
+    def send_chat_completion_request(cls, session, headers, proxies,
+                                     req_data, options,
+                                     partial_response_callback=None):
+        # Returns the response text, the number of tokens and the key to
+        # cache the response. The key is None if the response must not be
+        # cached. The caller caches the response by put_response_cache
+        # after the response is accepted.
+        cache_options = options.get("response_cache")
+        if cache_options is None:
+            response_text, num_tokens, _ = cls.post_chat_completion_request(
+                session, headers, proxies, req_data, options,
+                partial_response_callback)
+            return response_text, num_tokens, None
+
+        # The cached response costs no tokens.
+        key = ResponseCache.make_key(req_data)
+        with Tracer.span("response cache get", "io"):
+            data = ResponseCache.get(
+                key, cache_options["ttl"], cache_options["cache_dir"])
+        if data is not None:
+            MetricsRegistry.inc(
+                "openai_bridge_response_cache_requests_total", result="hit")
+            return data["text"], 0, None
+        MetricsRegistry.inc(
+            "openai_bridge_response_cache_requests_total", result="miss")
+
+        response_text, num_tokens, completed = \
+            cls.post_chat_completion_request(
+                session, headers, proxies, req_data, options,
+                partial_response_callback)
+        # The truncated response is not cached.
+        return response_text, num_tokens, key if completed else None
+
+    @classmethod
+    def send_journaled_chat_completion_request(
+            cls, session, headers, proxies, req_data, options,
+            transaction_id, state, partial_response_callback=None):
+        # The response is journaled before it is saved, so that the resumed
+        # request does not send the prompt again.
+        if "chat_response" in state:
+            response_text, num_tokens = state["chat_response"]
+            return response_text, num_tokens, None
+        response_text, num_tokens, cache_key = \
+            cls.send_chat_completion_request(
+                session, headers, proxies, req_data, options,
+                partial_response_callback)
+        state["chat_response"] = [response_text, num_tokens]
+        RequestJournal.update_state(transaction_id, state)
+        return response_text, num_tokens, cache_key
+
+    @classmethod
+    def put_response_cache(cls, key, response_text, options):
+        if key is None:
+            return
+        cache_options = options["response_cache"]
+        with Tracer.span("response cache put", "io"):
+            ResponseCache.put(
+                key, {"text": response_text}, cache_options["ttl"],
+                cache_options["max_size"], cache_options["cache_dir"])
+
+    @classmethod
+    def post_chat_completion_request(cls, session, headers, proxies,
+                                     req_data, options,
+                                     partial_response_callback=None):
+        endpoint = "chat/completions"
+        model = req_data["model"]
+        estimated_tokens = count_message_tokens(req_data["messages"])
+
+        if not options.get("stream", False):
+            response = cls.send_api_request(
+                session, endpoint, model, estimated_tokens, headers=headers,
+                data=json.dumps(req_data), proxies=proxies)
+            response.raise_for_status()
+            response_data = cls.decode_json(response)
+            choice = response_data["choices"][0]
+            response_text = choice["message"]["content"]
+            num_tokens = response_data["usage"]["total_tokens"]
+            RateLimiter.consume_tokens(
+                endpoint, model, num_tokens - estimated_tokens)
+            return response_text, num_tokens, \
+                choice.get("finish_reason") == "stop"
+
+        stream_req_data = dict(req_data)
+        stream_req_data["stream"] = True
+        stream_req_data["stream_options"] = {"include_usage": True}
+
+        text_chunks = []
+        num_tokens = 0
+        finish_reason = None
+        done = False
+        last_checkpoint = time.monotonic()
+        with cls.send_api_request(
+                session, endpoint, model, estimated_tokens, headers=headers,
+                data=json.dumps(stream_req_data), proxies=proxies,
+                stream=True) as response:
+            response.raise_for_status()
+            response.encoding = "utf-8"
+            # Parse server-sent events. Each event has a delta of the
+            # response text.
+            stream_start = time.monotonic()
+            stream_start_time = time.perf_counter()
+            received_bytes = 0
+            for line in response.iter_lines(decode_unicode=True):
+                cls.check_cancelled()
+                received_bytes += len(line) + 1
+                if not line.startswith("data:"):
+                    continue
+                event_data = line[len("data:"):].strip()
+                if event_data == "[DONE]":
+                    done = True
+                    break
+                chunk = json.loads(event_data)
+                if chunk.get("usage"):
+                    num_tokens = chunk["usage"]["total_tokens"]
+                for choice in chunk.get("choices", []):
+                    delta = choice.get("delta", {}).get("content")
+                    if delta:
+                        text_chunks.append(delta)
+                    if choice.get("finish_reason"):
+                        finish_reason = choice["finish_reason"]
+
+                if partial_response_callback is None:
+                    continue
+                now = time.monotonic()
+                if now - last_checkpoint >= STREAM_CHECKPOINT_INTERVAL:
+                    partial_response_callback("".join(text_chunks))
+                    last_checkpoint = now
+            LatencyRecorder.record(
+                getattr(cls.worker_local, "transaction_id", None), "stream",
+                stream_start, time.monotonic())
+            MetricsRegistry.inc("openai_bridge_received_bytes_total",
+                                received_bytes, endpoint=endpoint)
+            if Tracer.enabled:
+                Tracer.add_event(
+                    "stream", "http", stream_start_time, time.perf_counter(),
+                    {"bytes": received_bytes})
+
+        RateLimiter.consume_tokens(
+            endpoint, model, num_tokens - estimated_tokens)
+        # The stream may be closed before the end of the response.
+        return "".join(text_chunks), num_tokens, \
+            done and finish_reason == "stop"
+
+    @classmethod
+    def handle_chat_request(cls, api_key, transaction_id, req_data,
+                            options, exec_params, state):
         user_text = req_data["messages"][0]["content"]
         condition_texts = []
         for text in req_data["messages"][1:]:
             condition_texts.append(text["content"])
+        # Keep the original request data for the retry.
+        req_data = dict(req_data)
+        req_data["messages"] = list(req_data["messages"])
 
         # Save send text.
         dirname = f"{CHAT_DATA_DIR}/topics"
         os.makedirs(dirname, exist_ok=True)
         topic = options["topic"]
 
+        # The other requests may write the same topic in parallel.
+        topic_lock = cls.get_topic_lock(topic)
         chat_file = ChatTextFile()
-        if options["new_topic"]:
-            chat_file.new(topic)
-        else:
-            chat_file.load_from_topic(topic)
-        # Response data will be added later
-        chat_file.add_part(user_text, condition_texts, "")
-        chat_file.save()
+        with topic_lock:
+            if options["new_topic"] and "chat_part_id" not in state:
+                chat_file.new(topic)
+            else:
+                chat_file.load_from_topic(topic)
+            part = chat_file.get_part_index(state.get("chat_part_id"))
+            if part is not None:
+                # The part was added by the previous attempt.
+                chat_file.modify_part(part, response_data="")
+            else:
+                # Response data will be added later
+                state["chat_part_id"] = chat_file.add_part(
+                    user_text, condition_texts, "")
+            with cls.measure("write", "io"):
+                chat_file.save()
+        part_id = state["chat_part_id"]
+        RequestJournal.update_state(transaction_id, state)
 
         for condition in options["hidden_conditions"]:
             req_data["messages"].append({
@@ -569,24 +1569,19 @@ class RequestHandler:
                 "content": condition,
             })
 
-        additional_messages = []
-        for part in range(chat_file.num_parts() - 1):
-            additional_messages.append({
-                "role": "user",
-                "content": chat_file.get_user_data(part),
-            })
-            for condition in chat_file.get_condition_data(part):
-                additional_messages.append({
-                    "role": "system",
-                    "content": condition,
-                })
-            additional_messages.append({
-                "role": "assistant",
-                "content": chat_file.get_response_data(part),
-            })
-            req_data["messages"] = additional_messages + req_data["messages"]
-
-        OPENAI_OT_ProcessMessage.process(
+        # Prepend the conversation history which fits in the token budget.
+        # The history must not push the prompt out of the context window
+        # even if the budget is specified by the user.
+        token_budget = \
+            get_max_prompt_tokens(req_data["model"]) - \
+            count_message_tokens(req_data["messages"])
+        if options.get("history_token_budget", 0) > 0:
+            token_budget = min(token_budget, options["history_token_budget"])
+        req_data["messages"] = build_chat_history(
+            chat_file, chat_file.get_part_index(part_id), token_budget) + \
+            req_data["messages"]
+
+        cls.post_message(
             transaction_id, 'CHAT', {}, options, exec_params)
 
         # Send prompt.
@@ -598,35 +1593,50 @@ class RequestHandler:
             "http": options["http_proxy"],
             "https": options["https_proxy"],
         }
-        response = requests.post("https://api.openai.com/v1/chat/completions",
-                                 headers=headers, data=json.dumps(req_data),
-                                 proxies=proxies)
-        response.raise_for_status()
-        response_data = response.json()
-        response_text = response_data["choices"][0]["message"]["content"]
+        session = get_session(proxies)
+
+        def save_partial_response(response_text):
+            # Checkpoint the partial response so that the chat log shows it.
+            with topic_lock:
+                chat_file.modify_part(
+                    chat_file.get_part_index(part_id),
+                    response_data=response_text)
+                chat_file.save()
+            cls.post_message(
+                transaction_id, 'CHAT', {}, options, exec_params)
+
+        response_text, num_tokens, cache_key = \
+            cls.send_journaled_chat_completion_request(
+                session, headers, proxies, req_data, options,
+                transaction_id, state, save_partial_response)
 
         # Save response text.
-        chat_file.modify_part(
-            chat_file.num_parts() - 1, response_data=response_text)
-        chat_file.save()
+        with topic_lock:
+            chat_file.modify_part(
+                chat_file.get_part_index(part_id),
+                response_data=response_text)
+            with cls.measure("write", "io"):
+                chat_file.save()
+        cls.put_response_cache(cache_key, response_text, options)
 
         usage_stats = {
             'CHAT': {
                 "model": req_data["model"],
-                "num_tokens": response_data["usage"]["total_tokens"],
+                "num_tokens": num_tokens,
             },
         }
 
         # Post to message queue.
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'CHAT', {"usage_stats": usage_stats},
             options, exec_params)
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'END_OF_TRANSACTION', None, None, exec_params)
 
     @classmethod
     def handle_generate_code_request(
-            cls, api_key, transaction_id, req_data, options, exec_params):
+            cls, api_key, transaction_id, req_data, options, exec_params,
+            state):
         # Send prompt.
         headers = {
             "Content-Type": "application/json",
@@ -636,12 +1646,11 @@ class RequestHandler:
             "http": options["http_proxy"],
             "https": options["https_proxy"],
         }
-        response = requests.post("https://api.openai.com/v1/chat/completions",
-                                 headers=headers, data=json.dumps(req_data),
-                                 proxies=proxies)
-        response.raise_for_status()
-        response_data = response.json()
-        response_text = response_data["choices"][0]["message"]["content"]
+        session = get_session(proxies)
+        response_text, num_tokens, cache_key = \
+            cls.send_journaled_chat_completion_request(
+                session, headers, proxies, req_data, options,
+                transaction_id, state)
 
         # Get code body.
         sections = parse_response_data(response_text)
@@ -656,73 +1665,80 @@ class RequestHandler:
 
         os.makedirs(CODE_DATA_DIR, exist_ok=True)
         filepath = f"{CODE_DATA_DIR}/{options['code']}.py"
-        with open(filepath, "w", encoding="utf-8") as f:
+        with cls.measure("write", "io"), \
+                open(filepath, "w", encoding="utf-8") as f:
             f.write(code_body)
+        # Cache the response after the code is extracted successfully.
+        cls.put_response_cache(cache_key, response_text, options)
 
         usage_stats = {
             'CODE': {
                 "model": req_data["model"],
-                "num_tokens": response_data["usage"]["total_tokens"],
+                "num_tokens": num_tokens,
             },
         }
 
         # Post to message queue.
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'CODE', {"usage_stats": usage_stats},
             options, exec_params)
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'END_OF_TRANSACTION', None, None, exec_params)
 
     @classmethod
     def handle_edit_code_request(
-            cls, api_key, transaction_id, req_data, options, exec_params):
+            cls, api_key, transaction_id, req_data, options, exec_params,
+            state):
         cls.handle_generate_code_request(
-            api_key, transaction_id, req_data, options, exec_params)
+            api_key, transaction_id, req_data, options, exec_params, state)
 
     @classmethod
     def handle_generate_code_from_audio_request(
-            cls, api_key, transaction_id, req_data, options, exec_params):
-        # Send audio.
-        audio_request = {
-            "file": (
-                os.path.basename(options["audio_file"]),
-                open(options["audio_file"], "rb")   # pylint: disable=R1732
-            ),
-            "model": (None, options["audio_model"]),
-            "prompt": (None, ""),
-            "response_format": (None, "json"),
-            "temperature": (None, "0.0"),
-            "language": (None, options["audio_language"]),
-        }
-        audio_headers = {
-            "Authorization": f"Bearer {api_key}"
-        }
+            cls, api_key, transaction_id, req_data, options, exec_params,
+            state):
         proxies = {
             "http": options["http_proxy"],
             "https": options["https_proxy"],
         }
-        response = requests.post(
-            "https://api.openai.com/v1/audio/transcriptions",
-            headers=audio_headers, files=audio_request, proxies=proxies)
-        response.raise_for_status()
-        response_data = response.json()
-        req_data["messages"].append({
+        session = get_session(proxies)
+
+        # Send audio. The transcription is reused by the retry.
+        if "transcription" not in state:
+            audio_request = {
+                "file": (os.path.basename(options["audio_file"]),
+                         options["audio_file"]),
+                "model": (None, options["audio_model"]),
+                "prompt": (None, ""),
+                "response_format": (None, "json"),
+                "temperature": (None, "0.0"),
+                "language": (None, options["audio_language"]),
+            }
+            audio_headers = {
+                "Authorization": f"Bearer {api_key}"
+            }
+            response = cls.send_api_request(
+                session, "audio/transcriptions", options["audio_model"],
+                headers=audio_headers, files=audio_request, proxies=proxies)
+            response.raise_for_status()
+            state["transcription"] = cls.decode_json(response)["text"]
+            RequestJournal.update_state(transaction_id, state)
+        transcription = state["transcription"]
+        req_data = dict(req_data)
+        req_data["messages"] = req_data["messages"] + [{
             "role": "user",
-            "content": response_data["text"],
-        })
-        options["code"] = response_data["text"][0:64]
+            "content": transcription,
+        }]
+        options["code"] = transcription[0:64]
 
         # Send prompt.
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {api_key}"
         }
-        response = requests.post("https://api.openai.com/v1/chat/completions",
-                                 headers=headers, data=json.dumps(req_data),
-                                 proxies=proxies)
-        response.raise_for_status()
-        response_data = response.json()
-        response_text = response_data["choices"][0]["message"]["content"]
+        response_text, num_tokens, cache_key = \
+            cls.send_journaled_chat_completion_request(
+                session, headers, proxies, req_data, options,
+                transaction_id, state)
 
         # Get code body.
         sections = parse_response_data(response_text)
@@ -737,22 +1753,25 @@ class RequestHandler:
 
         os.makedirs(CODE_DATA_DIR, exist_ok=True)
         filepath = f"{CODE_DATA_DIR}/{options['code']}.py"
-        with open(filepath, "w", encoding="utf-8") as f:
+        with cls.measure("write", "io"), \
+                open(filepath, "w", encoding="utf-8") as f:
             f.write(code_body)
+        # Cache the response after the code is extracted successfully.
+        cls.put_response_cache(cache_key, response_text, options)
 
         usage_stats = {
             # TODO: Add 'AUDIO' stat.
             'CODE': {
                 "model": req_data["model"],
-                "num_tokens": response_data["usage"]["total_tokens"],
+                "num_tokens": num_tokens,
             },
         }
 
         # Post to message queue.
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'CODE', {"usage_stats": usage_stats},
             options, exec_params)
-        OPENAI_OT_ProcessMessage.process(
+        cls.post_message(
             transaction_id, 'END_OF_TRANSACTION', None, None, exec_params)
 
     @classmethod
@@ -762,34 +1781,44 @@ class RequestHandler:
         req_type = request[2]
         req_data = request[3]
         options = request[4]
+        state = request[5]
+
+        with Profiler.profile(f"RequestHandler.handle_request-{req_type}"):
+            if req_type == 'GENERATE_IMAGE':
+                cls.handle_generate_image_request(
+                    api_key, transaction_id, req_data, options, exec_params,
+                    state)
+            elif req_type == 'EDIT_IMAGE':
+                cls.handle_edit_image_request(
+                    api_key, transaction_id, req_data, options, exec_params,
+                    state)
+            elif req_type == 'GENERATE_VARIATION_IMAGE':
+                cls.handle_generate_variation_image_request(
+                    api_key, transaction_id, req_data, options, exec_params,
+                    state)
+            elif req_type == 'TRANSCRIBE_AUDIO':
+                cls.handle_transcribe_audio_request(
+                    api_key, transaction_id, req_data, options, exec_params,
+                    state)
+            elif req_type == 'CHAT':
+                cls.handle_chat_request(
+                    api_key, transaction_id, req_data, options, exec_params,
+                    state)
+            elif req_type == 'GENERATE_CODE':
+                cls.handle_generate_code_request(
+                    api_key, transaction_id, req_data, options, exec_params,
+                    state)
+            elif req_type == 'GENERATE_CODE_FROM_AUDIO':
+                cls.handle_generate_code_from_audio_request(
+                    api_key, transaction_id, req_data, options, exec_params,
+                    state)
+            elif req_type == 'EDIT_CODE':
+                cls.handle_edit_code_request(
+                    api_key, transaction_id, req_data, options, exec_params,
+                    state)
 
-        if req_type == 'GENERATE_IMAGE':
-            cls.handle_generate_image_request(
-                api_key, transaction_id, req_data, options, exec_params)
-        elif req_type == 'EDIT_IMAGE':
-            cls.handle_edit_image_request(
-                api_key, transaction_id, req_data, options, exec_params)
-        elif req_type == 'GENERATE_VARIATION_IMAGE':
-            cls.handle_generate_variation_image_request(
-                api_key, transaction_id, req_data, options, exec_params)
-        elif req_type == 'TRANSCRIBE_AUDIO':
-            cls.handle_transcribe_audio_request(
-                api_key, transaction_id, req_data, options, exec_params)
-        elif req_type == 'CHAT':
-            cls.handle_chat_request(
-                api_key, transaction_id, req_data, options, exec_params)
-        elif req_type == 'GENERATE_CODE':
-            cls.handle_generate_code_request(
-                api_key, transaction_id, req_data, options, exec_params)
-        elif req_type == 'GENERATE_CODE_FROM_AUDIO':
-            cls.handle_generate_code_from_audio_request(
-                api_key, transaction_id, req_data, options, exec_params)
-        elif req_type == 'EDIT_CODE':
-            cls.handle_edit_code_request(
-                api_key, transaction_id, req_data, options, exec_params)
-
-    @classmethod
-    def send_loop(cls):
+    @classmethod
+    def send_loop(cls, worker_index):
         exec_params = {
             "sync": False,
             "context": None,
@@ -798,44 +1827,273 @@ class RequestHandler:
 
         while True:
             try:
-                if cls.should_stop:
+                request = cls.wait_request(worker_index)
+                if request is None:
                     break
 
-                with cls.request_queue_lock:    # pylint: disable=E1129
-                    if len(cls.request_queue) == 0:
-                        time.sleep(0.01)
-                        continue
-                    request = cls.request_queue.pop(0)
-
                 transaction_id = request[1]
+                LatencyRecorder.dequeue(transaction_id)
 
-                cls.handle_request(request, exec_params)
-
+                cls.worker_local.transaction_id = transaction_id
+                cls.worker_local.request_state = request[5]
+                try:
+                    cls.check_cancelled()
+                    cls.handle_request(request, exec_params)
+                finally:
+                    cls.worker_local.transaction_id = None
+                    cls.worker_local.request_state = None
+                    cls.finish_request(request)
+
+            except RequestCancelledError:
+                # The cancelled transaction has already received
+                # END_OF_TRANSACTION. This releases the request.
+                # pylint: disable=E0601
+                cls.post_message(
+                    transaction_id, 'END_OF_TRANSACTION', None, None,
+                    exec_params)
+            except RequestDeferredError as e:
+                # Paced by the rate limiter.
+                cls.defer_request(request, e.delay)
+                continue
+            except RequestHandlerStoppedError:
+                # The request is interrupted by stop() while waiting. It is
+                # left in the journal with its files to be resumed after
+                # the restart.
+                break
             except Exception as e:  # pylint: disable=W0703
                 # pylint: disable=E0601
-                OPENAI_OT_ProcessMessage.process(
+                if cls.schedule_retry(request, e):
+                    continue
+                cls.post_message(
                     transaction_id, 'ERROR', {"exception": e}, None,
                     exec_params)
-                OPENAI_OT_ProcessMessage.process(
+                cls.post_message(
                     transaction_id, 'END_OF_TRANSACTION', None, None,
                     exec_params)
+            cls.cleanup_request(request)
+
+
+def collect_request_metrics():
+    samples = []
+    request_queue_cond = RequestHandler.request_queue_cond
+    if request_queue_cond is not None:
+        with request_queue_cond:    # pylint: disable=E1129
+            for category, queue in RequestHandler.request_queues.items():
+                samples.append(("openai_bridge_request_queue_depth",
+                                {"category": category}, len(queue)))
+            for category, num in RequestHandler.running_requests.items():
+                samples.append(("openai_bridge_running_requests",
+                                {"category": category}, num))
+            samples.append(("openai_bridge_delayed_requests", {},
+                            len(RequestHandler.delayed_requests)))
+    with OPENAI_OT_ProcessMessage.message_queue_lock:
+        samples.append(("openai_bridge_message_queue_depth", {},
+                        len(OPENAI_OT_ProcessMessage.message_queue)))
+    with RequestHandler.inflight_lock:
+        samples.append(("openai_bridge_inflight_transactions", {},
+                        len(RequestHandler.active_transaction_ids)))
+    return samples
+
+
+MetricsRegistry.register_gauge_collector(collect_request_metrics)
 
 
 def sync_request(api_key, type_, data, options, context, operator_instance):
-    request = [api_key, None, type_, data, options]
+    request = [api_key, None, type_, data, options, {}]
     exec_params = {
         "sync": True,
         "context": context,
         "operator_instance": operator_instance,
     }
-    RequestHandler.handle_request(request, exec_params)
-
-
-def async_request(api_key, type_, data, options, transaction_data):
+    # The synchronous request blocks the main thread anyway, so the retry
+    # waits here if the delay is short.
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                RequestHandler.handle_request(request, exec_params)
+                return
+            except Exception as e:  # pylint: disable=W0703
+                if attempt >= MAX_RETRIES or not is_retryable_error(e):
+                    raise
+                delay = get_retry_delay(attempt, e, SYNC_RETRY_MAX_DELAY)
+                if delay > SYNC_RETRY_MAX_DELAY:
+                    raise
+                time.sleep(delay)
+    finally:
+        RequestHandler.cleanup_request(request)
+
+
+def async_request(api_key, type_, data, options, transaction_data,
+                  priority=DEFAULT_REQUEST_PRIORITY):
     transaction_id = uuid.uuid4()
     with OPENAI_OT_ProcessMessage.transaction_ids_lock:
         OPENAI_OT_ProcessMessage.transaction_ids[transaction_id] = \
             transaction_data
 
-    request = [api_key, transaction_id, type_, data, options]
+    request = [api_key, transaction_id, type_, data, options,
+               {"priority": priority}]
+    LatencyRecorder.begin(transaction_id, type_)
+    RequestJournal.add(request, transaction_data)
     RequestHandler.add_request(request)
+
+    return transaction_id
+
+
+def resume_requests(api_key):
+    # Resume the requests which were not finished by the previous session.
+    # The requests already queued or in flight are not sent again.
+    entries = RequestJournal.pop_unfinished()
+    with RequestHandler.inflight_lock:
+        entries = [
+            (request, transaction_data)
+            for request, transaction_data in entries
+            if request[1] not in RequestHandler.active_transaction_ids
+        ]
+    for request, transaction_data in entries:
+        request[0] = api_key
+        request[5]["resumed"] = True
+        LatencyRecorder.begin(request[1], request[2])
+        with OPENAI_OT_ProcessMessage.transaction_ids_lock:
+            OPENAI_OT_ProcessMessage.transaction_ids[request[1]] = \
+                transaction_data
+        RequestHandler.add_request(request)
+    return len(entries)
+
+
+def offer_resume_requests():
+    # Called by the timer after the add-on is registered, because the
+    # window is not ready while registering.
+    wm = bpy.context.window_manager
+    if len(wm.windows) == 0 or len(RequestJournal.load()) == 0:
+        return None
+    with bpy.context.temp_override(window=wm.windows[0]):
+        bpy.ops.system.openai_resume_requests('INVOKE_DEFAULT')
+    return None
+
+
+@BlClassRegistry()
+class OPENAI_OT_CancelRequest(bpy.types.Operator):
+
+    bl_idname = "system.openai_cancel_request"
+    bl_description = "Cancel the request (Cancel all requests if no ID)"
+    bl_label = "Cancel Request"
+    bl_options = {'REGISTER'}
+
+    transaction_id: bpy.props.StringProperty(
+        name="Transaction ID",
+        description="ID of the transaction to be cancelled",
+        default="",
+    )
+
+    def execute(self, _):
+        if self.transaction_id == "":
+            num_cancelled = RequestHandler.cancel_all()
+        else:
+            num_cancelled = 0
+            with RequestHandler.inflight_lock:
+                transaction_ids = list(RequestHandler.active_transaction_ids)
+            for transaction_id in transaction_ids:
+                if str(transaction_id) != self.transaction_id:
+                    continue
+                if RequestHandler.cancel(transaction_id):
+                    num_cancelled += 1
+
+        self.report({'INFO'}, f"Cancelled {num_cancelled} requests.")
+
+        return {'FINISHED'}
+
+
+@BlClassRegistry()
+class OPENAI_OT_ShowRequestLatency(bpy.types.Operator):
+
+    bl_idname = "system.openai_show_request_latency"
+    bl_description = "Write the latency of the request stages to the text"
+    bl_label = "Show Request Latency"
+    bl_options = {'REGISTER'}
+
+    def execute(self, context):
+        lines = format_statistics(LatencyRecorder.get_statistics())
+        if not lines:
+            self.report({'INFO'}, "No request is recorded.")
+            return {'CANCELLED'}
+
+        text_name = "OpenAI Bridge Request Latency"
+        if text_name not in bpy.data.texts:
+            bpy.data.texts.new(text_name)
+        text_data = bpy.data.texts[text_name]
+        text_data.clear()
+        text_data.write("\n".join(lines))
+        # Focus on the text in Text Editor.
+        _, _, space = get_area_region_space(
+            context, 'TEXT_EDITOR', 'WINDOW', 'TEXT_EDITOR')
+        if space is not None:
+            space.text = text_data
+        self.report({'INFO'}, f"Wrote the request latency to '{text_name}'.")
+
+        return {'FINISHED'}
+
+
+@BlClassRegistry()
+class OPENAI_OT_ClearRequestLatency(bpy.types.Operator):
+
+    bl_idname = "system.openai_clear_request_latency"
+    bl_description = "Clear the recorded latency of the requests"
+    bl_label = "Clear Request Latency"
+    bl_options = {'REGISTER'}
+
+    def execute(self, _):
+        LatencyRecorder.clear()
+
+        return {'FINISHED'}
+
+
+@BlClassRegistry()
+class OPENAI_OT_ResumeRequests(bpy.types.Operator):
+
+    bl_idname = "system.openai_resume_requests"
+    bl_description = "Resume the requests not finished by the last session"
+    bl_label = "Resume Requests"
+    bl_options = {'REGISTER'}
+
+    discard: bpy.props.BoolProperty(
+        name="Discard",
+        description="Discard the unfinished requests instead of resuming",
+        default=False,
+    )
+
+    def draw(self, _):
+        layout = self.layout
+
+        entries = RequestJournal.load()
+        layout.label(text=f"{len(entries)} requests were not finished:")
+        col = layout.column(align=True)
+        for _, transaction_data in entries[:10]:
+            col.label(text=f"[{transaction_data['type']}] "
+                           f"{transaction_data['title']}")
+        if len(entries) > 10:
+            col.label(text="...")
+        layout.prop(self, "discard")
+
+    def invoke(self, context, _):
+        wm = context.window_manager
+        user_prefs = context.preferences
+        prefs = user_prefs.addons["openai_bridge"].preferences
+
+        return wm.invoke_props_dialog(self, width=prefs.popup_menu_width)
+
+    def execute(self, context):
+        user_prefs = context.preferences
+        prefs = user_prefs.addons["openai_bridge"].preferences
+
+        if self.discard:
+            RequestJournal.discard_unfinished()
+            self.report({'INFO'}, "Discarded the unfinished requests.")
+            return {'FINISHED'}
+
+        num_resumed = resume_requests(prefs.api_key)
+        for _ in range(num_resumed):
+            # Run Message Processing Timer if it has not launched yet.
+            bpy.ops.system.openai_process_message()
+        self.report({'INFO'}, f"Resumed {num_resumed} requests.")
+
+        return {'FINISHED'}
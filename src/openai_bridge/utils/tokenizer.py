@@ -0,0 +1,114 @@
+import functools
+import hashlib
+import math
+import os
+import re
+import tempfile
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# Price (USD) per 1,000 tokens for the prompt and the completion.
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+}
+
+# Number of tokens added to each message by the chat format.
+TOKENS_PER_MESSAGE = 4
+# Number of tokens to prime the reply of the assistant.
+TOKENS_PER_REPLY = 3
+
+# Approximation of the pre-tokenizer used by the GPT models.
+# The words are split further into the chunks of CHARS_PER_TOKEN.
+PRETOKENIZE_PATTERN = re.compile(
+    r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+")
+CHARS_PER_TOKEN = 4
+
+CACHE_SIZE = 512
+
+# All supported chat models use this encoding.
+ENCODING_NAME = "cl100k_base"
+ENCODING_URL = \
+    "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+
+
+def is_encoding_cached():
+    # tiktoken downloads the encoding into the cache directory on the first
+    # use. The download must not block Blender or fail in offline.
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["TIKTOKEN_CACHE_DIR"]
+    elif "DATA_GYM_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["DATA_GYM_CACHE_DIR"]
+    else:
+        cache_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    if cache_dir == "":
+        return False
+    cache_key = hashlib.sha1(ENCODING_URL.encode()).hexdigest()
+    return os.path.exists(os.path.join(cache_dir, cache_key))
+
+
+class Encoding:
+    """The encoding of tiktoken, which is loaded on the first use and only
+    from the local cache. The regex tokenizer is used if it cannot be
+    loaded.
+    """
+
+    encoding = None
+    loaded = False
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        if cls.loaded:
+            return cls.encoding
+        with cls.lock:
+            if not cls.loaded:
+                if tiktoken is not None and is_encoding_cached():
+                    try:
+                        cls.encoding = tiktoken.get_encoding(ENCODING_NAME)
+                    except Exception:   # pylint: disable=W0703
+                        cls.encoding = None
+                cls.loaded = True
+        return cls.encoding
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = Encoding.get()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    num_tokens = 0
+    for chunk in PRETOKENIZE_PATTERN.findall(text):
+        if chunk.isspace():
+            num_tokens += 1
+        elif chunk.isascii():
+            num_tokens += math.ceil(len(chunk) / CHARS_PER_TOKEN)
+        else:
+            # Non-ASCII characters are often encoded into several tokens.
+            num_tokens += len(chunk.encode("utf-8")) // 2 + 1
+    return num_tokens
+
+
+def count_message_tokens(messages):
+    num_tokens = TOKENS_PER_REPLY
+    for message in messages:
+        num_tokens += count_tokens(message["content"]) + TOKENS_PER_MESSAGE
+    return num_tokens
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens=0):
+    if model not in MODEL_PRICES:
+        return None
+    prompt_price, completion_price = MODEL_PRICES[model]
+    cost = prompt_tokens * prompt_price
+    cost += completion_tokens * completion_price
+    return cost / 1000.0
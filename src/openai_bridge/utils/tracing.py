@@ -0,0 +1,111 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from ..utils.common import DATA_DIR
+
+TRACE_DIR = f"{DATA_DIR}/traces"
+# Oldest events are dropped over this number.
+MAX_TRACE_EVENTS = 1000000
+
+
+class Tracer:
+    """Records the spans of the worker threads and the main thread, and
+    saves them as Chrome Trace Event JSON which can be opened by Perfetto
+    or chrome://tracing.
+    """
+
+    enabled = False
+    lock = threading.Lock()
+    events = deque(maxlen=MAX_TRACE_EVENTS)
+    thread_names = {}
+    start_time = 0.0
+
+    @classmethod
+    def start(cls):
+        with cls.lock:
+            cls.events.clear()
+            cls.thread_names = {}
+            cls.start_time = time.perf_counter()
+            cls.enabled = True
+
+    @classmethod
+    def stop(cls, filepath):
+        with cls.lock:
+            cls.enabled = False
+            events = list(cls.events)
+            thread_names = dict(cls.thread_names)
+            cls.events.clear()
+        cls.save(filepath, events, thread_names)
+        return len(events)
+
+    @classmethod
+    def add_event(cls, name, category, start, end, args):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - cls.start_time) * 1000000.0,
+            "dur": (end - start) * 1000000.0,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+        }
+        if args:
+            event["args"] = args
+        with cls.lock:
+            if not cls.enabled:
+                return
+            cls.events.append(event)
+            cls.thread_names[thread.ident] = thread.name
+
+    @classmethod
+    @contextlib.contextmanager
+    def span(cls, name, category="", **args):
+        if not cls.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.add_event(name, category, start, time.perf_counter(), args)
+
+    @classmethod
+    def save(cls, filepath, events, thread_names):
+        pid = os.getpid()
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": pid,
+             "args": {"name": "Blender (OpenAI Bridge)"}}
+        ]
+        for tid, name in thread_names.items():
+            metadata.append({"name": "thread_name", "ph": "M", "pid": pid,
+                             "tid": tid, "args": {"name": name}})
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + events,
+                       "displayTimeUnit": "ms"}, f)
+
+
+def trace_draw(func):
+    # The draw function of the panel must keep its arguments, because
+    # Blender checks the number of arguments when the panel is registered.
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(self, context):
+        if not Tracer.enabled:
+            return func(self, context)
+        with Tracer.span(name, "ui"):
+            return func(self, context)
+
+    return wrapper
+
+
+def get_trace_filepath():
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    return f"{TRACE_DIR}/trace-{timestamp}.json"
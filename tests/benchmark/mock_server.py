@@ -0,0 +1,268 @@
+"""Local stand-in of OpenAI API for the benchmark.
+
+Implements the endpoints used by OpenAI Bridge with the configurable
+latency, jitter, error rates and payload sizes:
+
+    python mock_server.py --port 8000 --latency-ms 300 --jitter-ms 100 \\
+        --error-rate 0.02 --rate-limit-rate 0.02
+
+Point the add-on to the server by the environment variable before
+launching Blender:
+
+    OPENAI_BRIDGE_API_BASE_URL=http://127.0.0.1:8000/v1
+"""
+
+import argparse
+import json
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODELS = ["gpt-3.5-turbo", "gpt-4", "gpt-4-32k", "whisper-1", "dall-e-2"]
+IMAGE_SIZES = {"256x256": 256, "512x512": 512, "1024x1024": 1024}
+WORDS = ("the object mesh vertex material light camera scene render node "
+         "modifier curve armature texture shader").split()
+
+
+def make_png(width, height):
+    # Solid color image which Blender can load.
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + \
+            struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+
+    row = b"\x00" + b"\x80\x80\x80" * width
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + \
+        chunk(b"IDAT", zlib.compress(row * height)) + chunk(b"IEND", b"")
+
+
+class MockServerConfig:
+    def __init__(self, args):
+        self.latency = args.latency_ms / 1000.0
+        self.jitter = args.jitter_ms / 1000.0
+        self.error_rate = args.error_rate
+        self.rate_limit_rate = args.rate_limit_rate
+        self.chunk_interval = args.chunk_interval_ms / 1000.0
+        self.response_tokens = args.response_tokens
+        self.image_pixels = args.image_pixels
+        self.random = random.Random(args.seed)
+        self.random_lock = threading.Lock()
+        self.images = {}
+        self.images_lock = threading.Lock()
+
+    def uniform(self, a, b):
+        with self.random_lock:
+            return self.random.uniform(a, b)
+
+    def get_image(self, pixels):
+        with self.images_lock:
+            if pixels not in self.images:
+                self.images[pixels] = make_png(pixels, pixels)
+            return self.images[pixels]
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):   # pylint: disable=W0622
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def wait_latency(self):
+        config = self.config
+        time.sleep(max(0.0, config.latency + config.uniform(
+            -config.jitter, config.jitter)))
+
+    def inject_error(self):
+        # Returns True if the error response is sent instead.
+        config = self.config
+        value = config.uniform(0.0, 1.0)
+        if value < config.rate_limit_rate:
+            self.send_json(
+                429, {"error": {"message": "Rate limit reached (mock)"}},
+                {"Retry-After": "1"})
+            return True
+        if value < config.rate_limit_rate + config.error_rate:
+            self.send_json(
+                503, {"error": {"message": "Service unavailable (mock)"}})
+            return True
+        return False
+
+    def make_text(self, num_tokens):
+        words = [WORDS[i % len(WORDS)] for i in range(max(1, num_tokens - 8))]
+        return "Here is the code.\n```python\nimport bpy\n# " + \
+            " ".join(words) + "\n```\n"
+
+    def do_GET(self):   # pylint: disable=C0103
+        if self.path == "/v1/models":
+            self.send_json(
+                200, {"object": "list",
+                      "data": [{"id": m, "object": "model"} for m in MODELS]})
+        elif self.path.startswith("/files/"):
+            pixels = int(self.path.split("/")[2])
+            body = self.config.get_image(pixels)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):  # pylint: disable=C0103
+        body = self.read_body()
+        self.wait_latency()
+        if self.inject_error():
+            return
+
+        if self.path == "/v1/chat/completions":
+            self.handle_chat_completions(json.loads(body))
+        elif self.path == "/v1/images/generations":
+            request = json.loads(body)
+            self.handle_images(request.get("n", 1), request.get("size"))
+        elif self.path in ("/v1/images/edits", "/v1/images/variations"):
+            self.handle_images(self.get_multipart_field(body, "n", "1"),
+                               self.get_multipart_field(body, "size"))
+        elif self.path == "/v1/audio/transcriptions":
+            self.send_json(
+                200, {"text": self.make_text(self.config.response_tokens)})
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    @staticmethod
+    def get_multipart_field(body, name, default=None):
+        match = re.search(
+            rb'name="' + name.encode() + rb'"\r\n\r\n([^\r]*)\r\n', body)
+        if match is None:
+            return default
+        return match.group(1).decode("utf-8")
+
+    def handle_images(self, num_images, size):
+        pixels = IMAGE_SIZES.get(size, 256)
+        if self.config.image_pixels > 0:
+            pixels = self.config.image_pixels
+        host = self.headers.get("Host")
+        data = [
+            {"url": f"http://{host}/files/{pixels}/{uuid.uuid4().hex}.png"}
+            for _ in range(int(num_images))
+        ]
+        self.send_json(200, {"created": int(time.time()), "data": data})
+
+    def handle_chat_completions(self, request):
+        prompt_tokens = sum(
+            len(m["content"]) // 4 + 4 for m in request["messages"])
+        completion_tokens = self.config.response_tokens
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        text = self.make_text(completion_tokens)
+        if not request.get("stream", False):
+            self.send_json(200, {
+                "object": "chat.completion",
+                "model": request["model"],
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+            return
+
+        # Server-sent events. The connection is closed at the end instead
+        # of the chunked transfer encoding.
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        pieces = re.findall(r"\S+\s*", text)
+        num_chunks = max(1, completion_tokens // 4)
+        chunk_size = max(1, len(pieces) // num_chunks)
+        for i in range(0, len(pieces), chunk_size):
+            delta = "".join(pieces[i:i + chunk_size])
+            self.send_event({"choices": [
+                {"index": 0, "delta": {"content": delta}}]})
+            time.sleep(self.config.chunk_interval)
+        self.send_event({"choices": [
+            {"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        self.send_event({"choices": [], "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def send_event(self, data):
+        self.wfile.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Mock OpenAI API server for the benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-ms", type=float, default=200.0,
+                        help="Latency before the response")
+    parser.add_argument("--jitter-ms", type=float, default=50.0,
+                        help="Random variation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Ratio of 503 responses")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Ratio of 429 responses")
+    parser.add_argument("--chunk-interval-ms", type=float, default=20.0,
+                        help="Interval between the streaming chunks")
+    parser.add_argument("--response-tokens", type=int, default=200,
+                        help="Number of tokens of the chat response")
+    parser.add_argument("--image-pixels", type=int, default=0,
+                        help="Width of the images (0: requested size)")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def create_server(args):
+    handler_class = type("ConfiguredMockRequestHandler",
+                         (MockRequestHandler, ),
+                         {"config": MockServerConfig(args)})
+    server = ThreadingHTTPServer((args.host, args.port), handler_class)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv):
+    args = parse_args(argv)
+    server = create_server(args)
+    host, port = server.server_address[0:2]
+    print(f"Mock server is listening on http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
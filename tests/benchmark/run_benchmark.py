@@ -0,0 +1,316 @@
+"""End-to-end load benchmark of OpenAI Bridge.
+
+Sends the mix of the requests through async_request, processes the
+messages on the main thread like the message processing timer, and reports
+the throughput and the end-to-end latency. Run in Blender against the mock
+server:
+
+    OPENAI_BRIDGE_API_BASE_URL=http://127.0.0.1:8000/v1 \\
+        blender -b --python run_benchmark.py -- \\
+        --num-requests 200 --rate 10 --mix chat=3,ask=2,code=2,image=2,audio=1
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import wave
+
+import bpy
+
+ADDON_NAME = "openai_bridge"
+DEFAULT_MIX = "chat=3,ask=2,code=2,image=2,audio=1"
+REQUEST_KINDS = ("chat", "ask", "code", "image", "audio")
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, p):
+    # Nearest-rank percentile.
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100.0 * len(values)))
+    return values[rank - 1]
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        kind, weight = item.split("=")
+        if kind not in REQUEST_KINDS:
+            raise ValueError(f"Unknown request kind '{kind}'")
+        mix[kind] = float(weight)
+    return mix
+
+
+def make_silent_wav(filepath, seconds=1.0, rate=16000):
+    with wave.open(filepath, "wb") as f:
+        # pylint: disable=E1101
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(b"\x00\x00" * int(rate * seconds))
+
+
+def make_request(kind, index, audio_filepath):
+    # Returns the arguments of async_request which the operators send.
+    options = {
+        "http_proxy": "",
+        "https_proxy": "",
+    }
+    title = f"Benchmark {index}"
+    if kind in ("chat", "ask"):
+        data = {
+            "model": "gpt-3.5-turbo",
+            "messages": [{
+                "role": "user",
+                "content": f"How do I add a modifier? (request {index})",
+            }],
+        }
+        options.update({
+            "topic": title,
+            "new_topic": True,
+            "hidden_conditions": ["The question is for the Blender"],
+            "stream": kind == "chat",
+            "history_token_budget": 0,
+        })
+        priority = 'INTERACTIVE' if kind == "ask" else 'NORMAL'
+        return 'CHAT', data, options, priority
+    if kind == "code":
+        data = {
+            "model": "gpt-3.5-turbo",
+            "messages": [{
+                "role": "user",
+                "content": f"Add a cube at the origin. (request {index})",
+            }],
+        }
+        options.update({
+            "code": f"benchmark_{index}",
+            "execute_immediately": False,
+            "show_text_editor": False,
+            "stream": False,
+        })
+        return 'GENERATE_CODE', data, options, 'NORMAL'
+    if kind == "image":
+        data = {
+            "prompt": f"Concept art of a robot (request {index})",
+            "n": 2,
+            "size": "256x256",
+            "response_format": "url",
+        }
+        options.update({
+            "auto_image_name": True,
+            "image_name": "",
+        })
+        return 'GENERATE_IMAGE', data, options, 'BACKGROUND'
+    data = {
+        "file": (os.path.basename(audio_filepath), audio_filepath),
+        "model": (None, "whisper-1"),
+        "prompt": (None, ""),
+        "response_format": (None, "json"),
+        "temperature": (None, "0.0"),
+        "language": (None, "en"),
+    }
+    options.update({
+        "target": 'TEXT_EDITOR',
+        "target_text_name": "Benchmark Transcript",
+    })
+    return 'TRANSCRIBE_AUDIO', data, options, 'BACKGROUND'
+
+
+class MessageReporter:
+    # Stands in for the operator which reports the errors.
+
+    def __init__(self):
+        self.reports = []
+
+    def report(self, type_, message):
+        self.reports.append((type_, message))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="End-to-end load benchmark of OpenAI Bridge")
+    parser.add_argument("--num-requests", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Requests per second (0: send all at once)")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="Weights of the request kinds")
+    parser.add_argument("--timeout", type=float, default=600.0,
+                        help="Seconds to wait for all requests")
+    parser.add_argument("--poll-interval", type=float, default=None,
+                        help="Interval of the message processing")
+    parser.add_argument("--api-key", default="sk-benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None,
+                        help="File to write the result as JSON")
+    parser.add_argument("--keep-data", action="store_true",
+                        help="Keep the chat topics, code and images")
+    parser.add_argument("--allow-remote", action="store_true",
+                        help="Allow to send the requests to OpenAI API")
+    return parser.parse_args(argv)
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+        **{f"p{p}": percentile(latencies, p) for p in PERCENTILES},
+    }
+
+
+def run(args):
+    # pylint: disable=C0415
+    if ADDON_NAME not in bpy.context.preferences.addons:
+        bpy.ops.preferences.addon_enable(module=ADDON_NAME)
+    from openai_bridge.utils.common import (
+        API_BASE_URL,
+        CHAT_DATA_DIR,
+        CODE_DATA_DIR,
+    )
+    from openai_bridge.utils.threading import (
+        async_request,
+        OPENAI_OT_ProcessMessage,
+        MESSAGE_TIMER_MIN_INTERVAL,
+    )
+
+    if API_BASE_URL.startswith("https://api.openai.com") and \
+            not args.allow_remote:
+        print("Set OPENAI_BRIDGE_API_BASE_URL to the mock server, or "
+              "specify --allow-remote to send the requests to OpenAI API.")
+        return 1
+    poll_interval = args.poll_interval
+    if poll_interval is None:
+        poll_interval = MESSAGE_TIMER_MIN_INTERVAL
+
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    kinds = rng.choices(list(mix.keys()), weights=list(mix.values()),
+                        k=args.num_requests)
+    # Poisson arrivals at the rate.
+    arrivals = []
+    arrival_time = 0.0
+    for _ in kinds:
+        arrivals.append(arrival_time)
+        if args.rate > 0.0:
+            arrival_time += rng.expovariate(args.rate)
+
+    tmp_dir = tempfile.mkdtemp(prefix="openai_bridge_benchmark_")
+    audio_filepath = f"{tmp_dir}/audio.wav"
+    make_silent_wav(audio_filepath)
+
+    reporter = MessageReporter()
+    pending = {}
+    latencies = {kind: [] for kind in mix}
+    errors = {kind: 0 for kind in mix}
+    main_thread_times = []
+    created_filepaths = []
+    message_queue = OPENAI_OT_ProcessMessage.message_queue
+
+    start_time = time.monotonic()
+    next_index = 0
+    while next_index < len(kinds) or pending:
+        now = time.monotonic()
+        if now - start_time > args.timeout:
+            print(f"Timed out with {len(pending)} pending requests.")
+            break
+
+        while next_index < len(kinds) and \
+                arrivals[next_index] <= now - start_time:
+            kind = kinds[next_index]
+            type_, data, options, priority = make_request(
+                kind, next_index, audio_filepath)
+            transaction_data = {"type": type_, "title": f"{next_index}"}
+            transaction_id = async_request(
+                args.api_key, type_, data, options, transaction_data,
+                priority=priority)
+            pending[transaction_id] = (kind, time.monotonic())
+            if type_ == 'CHAT':
+                created_filepaths.append(
+                    f"{CHAT_DATA_DIR}/topics/{options['topic']}.jsonl")
+            elif type_ == 'GENERATE_CODE':
+                created_filepaths.append(
+                    f"{CODE_DATA_DIR}/{options['code']}.py")
+            next_index += 1
+
+        # Process the messages like the message processing timer.
+        while True:
+            with OPENAI_OT_ProcessMessage.message_queue_lock:
+                if len(message_queue) == 0:
+                    break
+                message = message_queue.popleft()
+            processing_start = time.perf_counter()
+            OPENAI_OT_ProcessMessage.process_message_internal(
+                bpy.context, reporter, message)
+            main_thread_times.append(time.perf_counter() - processing_start)
+
+            transaction_id = message["transaction_id"]
+            if message["type"] == 'IMAGE':
+                created_filepaths.append(message["data"]["filepath"])
+            elif message["type"] == 'ERROR':
+                errors[pending[transaction_id][0]] += 1
+            elif message["type"] == 'END_OF_TRANSACTION':
+                kind, sent_time = pending.pop(transaction_id)
+                latencies[kind].append(time.monotonic() - sent_time)
+                with OPENAI_OT_ProcessMessage.transaction_ids_lock:
+                    OPENAI_OT_ProcessMessage.transaction_ids.pop(
+                        transaction_id, None)
+
+        time.sleep(poll_interval)
+    elapsed = time.monotonic() - start_time
+
+    all_latencies = [v for values in latencies.values() for v in values]
+    result = {
+        "num_requests": args.num_requests,
+        "num_completed": len(all_latencies),
+        "num_errors": sum(errors.values()),
+        "elapsed": elapsed,
+        "throughput": len(all_latencies) / elapsed if elapsed > 0 else 0.0,
+        "latency": summarize(all_latencies),
+        "latency_per_kind": {
+            kind: dict(summarize(values), errors=errors[kind])
+            for kind, values in latencies.items()
+        },
+        "main_thread": summarize(main_thread_times),
+    }
+    print_result(result)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+    if not args.keep_data:
+        for filepath in created_filepaths + [audio_filepath]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        os.rmdir(tmp_dir)
+    return 0
+
+
+def print_result(result):
+    def row(name, stats, scale=1.0, unit="s"):
+        values = " ".join(
+            f"p{p}={stats[f'p{p}'] * scale:8.3f}{unit}" for p in PERCENTILES)
+        return f"{name:<12} n={stats['count']:<6} {values}"
+
+    print(f"Completed:   {result['num_completed']}/{result['num_requests']} "
+          f"({result['num_errors']} errors) in {result['elapsed']:.2f}s")
+    print(f"Throughput:  {result['throughput']:.2f} requests/s")
+    print("End-to-end latency:")
+    print(row("all", result["latency"]))
+    for kind, stats in result["latency_per_kind"].items():
+        print(row(kind, stats) + f" errors={stats['errors']}")
+    print("Main thread time per message:")
+    print(row("message", result["main_thread"], 1000.0, "ms"))
+
+
+def main():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    return run(parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Tests of the chat topic file written by the parallel writers.
+
+Run in Blender, because the add-on is imported through its package:
+
+    blender -b --python test_chat_text_file.py
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import bpy
+
+ADDON_NAME = "openai_bridge"
+
+
+def enable_addon():
+    if ADDON_NAME not in bpy.context.preferences.addons:
+        bpy.ops.preferences.addon_enable(module=ADDON_NAME)
+
+
+class ChatTextFileReplacedWhileStreamingTest(unittest.TestCase):
+    # The other writer replaces or removes the topic while the reply is
+    # streaming into it.
+
+    def setUp(self):
+        # pylint: disable=C0415
+        from openai_bridge.utils import common
+
+        self.common = common
+        tmp_dir = tempfile.TemporaryDirectory()    # pylint: disable=R1732
+        self.addCleanup(tmp_dir.cleanup)
+        patcher = mock.patch.object(common, "CHAT_DATA_DIR", tmp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.makedirs(f"{tmp_dir.name}/topics")
+
+    def start_streaming(self, topic):
+        # Adds the part of the reply, and checkpoints the partial response.
+        chat_file = self.common.ChatTextFile()
+        chat_file.new(topic)
+        part_id = chat_file.add_part("question", [], "")
+        chat_file.save()
+        chat_file.modify_part(
+            chat_file.get_part_index(part_id), response_data="Hello ")
+        chat_file.save()
+        return chat_file, part_id
+
+    def finish_streaming(self, chat_file, part_id):
+        chat_file.modify_part(
+            chat_file.get_part_index(part_id),
+            response_data="Hello world!")
+        chat_file.save()
+
+    def load(self, topic):
+        chat_file = self.common.ChatTextFile()
+        chat_file.load_from_topic(topic)
+        return [(chat_file.get_user_data(i), chat_file.get_response_data(i))
+                for i in range(chat_file.num_parts())]
+
+    def test_replaced(self):
+        chat_file, part_id = self.start_streaming("topic")
+
+        # Ask the new topic of the same name.
+        other_file = self.common.ChatTextFile()
+        other_file.new("topic")
+        other_file.add_part("other question", [], "other answer")
+        other_file.save()
+
+        self.finish_streaming(chat_file, part_id)
+        self.assertEqual(self.load("topic"), [
+            ("other question", "other answer"),
+            ("question", "Hello world!"),
+        ])
+
+    def test_removed(self):
+        chat_file, part_id = self.start_streaming("topic")
+
+        self.common.ChatTextFile.remove("topic")
+
+        self.finish_streaming(chat_file, part_id)
+        self.assertEqual(self.load("topic"), [("question", "Hello world!")])
+
+    def test_appended(self):
+        chat_file, part_id = self.start_streaming("topic")
+
+        other_file = self.common.ChatTextFile()
+        other_file.load_from_topic("topic")
+        other_file.add_part("other question", [], "other answer")
+        other_file.save()
+
+        self.finish_streaming(chat_file, part_id)
+        self.assertEqual(self.load("topic"), [
+            ("question", "Hello world!"),
+            ("other question", "other answer"),
+        ])
+
+
+def main():
+    enable_addon()
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    program = unittest.main(argv=[sys.argv[0]] + argv, exit=False)
+    return 0 if program.result.wasSuccessful() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())